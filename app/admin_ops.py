@@ -1,16 +1,24 @@
-from flask import Blueprint, render_template, request, redirect, url_for, jsonify, flash, Response
+from flask import Blueprint, render_template, request, redirect, url_for, jsonify, flash, Response, stream_with_context
 from .auth import get_current_user, is_user_admin
 from .config_loader import get_svc_conn, is_user_admin, get_global_setting
 from .db_actions import get_backup_path_for_db, allow_dynamic_backup
 from .queue import running_tasks
+from .cluster_cache import mark_updated as mark_cluster_cache_updated
+from .services.retention import run_retention
+from .services.backup_catalog import scan_catalog, get_catalog_report, fill_checksums_in_background
+from .services.prestage import get_prestage_stats, plan_prestage, predict_targets
+from .services.log_storage import apply_log_retention, get_partition_report, apply_data_compression, get_data_compression
+from .services.log_query import LogFilter, query_logs, stream_logs, DEFAULT_PAGE_SIZE
+from .services.log_search import search_logs, rebuild_index
+from .services.job_phases import get_phase_report
+from .services.csv_stream import iter_csv
+from .logger_db import log_user_action
 import threading
 import time
 import datetime
 import pyodbc
 import os
 import json
-import io
-import csv
 
 bp = Blueprint('admin_ops', __name__, url_prefix='/admin')
 
@@ -203,6 +211,8 @@ def update_setting():
                 WHERE setting_key = ?
             """, value, key)
         conn.commit()
+        # Настройки rac закэшированы во всех процессах (и в воркере): метка перечитает их везде
+        mark_cluster_cache_updated()
         flash(f"Настройка {key} обновлена", "success")
     except Exception as e:
         flash(f"Ошибка обновления настройки: {e}", "error")
@@ -256,13 +266,17 @@ def edit_user_db(db_id):
     cursor = conn.cursor()
     if request.method == 'POST':
         notify_user = request.form.get('notify_user') == 'on'
-        cursor.execute("UPDATE UserDatabases SET notify_user = ? WHERE id = ?", notify_user, db_id)
+        infobase_guid = request.form.get('infobase_guid', '').strip() or None
+        cursor.execute("UPDATE UserDatabases SET notify_user = ?, infobase_guid = ? WHERE id = ?",
+                       notify_user, infobase_guid, db_id)
         conn.commit()
+        # infobase_guid — запасной вариант топологии кластера для баз без ClusterInfo
+        mark_cluster_cache_updated()
         flash("Настройки обновлены", "success")
         return redirect(url_for('admin_ops.databases'))
 
     cursor.execute("""
-        SELECT ud.id, u.windows_login, ud.restore_target_db, ud.notify_user
+        SELECT ud.id, u.windows_login, ud.restore_target_db, ud.notify_user, ud.infobase_guid
         FROM UserDatabases ud
         JOIN Users u ON ud.user_id = u.id
         WHERE ud.id = ?
@@ -284,6 +298,7 @@ def delete_user_db(db_id):
     cursor.execute("DELETE FROM UserDatabases WHERE id = ?", db_id)
     conn.commit()
     conn.close()
+    mark_cluster_cache_updated()
     flash("Пользовательская БД удалена", "success")
     return redirect(url_for('admin_ops.databases'))
 
@@ -292,238 +307,161 @@ def full_logs():
     if not is_user_admin_check():
         return "Доступ запрещён", 403
 
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
-    user_filter = request.args.get('user')
-    log_type = request.args.get('log_type')  # 'auth', 'action', '1c'
-
-    conn = get_svc_conn()
-    cursor = conn.cursor()
-
-    query_parts = []
-    params = []
-
-    base_query = """
-        SELECT 'Auth' as type, windows_user, ip_address, action as event, details, timestamp
-        FROM AuthLog
-    """
-    if start_date:
-        base_query += " WHERE timestamp >= ?"
-        params.append(start_date)
-    if end_date:
-        if params:
-            base_query += " AND timestamp <= ?"
-        else:
-            base_query += " WHERE timestamp <= ?"
-        params.append(end_date)
-    if user_filter:
-        if params:
-            base_query += " AND windows_user = ?"
-        else:
-            base_query += " WHERE windows_user = ?"
-        params.append(user_filter)
-    if log_type == 'auth':
-        query_parts.append(base_query)
-
-    base_query_action = """
-        SELECT 'Action' as type, windows_user, ip_address, action_type as event, details, timestamp
-        FROM UserActionsLog
-    """
-    if start_date or end_date or user_filter:
-        where_clause = []
-        if start_date:
-            where_clause.append("timestamp >= ?")
-            params.append(start_date)
-        if end_date:
-            where_clause.append("timestamp <= ?")
-            params.append(end_date)
-        if user_filter:
-            where_clause.append("windows_user = ?")
-            params.append(user_filter)
-        base_query_action += " WHERE " + " AND ".join(where_clause)
-    if log_type == 'action' or not log_type:
-        query_parts.append(base_query_action)
-
-    base_query_1c = """
-        SELECT '1C' as type, (SELECT windows_user FROM RestoreQueue WHERE id = ocl.job_id) as windows_user, NULL as ip_address, operation as event, ISNULL(log_text, error_message) as details, timestamp
-        FROM OneCOperationLog ocl
-    """
-    if start_date or end_date or user_filter:
-        where_clause = []
-        base_query_1c += " JOIN RestoreQueue rq ON ocl.job_id = rq.id "
-        if start_date:
-            where_clause.append("ocl.timestamp >= ?")
-            params.append(start_date)
-        if end_date:
-            where_clause.append("ocl.timestamp <= ?")
-            params.append(end_date)
-        if user_filter:
-            where_clause.append("rq.windows_user = ?")
-            params.append(user_filter)
-        base_query_1c += " WHERE " + " AND ".join(where_clause)
-    if log_type == '1c' or not log_type:
-        query_parts.append(base_query_1c)
-
-    if not query_parts:
-        query_parts.append("""
-            SELECT 'Auth' as type, windows_user, ip_address, action as event, details, timestamp FROM AuthLog
-            UNION ALL
-            SELECT 'Action' as type, windows_user, ip_address, action_type as event, details, timestamp FROM UserActionsLog
-            UNION ALL
-            SELECT '1C' as type, (SELECT windows_user FROM RestoreQueue WHERE id = ocl.job_id) as windows_user, NULL as ip_address, operation as event, ISNULL(log_text, error_message) as details, ocl.timestamp FROM OneCOperationLog ocl JOIN RestoreQueue rq ON ocl.job_id = rq.id
-        """)
-        if start_date or end_date or user_filter:
-            where_clauses = []
-            if start_date:
-                where_clauses.append("timestamp >= ?")
-                params.append(start_date)
-            if end_date:
-                where_clauses.append("timestamp <= ?")
-                params.append(end_date)
-            if user_filter:
-                where_clauses.append("windows_user = ?")
-                params.append(user_filter)
-            if where_clauses:
-                query_parts = [f"({q}) WHERE {' AND '.join(where_clauses)}" for q in [
-                    "SELECT 'Auth' as type, windows_user, ip_address, action as event, details, timestamp FROM AuthLog",
-                    "SELECT 'Action' as type, windows_user, ip_address, action_type as event, details, timestamp FROM UserActionsLog",
-                    "SELECT '1C' as type, (SELECT windows_user FROM RestoreQueue WHERE id = ocl.job_id) as windows_user, NULL as ip_address, operation as event, ISNULL(log_text, error_message) as details, ocl.timestamp FROM OneCOperationLog ocl JOIN RestoreQueue rq ON ocl.job_id = rq.id"
-                ]]
-
-    full_query = " UNION ALL ".join(query_parts) + " ORDER BY timestamp DESC"
-
-    cursor.execute(full_query, params)
-    logs = cursor.fetchall()
-    conn.close()
+    try:
+        flt = LogFilter.from_args(request.args)
+        page = query_logs(flt, request.args.get('before'), request.args.get('page_size', DEFAULT_PAGE_SIZE, type=int))
+    except ValueError as e:
+        return str(e), 400
 
-    return render_template('admin/full_logs.html', logs=logs, start_date=start_date, end_date=end_date, user_filter=user_filter, log_type=log_type)
+    return render_template('admin/full_logs.html', logs=page["rows"], next_cursor=page["next_cursor"],
+                           start_date=request.args.get('start_date'), end_date=request.args.get('end_date'),
+                           user_filter=flt.windows_user, database=flt.target_db, log_type=request.args.get('log_type'))
 
 @bp.route('/logs/full/export')
 def export_full_logs():
+    """Выгрузка журналов по фильтру страницы потоком; ?compress=gzip — в .csv.gz."""
     if not is_user_admin_check():
         return "Доступ запрещён", 403
 
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
-    user_filter = request.args.get('user')
-    log_type = request.args.get('log_type')
+    try:
+        flt = LogFilter.from_args(request.args)
+    except ValueError as e:
+        return str(e), 400
+    compress = request.args.get('compress') == 'gzip'
+
+    rows = ([log['type'], log['windows_user'], log['ip_address'], log['event'],
+             log['details'] or log['error_message'], log['timestamp']] for log in stream_logs(flt))
+    body = iter_csv(['Тип', 'Пользователь', 'IP', 'Событие', 'Детали', 'Время'], rows, compress=compress)
+    filename = "full_logs.csv.gz" if compress else "full_logs.csv"
+    return Response(
+        stream_with_context(body),
+        mimetype="application/gzip" if compress else "text/csv",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
 
-    conn = get_svc_conn()
-    cursor = conn.cursor()
+@bp.route('/logs/search')
+def log_search():
+    """Поиск по выводу 1С и ошибкам задач: ?q=...&start_date&end_date&database&job_id&log_type; ?format=json — API."""
+    if not is_user_admin_check():
+        return "Доступ запрещён", 403
+
+    query = request.args.get('q', '').strip()
+    try:
+        flt = LogFilter.from_args(request.args, default_types=('1c', 'job'))
+        result = search_logs(query, flt, request.args.get('limit', 50, type=int)) if query else None
+    except ValueError as e:
+        return str(e), 400
+
+    if request.args.get('format') == 'json':
+        if result is None:
+            return jsonify({"error": "Пустой запрос"}), 400
+        for hit in result["hits"]:
+            hit["timestamp"] = hit["timestamp"].isoformat()
+            hit["url"] = url_for('admin_ops.full_logs', job_id=hit["job_id"]) if hit["job_id"] else None
+        return jsonify(result)
+    return render_template('admin/log_search.html', query=query, result=result,
+                           start_date=request.args.get('start_date'), end_date=request.args.get('end_date'),
+                           database=flt.target_db, log_type=request.args.get('log_type'))
+
+@bp.route('/logs/search/rebuild', methods=['POST'])
+def rebuild_log_search():
+    """Перестраивает поисковый индекс за период start_date..end_date (включительно)."""
+    if not is_user_admin_check():
+        return "Доступ запрещён", 403
+    try:
+        flt = LogFilter.from_args(request.form)
+    except ValueError as e:
+        return str(e), 400
+    if not flt.start or not flt.end:
+        flash("Укажите период перестройки индекса", "error")
+        return redirect(url_for('admin_ops.log_search'))
+    documents = rebuild_index(flt.start, flt.end)
+    log_user_action(get_current_user(), 'log_search_rebuilt', None,
+                    f"{flt.start:%d.%m.%Y}–{flt.end:%d.%m.%Y}: документов {documents}")
+    flash(f"Индекс перестроен, документов: {documents}", "success")
+    return redirect(url_for('admin_ops.log_search'))
+
+@bp.route('/performance')
+def performance():
+    """p50/p95 длительности шагов задач: ?group=phase|source|day&days=30&phase=&source=; ?format=json."""
+    if not is_user_admin_check():
+        return "Доступ запрещён", 403
+    group = request.args.get('group', 'phase')
+    days = request.args.get('days', 30, type=int)
+    phase = request.args.get('phase') or None
+    source = request.args.get('source') or None
+    try:
+        report = get_phase_report(group, days, phase, source)
+    except ValueError as e:
+        return str(e), 400
+    if request.args.get('format') == 'json':
+        return jsonify(report)
+    return render_template('admin/performance.html', report=report, group=group,
+                           days=days, phase=phase, source=source)
+
+@bp.route('/retention', methods=['GET', 'POST'])
+def retention():
+    """GET — план очистки бэкапов без изменений; POST — выполнить очистку."""
+    if not is_user_admin_check():
+        return "Доступ запрещён", 403
+    result = run_retention(dry_run=request.method == 'GET')
+    if request.method == 'POST':
+        log_user_action(get_current_user(), 'retention_run', None, json.dumps(result["summary"]))
+    return jsonify(result)
 
-    # Используем тот же запрос, что и выше
-    query_parts = []
-    params = []
+@bp.route('/catalog')
+def backup_catalog():
+    """Каталог бэкапов: объём по источникам, файлы-сироты, строки без файлов."""
+    if not is_user_admin_check():
+        return "Доступ запрещён", 403
+    report = get_catalog_report()
+    if request.args.get('format') == 'json':
+        return jsonify(report)
+    return render_template('admin/backup_catalog.html', **report)
 
-    base_query = """
-        SELECT 'Auth' as type, windows_user, ip_address, action as event, details, timestamp
-        FROM AuthLog
-    """
-    if start_date:
-        base_query += " WHERE timestamp >= ?"
-        params.append(start_date)
-    if end_date:
-        if params:
-            base_query += " AND timestamp <= ?"
-        else:
-            base_query += " WHERE timestamp <= ?"
-        params.append(end_date)
-    if user_filter:
-        if params:
-            base_query += " AND windows_user = ?"
-        else:
-            base_query += " WHERE windows_user = ?"
-        params.append(user_filter)
-    if log_type == 'auth':
-        query_parts.append(base_query)
-
-    base_query_action = """
-        SELECT 'Action' as type, windows_user, ip_address, action_type as event, details, timestamp
-        FROM UserActionsLog
+@bp.route('/catalog/scan', methods=['POST'])
+def scan_backup_catalog():
+    if not is_user_admin_check():
+        return "Доступ запрещён", 403
+    summary = scan_catalog(full=request.form.get('full') == '1')
+    # Контрольные суммы читают файлы целиком — не в запросе IIS, а в фоне
+    fill_checksums_in_background()
+    flash(f"Каталог обновлён: добавлено {summary['added']}, обновлено {summary['updated']}, "
+          f"удалено {summary['removed']} файлов за {summary['seconds']} с; контрольные суммы считаются в фоне", "success")
+    return redirect(url_for('admin_ops.backup_catalog'))
+
+@bp.route('/prestage', methods=['GET', 'POST'])
+def prestage():
+    """GET — прогноз на ближайший день и попадания прогнозов; POST — запланировать подготовку сейчас."""
+    if not is_user_admin_check():
+        return "Доступ запрещён", 403
+    if request.method == 'POST':
+        planned = plan_prestage()
+        log_user_action(get_current_user(), 'prestage_planned', None, f"Запланировано баз: {len(planned)}")
+    days = request.args.get('days', 30, type=int)
+    return jsonify({"forecast": predict_targets(), "stats": get_prestage_stats(days)})
+
+@bp.route('/log_storage', methods=['GET', 'POST'])
+def log_storage():
     """
-    if start_date or end_date or user_filter:
-        where_clause = []
-        if start_date:
-            where_clause.append("timestamp >= ?")
-            params.append(start_date)
-        if end_date:
-            where_clause.append("timestamp <= ?")
-            params.append(end_date)
-        if user_filter:
-            where_clause.append("windows_user = ?")
-            params.append(user_filter)
-        base_query_action += " WHERE " + " AND ".join(where_clause)
-    if log_type == 'action' or not log_type:
-        query_parts.append(base_query_action)
-
-    base_query_1c = """
-        SELECT '1C' as type, (SELECT windows_user FROM RestoreQueue WHERE id = ocl.job_id) as windows_user, NULL as ip_address, operation as event, ISNULL(log_text, error_message) as details, timestamp
-        FROM OneCOperationLog ocl
-        JOIN RestoreQueue rq ON ocl.job_id = rq.id
+    GET — строк журналов по месяцам и сжатие страниц; POST — применить срок хранения журналов сейчас,
+    POST с compression=NONE|ROW|PAGE — перестроить журналы с этим сжатием.
     """
-    if start_date or end_date or user_filter:
-        where_clause = []
-        if start_date:
-            where_clause.append("ocl.timestamp >= ?")
-            params.append(start_date)
-        if end_date:
-            where_clause.append("ocl.timestamp <= ?")
-            params.append(end_date)
-        if user_filter:
-            where_clause.append("rq.windows_user = ?")
-            params.append(user_filter)
-        base_query_1c += " WHERE " + " AND ".join(where_clause)
-    if log_type == '1c' or not log_type:
-        query_parts.append(base_query_1c)
-
-    if not query_parts:
-        query_parts.append("""
-            SELECT 'Auth' as type, windows_user, ip_address, action as event, details, timestamp
-            FROM AuthLog
-            UNION ALL
-            SELECT 'Action' as type, windows_user, ip_address, action_type as event, details, timestamp
-            FROM UserActionsLog
-            UNION ALL
-            SELECT '1C' as type, (SELECT windows_user FROM RestoreQueue WHERE id = ocl.job_id) as windows_user, NULL as ip_address, operation as event, ISNULL(log_text, error_message) as details, ocl.timestamp
-            FROM OneCOperationLog ocl
-            JOIN RestoreQueue rq ON ocl.job_id = rq.id
-        """)
-        if start_date or end_date or user_filter:
-            where_clauses = []
-            if start_date:
-                where_clauses.append("timestamp >= ?")
-                params.append(start_date)
-            if end_date:
-                where_clauses.append("timestamp <= ?")
-                params.append(end_date)
-            if user_filter:
-                where_clauses.append("windows_user = ?")
-                params.append(user_filter)
-            if where_clauses:
-                query_parts = [f"({q}) WHERE {' AND '.join(where_clauses)}" for q in [
-                    "SELECT 'Auth' as type, windows_user, ip_address, action as event, details, timestamp FROM AuthLog",
-                    "SELECT 'Action' as type, windows_user, ip_address, action_type as event, details, timestamp FROM UserActionsLog",
-                    "SELECT '1C' as type, (SELECT windows_user FROM RestoreQueue WHERE id = ocl.job_id) as windows_user, NULL as ip_address, operation as event, ISNULL(log_text, error_message) as details, ocl.timestamp FROM OneCOperationLog ocl JOIN RestoreQueue rq ON ocl.job_id = rq.id"
-                ]]
-
-    full_query = " UNION ALL ".join(query_parts) + " ORDER BY timestamp DESC"
-
-    cursor.execute(full_query, params)
-    logs = cursor.fetchall()
-    conn.close()
-
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['Тип', 'Пользователь', 'IP', 'Событие', 'Детали', 'Время'])
-    for log in logs:
-        writer.writerow([log.type, log.windows_user, log.ip_address, log.event, log.details, log.timestamp])
-    
-    output.seek(0)
-    return Response(
-        output.getvalue(),
-        mimetype="text/csv",
-        headers={"Content-Disposition": "attachment; filename=full_logs.csv"}
-    )
+    if not is_user_admin_check():
+        return "Доступ запрещён", 403
+    cleared = None
+    if request.method == 'POST':
+        compression = request.values.get('compression')
+        if compression:
+            try:
+                apply_data_compression(compression)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            log_user_action(get_current_user(), 'log_compression_applied', None, f"DATA_COMPRESSION = {compression}")
+        else:
+            cleared = apply_log_retention()
+            log_user_action(get_current_user(), 'log_retention_applied', None, f"Очищено строк: {cleared}")
+    return jsonify({"months": get_partition_report(), "compression": get_data_compression(), "cleared": cleared})
 
 @bp.route('/settings/global')
 def global_settings():
@@ -546,6 +484,7 @@ def edit_global_setting(setting_id):
         new_value = request.form['value']
         cursor.execute("UPDATE GlobalSettings SET setting_value = ? WHERE id = ?", new_value, setting_id)
         conn.commit()
+        mark_cluster_cache_updated()
         flash("Настройка обновлена", "success")
         return redirect(url_for('admin_ops.global_settings'))
 
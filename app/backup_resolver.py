@@ -0,0 +1,125 @@
+# app/backup_resolver.py
+"""
+Выбор бэкапа источника для восстановления.
+
+Раньше подходил только бэкап с backup_date = сегодня: после полуночи или при опоздании
+ночного бэкапа каждое восстановление падало или делало бэкап с продуктива.
+Теперь берётся самый свежий бэкап не старше окна свежести:
+  * BackupSources.backup_max_age_hours — для конкретного источника;
+  * GlobalSettings.backup_max_age_hours — для остальных (по умолчанию 36 часов).
+Пользователь может выбрать дату бэкапа явно (RestoreQueue.backup_date).
+Перед возвратом проверяется, что все файлы набора существуют.
+
+Результат — цепочка наборов для последовательного RESTORE: [[файлы полного]] или,
+для разностного бэкапа, [[файлы полного], [файлы разностного]].
+"""
+
+import datetime
+import os
+
+from .config_loader import get_svc_conn, get_global_setting
+
+DEFAULT_MAX_AGE_HOURS = 36
+CANDIDATES_LIMIT = 5  # сколько последних наборов проверять, если файлы свежего пропали
+
+
+def get_max_age_hours(source_db_name):
+    """Окно свежести для источника: переопределение из BackupSources или общая настройка."""
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("SELECT backup_max_age_hours FROM BackupSources WHERE source_db_name = ?", source_db_name)
+    row = cursor.fetchone()
+    conn.close()
+    if row and row[0]:
+        return row[0]
+    return int(get_global_setting('backup_max_age_hours') or DEFAULT_MAX_AGE_HOURS)
+
+
+def _load_sets(cursor, backup_ids):
+    """Файлы наборов: полосы из BackupFiles или backup_file_path для бэкапа из одного файла."""
+    placeholders = ', '.join('?' for _ in backup_ids)
+    cursor.execute(f"""
+        SELECT backup_id, file_path FROM BackupFiles
+        WHERE backup_id IN ({placeholders})
+        ORDER BY backup_id, file_index
+    """, *backup_ids)
+    files = {}
+    for backup_id, file_path in cursor.fetchall():
+        files.setdefault(backup_id, []).append(file_path)
+    return files
+
+
+def list_backups(source_db_name, limit=30):
+    """Последние бэкапы источника для выбора пользователем: [{backup_date, created_at}]."""
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT TOP (?) backup_date, created_at
+        FROM Backups
+        WHERE source_db_name = ?
+        ORDER BY backup_date DESC
+    """, limit, source_db_name)
+    rows = cursor.fetchall()
+    conn.close()
+    return [{"backup_date": row[0], "created_at": row[1]} for row in rows]
+
+
+def resolve_backup(source_db_name, backup_date=None, max_age_hours=None):
+    """
+    Возвращает цепочку наборов подходящего бэкапа (см. описание модуля) или None.
+    backup_date — явно выбранная дата; иначе самый свежий набор в окне свежести.
+    Наборы, у которых не хватает файлов на диске, пропускаются.
+    """
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    if backup_date:
+        cursor.execute("""
+            SELECT id, backup_file_path, backup_date, created_at, base_backup_id
+            FROM Backups
+            WHERE source_db_name = ? AND backup_date = ?
+        """, source_db_name, backup_date)
+    else:
+        if max_age_hours is None:
+            max_age_hours = get_max_age_hours(source_db_name)
+        not_before = datetime.datetime.now() - datetime.timedelta(hours=max_age_hours)
+        # Поиск по индексу IX_Backups_db_date (source_db_name, backup_date DESC)
+        cursor.execute("""
+            SELECT TOP (?) id, backup_file_path, backup_date, created_at, base_backup_id
+            FROM Backups
+            WHERE source_db_name = ? AND backup_date >= ? AND created_at >= ?
+            ORDER BY backup_date DESC, created_at DESC
+        """, CANDIDATES_LIMIT, source_db_name, not_before.date(), not_before)
+    rows = cursor.fetchall()
+    base_ids = [row[4] for row in rows if row[4]]
+    bases = {}
+    if base_ids:
+        placeholders = ', '.join('?' for _ in base_ids)
+        cursor.execute(f"SELECT id, backup_file_path FROM Backups WHERE id IN ({placeholders})", *base_ids)
+        bases = {row[0]: row[1] for row in cursor.fetchall()}
+    striped = _load_sets(cursor, [row[0] for row in rows] + base_ids) if rows else {}
+    conn.close()
+
+    for backup_id, backup_file_path, row_date, created_at, base_backup_id in rows:
+        chain = [striped.get(backup_id) or [backup_file_path]]
+        if base_backup_id:
+            # Разностный бэкап восстанавливается поверх своего полного
+            if base_backup_id not in bases:
+                print(f"⚠️ Бэкап {source_db_name} от {row_date} пропущен: нет полного бэкапа цепочки")
+                continue
+            chain.insert(0, striped.get(base_backup_id) or [bases[base_backup_id]])
+        missing = [path for files in chain for path in files if not os.path.exists(path)]
+        if missing:
+            print(f"⚠️ Бэкап {source_db_name} от {row_date} пропущен: нет файлов {', '.join(missing)}")
+            continue
+        return chain
+    return None
+
+
+def get_requested_backup_date(job_id):
+    """Дата бэкапа, выбранная пользователем для задачи (RestoreQueue.backup_date), или None."""
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("SELECT backup_date FROM RestoreQueue WHERE id = ?", job_id)
+    row = cursor.fetchone()
+    conn.close()
+    return row[0] if row else None
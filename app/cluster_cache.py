@@ -0,0 +1,151 @@
+# app/cluster_cache.py
+"""
+Кэш топологии кластера 1С в памяти процесса: имя базы -> cluster_guid, infobase_guid, db_server.
+
+Заполняется одним проходом по ClusterInfo (плюс infobase_guid из UserDatabases/CommonDatabases
+для баз, которых нет в ClusterInfo) вместе с настройками rac из GlobalSettings,
+поэтому вызовы rac не делают запросов к svc-БД.
+Кластер для таких баз — основной кластер ClusterInfo, а если она пуста — настройка
+cluster_guid или единственный кластер из `rac cluster list` (запрашивается один раз).
+Скрипт scripts/parse_cluster_info.py после синхронизации, а админка после изменения
+настроек или баз обновляют файл-метку (mark_updated), и кэш во всех процессах
+перечитывается при следующем обращении.
+"""
+
+import os
+import threading
+import time
+from collections import Counter
+
+from .config_loader import get_svc_conn
+
+STAMP_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'config', 'cluster_info.stamp')
+MISS_RELOAD_INTERVAL = 60  # seconds: как часто можно перечитать кэш из-за промаха
+RAC_SETTING_KEYS = ('path_to_rac', 'ras_address', 'app_server', 'app_server_admin', 'app_server_admin_pwd',
+                    'cluster_guid')
+
+_lock = threading.Lock()
+_topology = {}
+_settings = {}
+_loaded = False
+_loaded_stamp = None
+_last_load = 0.0
+_rac_cluster = None  # кластер из `rac cluster list`, если ClusterInfo пуста и cluster_guid не задан
+
+
+def _stamp_mtime():
+    try:
+        return os.stat(STAMP_FILE).st_mtime
+    except OSError:
+        return None
+
+
+def _load():
+    """Читает ClusterInfo, GUID из UserDatabases/CommonDatabases и настройки rac за одно подключение."""
+    global _topology, _settings, _loaded, _loaded_stamp, _last_load, _rac_cluster
+    stamp = _stamp_mtime()
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("SELECT name, cluster_guid, infobase_guid, db_server FROM ClusterInfo")
+    topology = {}
+    clusters = Counter()
+    for name, cluster_guid, infobase_guid, db_server in cursor.fetchall():
+        topology[name.lower()] = {
+            "cluster_guid": cluster_guid,
+            "infobase_guid": infobase_guid,
+            "db_server": db_server,
+        }
+        clusters[cluster_guid] += 1
+
+    placeholders = ', '.join('?' for _ in RAC_SETTING_KEYS)
+    cursor.execute(f"SELECT setting_key, setting_value FROM GlobalSettings WHERE setting_key IN ({placeholders})",
+                   *RAC_SETTING_KEYS)
+    settings = {key: value for key, value in cursor.fetchall()}
+
+    # Базы, которых нет в ClusterInfo, но для которых GUID задан вручную;
+    # кластер без ClusterInfo определяется при первом обращении (_fallback_cluster)
+    cursor.execute("""
+        SELECT restore_target_db, infobase_guid FROM UserDatabases WHERE infobase_guid IS NOT NULL
+        UNION ALL
+        SELECT restore_target_db, infobase_guid FROM CommonDatabases WHERE infobase_guid IS NOT NULL
+    """)
+    default_cluster = clusters.most_common(1)[0][0] if clusters else settings.get('cluster_guid') or None
+    for name, infobase_guid in cursor.fetchall():
+        if name.lower() not in topology:
+            topology[name.lower()] = {
+                "cluster_guid": default_cluster,
+                "infobase_guid": infobase_guid,
+                "db_server": None,
+            }
+    conn.close()
+
+    _topology = topology
+    _settings = settings
+    _rac_cluster = None
+    _loaded = True
+    _loaded_stamp = stamp
+    _last_load = time.monotonic()
+    print(f"[cluster_cache] загружено баз: {len(topology)}")
+
+
+def _ensure_fresh():
+    with _lock:
+        if not _loaded or _stamp_mtime() != _loaded_stamp:
+            _load()
+
+
+def _fallback_cluster():
+    """Кластер для баз без ClusterInfo, когда он не задан: единственный кластер из `rac cluster list`."""
+    global _rac_cluster
+    if _rac_cluster is None:
+        # Импорт здесь: rac_client сам читает настройки из этого модуля
+        from .rac_client import list_clusters
+        clusters = list_clusters()
+        if len(clusters) != 1:
+            raise RuntimeError(f"rac cluster list вернул кластеров: {len(clusters)}; задайте настройку cluster_guid")
+        _rac_cluster = clusters[0]
+    return _rac_cluster
+
+
+def get_cluster_info(db_name):
+    """Возвращает dict cluster_guid, infobase_guid, db_server для базы или None."""
+    _ensure_fresh()
+    info = _topology.get(db_name.lower())
+    if info is None:
+        # База могла появиться после загрузки кэша — перечитываем, но не чаще MISS_RELOAD_INTERVAL
+        with _lock:
+            if time.monotonic() - _last_load > MISS_RELOAD_INTERVAL:
+                _load()
+        info = _topology.get(db_name.lower())
+    if info is None:
+        return None
+    info = dict(info)
+    if not info["cluster_guid"]:
+        try:
+            info["cluster_guid"] = _fallback_cluster()
+        except Exception as e:
+            print(f"[cluster_cache] кластер базы {db_name} не определён: {e}")
+            return None
+    return info
+
+
+def get_rac_setting(key):
+    """Возвращает закэшированную настройку rac из GlobalSettings (см. RAC_SETTING_KEYS)."""
+    _ensure_fresh()
+    return _settings.get(key)
+
+
+def invalidate():
+    """Сбрасывает кэш; следующее обращение перечитает данные из svc-БД."""
+    global _loaded
+    with _lock:
+        _loaded = False
+
+
+def mark_updated():
+    """Отмечает, что ClusterInfo изменилась: обновляет файл-метку для всех процессов."""
+    os.makedirs(os.path.dirname(STAMP_FILE), exist_ok=True)
+    with open(STAMP_FILE, 'a'):
+        pass
+    os.utime(STAMP_FILE, None)
+    invalidate()
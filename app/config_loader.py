@@ -36,6 +36,63 @@ def get_global_setting(key):
     conn.close()
     return row[0] if row else None
 
+def get_tuning_profile(profile_name=None):
+    """
+    Возвращает профиль настройки БД из TuningProfiles (по умолчанию — 'default').
+    Если профиля нет, используется MAXDOP = 1 без прочих изменений.
+    """
+    profile_name = profile_name or 'default'
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT profile_name, maxdop, auto_update_stats, auto_update_stats_async, query_store
+        FROM TuningProfiles
+        WHERE profile_name = ?
+    """, profile_name)
+    row = cursor.fetchone()
+    conn.close()
+    if not row:
+        return {"profile_name": profile_name, "maxdop": 1}
+    return {
+        "profile_name": row[0],
+        "maxdop": row[1],
+        "auto_update_stats": row[2],
+        "auto_update_stats_async": row[3],
+        "query_store": row[4]
+    }
+
+def get_backup_profile(profile_name=None):
+    """
+    Возвращает профиль бэкапа из BackupProfiles (по умолчанию — 'default').
+    volumes — список папок для полос (пусто — backup_base_path); параметры
+    BUFFERCOUNT/MAXTRANSFERSIZE/BLOCKSIZE со значением None не указываются.
+    strategy: 'full' — каждый раз COPY_ONLY, 'weekly_full_daily_diff' — полный в full_weekday
+    (0 — понедельник) и разностные в остальные дни.
+    Если профиля нет, бэкап пишется одним файлом, как раньше.
+    """
+    profile_name = profile_name or 'default'
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT profile_name, stripes, volumes, buffer_count, max_transfer_size, block_size, strategy, full_weekday
+        FROM BackupProfiles
+        WHERE profile_name = ?
+    """, profile_name)
+    row = cursor.fetchone()
+    conn.close()
+    if not row:
+        return {"profile_name": profile_name, "stripes": 1, "volumes": [], "strategy": 'full', "full_weekday": 6}
+    return {
+        "profile_name": row[0],
+        "stripes": max(row[1] or 1, 1),
+        "volumes": [v.strip() for v in (row[2] or '').split(';') if v.strip()],
+        "buffer_count": row[3],
+        "max_transfer_size": row[4],
+        "block_size": row[5],
+        "strategy": row[6] or 'full',
+        "full_weekday": row[7] if row[7] is not None else 6
+    }
+
 def get_user_databases(windows_login):
     conn = get_svc_conn()
     cursor = conn.cursor()
@@ -97,7 +154,7 @@ def get_db_config(target_db_name, windows_login):
                ud.header, ud.use_storage, ud.backup_path_template, ud.storage_path,
                ISNULL(ud.user_app_login, (SELECT setting_value FROM GlobalSettings WHERE setting_key = 'app_user')) as app_login,
                ISNULL(ud.user_app_password, (SELECT setting_value FROM GlobalSettings WHERE setting_key = 'app_password')) as app_password,
-               ud.infobase_guid
+               ud.infobase_guid, ud.tuning_profile
         FROM UserDatabases ud
         JOIN Users u ON ud.user_id = u.id
         WHERE u.windows_login = ? AND ud.restore_target_db = ?
@@ -116,12 +173,13 @@ def get_db_config(target_db_name, windows_login):
             "app_login": row[7],
             "app_password": row[8],
             "infobase_guid": row[9],  # Новое
+            "tuning_profile": row[10],
             "sql_login": "sa",
             "sql_password": "..."
         }
 
     cursor.execute("""
-        SELECT source_db_name, header, backup_path_template, infobase_guid
+        SELECT source_db_name, header, backup_path_template, infobase_guid, tuning_profile
         FROM CommonDatabases
         WHERE restore_target_db = ?
         AND is_admin_only = 0
@@ -134,6 +192,7 @@ def get_db_config(target_db_name, windows_login):
             "header": row[1],
             "backup_path": row[2],
             "infobase_guid": row[3],  # Новое
+            "tuning_profile": row[4],
             "use_storage": False,
             "app_login": get_global_setting('app_user'),
             "app_password": get_global_setting('app_password'),
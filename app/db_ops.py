@@ -1,17 +1,33 @@
 import os
 from pathlib import Path
-import pyodbc
 import datetime
 import threading
 import time
+import hmac
 from collections import deque
+from contextlib import ExitStack
 from flask import Blueprint, request, jsonify, render_template, flash,  redirect, url_for, Response, stream_with_context # добавим flash
 from .auth import get_current_user
-from .config_loader import get_user_databases, get_common_databases, get_db_config, get_svc_conn, is_user_admin, get_global_setting
+from .config_loader import get_user_databases, get_common_databases, get_db_config, get_svc_conn, is_user_admin, get_global_setting, get_tuning_profile
 from .onec_commands import run_1c_command_via_1cv8, run_1c_command_via_rac
-from .email_sender import notify_user_on_restore_complete
-from .logger_db import log_user_action, log_1c_operation
-from .db_utils import get_svc_conn, get_sql_server_conn, get_sql_server_conn_config
+from .rac_client import drain_sessions
+from .services.storage_cache import update_from_storage, record_restored_target
+from .services.eta import get_queue_eta
+from .services.backup_flight import get_or_create_backup
+from .services.backup_catalog import record_backup
+from .services.backup_staging import staged_backup
+from .services.prestage import run_due_prestage, record_prestage_hit
+from .services.log_query import LogFilter, query_logs
+from .services.log_broker import subscribe, finish as finish_log_stream
+from .services.log_search import index_document
+from .services.job_phases import JobPhases, files_size
+from .services.job_queue import enqueue_job, claim_next_job, set_job_progress
+from .services.metrics import inc as inc_metric, observe_job, render as render_metrics
+from .sql_session import SqlSession, quote_name
+from .backup_resolver import resolve_backup, list_backups, get_requested_backup_date
+from .email_sender import notify_user_on_restore_complete, notify_user_on_backup_complete
+from .logger_db import log_user_action, log_1c_operation, log_task_message
+from .db_utils import get_svc_conn
 from flask import current_app
 import logging
 import re
@@ -42,14 +58,8 @@ def validate_db_name(db_name):
     return True
 
 def get_quoted_name(db_name):
-    """Возвращает безопасно экранированное имя БД через QUOTENAME."""
-    validate_db_name(db_name)
-    conn = get_sql_server_conn()  # Функция, которая возвращает подключение к SQL Server
-    cursor = conn.cursor()
-    cursor.execute("SELECT QUOTENAME(?)", db_name)
-    quoted = cursor.fetchone()[0]
-    conn.close()
-    return quoted
+    """Возвращает безопасно экранированное имя БД (локальный аналог QUOTENAME, без запроса к серверу)."""
+    return quote_name(db_name)
 
 def load_pending_jobs_from_db():
     """Загружает все pending задачи из БД при старте приложения."""
@@ -95,33 +105,24 @@ def worker_loop():
     current_app.logger.info("worker_loop: Поток запущен")
     while not shutdown_event.is_set():
         try:
-            conn = get_svc_conn()
-            cursor = conn.cursor()
-            # Атомарно получаем одну задачу со статусом 'pending'
-            cursor.execute("""
-                UPDATE TOP(1) RestoreQueue
-                SET status = 'running', started_at = GETDATE()
-                OUTPUT INSERTED.id, INSERTED.windows_user, INSERTED.target_db
-                WHERE status = 'pending'
-                ORDER BY priority, created_at
-            """)
-            row = cursor.fetchone()
-            conn.close()
-
-            if row:
-                job_id, windows_user, target_db = row
-                current_app.logger.info(f"worker_loop: Захвачена задача {job_id} для {target_db}")
+            # Атомарно получаем одну задачу со статусом 'pending' того типа, для которого есть свободный слот
+            job = claim_next_job()
+
+            if job:
+                job_id = job['id']
+                current_app.logger.info(f"worker_loop: Захвачена задача {job_id} ({job['job_type']}) для {job['target_db']}")
 
                 # Запускаем обработку задачи в отдельном потоке
                 thread = threading.Thread(
-                    target=perform_restore_job,
-                    args=({"id": job_id, "windows_user": windows_user, "target_db": target_db},),
+                    target=perform_job,
+                    args=(job,),
                     daemon=True
                 )
                 thread.start()
                 current_app.logger.info(f"worker_loop: Задача {job_id} передана в поток")
             else:
-                # Нет задач, ждём
+                # Нет задач: время для подготовки к ожидаемым восстановлениям, затем ждём
+                run_due_prestage()
                 current_app.logger.debug("worker_loop: Нет задач, жду 5 секунд...")
                 shutdown_event.wait(timeout=5)
         except Exception as e:
@@ -165,68 +166,147 @@ def update_job_status(job_id, status, error_message=None):
             cursor.execute("""
                 UPDATE RestoreQueue
                 SET status = ?, finished_at = GETDATE(), error_message = ?
+                OUTPUT INSERTED.job_type
                 WHERE id = ?
             """, status, error_message, job_id)
+            finished_row = cursor.fetchone()
+            if finished_row:
+                inc_metric(f'jobs_{status}_total', {'job_type': finished_row[0]})
 
         # Записываем в историю RestoreJobs
         cursor.execute("""
             INSERT INTO RestoreJobs (job_id, windows_user, target_db, status, error_message)
+            OUTPUT INSERTED.id, INSERTED.target_db, INSERTED.started_at
             SELECT id, windows_user, target_db, status, error_message
             FROM RestoreQueue
             WHERE id = ?
         """, job_id)
+        history_row = cursor.fetchone()
 
         conn.commit()
+        # Ошибка задачи — в поисковый индекс журналов (app/services/log_search.py)
+        if error_message and history_row:
+            try:
+                index_document(cursor, 'job', history_row[0], job_id, history_row[1], history_row[2], error_message)
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                current_app.logger.warning(f"Ошибка задачи {job_id} не добавлена в поисковый индекс: {e}")
+        if status in ('completed', 'failed'):
+            finish_log_stream(job_id, status)
     except Exception as e:
         current_app.logger.error(f"Ошибка при обновлении статуса задачи {job_id}: {e}")
     finally:
         conn.close()
     
     
+def perform_job(job):
+    """Выполняет задачу очереди по её типу (RestoreQueue.job_type)."""
+    labels = {'job_type': job.get('job_type') or 'restore'}
+    inc_metric('jobs_active', labels)
+    try:
+        if job.get('job_type') == 'user_backup':
+            perform_user_backup_job(job)
+        else:
+            perform_restore_job(job)
+    finally:
+        inc_metric('jobs_active', labels, -1)
+
 def perform_restore_job(job):
-    # job = {'id': ..., 'windows_user': ..., 'target_db': ...}
+    # job = {'id': ..., 'windows_user': ..., 'target_db': ..., 'job_type': ..., 'user_backup_id': ...}
     job_id = job['id']
     user = job['windows_user']
     target_db = job['target_db']
     db_config = get_db_config(target_db, user)
     if not db_config:
         update_job_status(job_id, 'failed', 'Нет доступа к БД')
-        log_1c_operation(job_id, target_db, 'access_check', 'error', error_message='Нет доступа к БД')
         running_tasks.discard(job_id)
         return
 
-    source_db = db_config['source_db']
-    backup_path = get_backup_path_for_db(source_db)
+    phases = JobPhases(job_id, job.get('job_type') or 'restore', target_db, db_config.get('source_db'))
+    job_started = time.monotonic()
+    if job.get('job_type') == 'user_restore':
+        # Восстановление из личного бэкапа: файл известен, бэкап источника не нужен
+        phases.source_db = target_db
+        backup_path = get_user_backup_file(job.get('user_backup_id'), user)
+        if not backup_path:
+            update_job_status(job_id, 'failed', 'Личный бэкап не найден или файл удалён')
+            running_tasks.discard(job_id)
+            return
+        backup_date = None
+    else:
+        source_db = db_config['source_db']
+        backup_date = get_requested_backup_date(job_id)
+        backup_path = get_backup_path_for_db(source_db, backup_date)
+    if not backup_path and backup_date:
+        update_job_status(job_id, 'failed', f'Бэкап за {backup_date:%d.%m.%Y} не найден')
+        running_tasks.discard(job_id)
+        return
     if not backup_path:
         if not allow_dynamic_backup:
             update_job_status(job_id, 'failed', 'Бэкап отсутствует и создание запрещено')
-            log_1c_operation(job_id, target_db, 'backup_check', 'error', error_message='Бэкап отсутствует и создание запрещено')
             running_tasks.discard(job_id)
             return
-        print(f"⚠️ Нет бэкапа для {source_db}, создаю...")
-        log_1c_operation(job_id, target_db, 'backup_creation', 'started', log_text=f"Создание бэкапа {source_db}")
-        from scripts.backup_task import create_backup_from_source
-        backup_path = create_backup_from_source(source_db)
-        log_1c_operation(job_id, target_db, 'backup_creation', 'success', log_text=f"Бэкап {backup_path} создан")
+        # Параллельные задачи с тем же источником дождутся одного общего бэкапа
+        set_job_progress(job_id, stage='Бэкап источника')
+        try:
+            with phases.phase('source_backup') as step:
+                backup_path = get_or_create_backup(source_db)
+                step['bytes'] = files_size(backup_path)
+        except Exception as e:
+            phases.flush()
+            update_job_status(job_id, 'failed', f'Не удалось создать бэкап: {e}')
+            running_tasks.discard(job_id)
+            return
 
     # SQL-логины для восстановления БД (не зависят от пользователя)
     sql_login = db_config['sql_login']
     sql_password = db_config['sql_password']
+    # Одно подключение к SQL Server на всю задачу; открывается при первом SQL-шаге
+    sql = SqlSession(sql_login, sql_password, job_id=job_id)
+    sql.progress_callback = lambda percent: set_job_progress(job_id, percent)
     try:
+        set_job_progress(job_id, stage='Завершение сеансов 1С')
         # --- НОВОЕ: Блокировка сеансов через rac перед восстановлением ---
         try:
-            log_1c_operation(job_id, target_db, 'session_block', 'started', log_text="Блокировка сеансов через rac")
-            run_1c_command_via_rac(target_db, "infobase update --sessions-deny=on")
-            log_1c_operation(job_id, target_db, 'session_block', 'success', log_text="Сеансы заблокированы")
+            with phases.phase('sessions_deny'):
+                run_1c_command_via_rac(target_db, "infobase update --sessions-deny=on", job_id=job_id)
             print(f"✅ Сеансы заблокированы для {target_db}")
         except Exception as e:
-            log_1c_operation(job_id, target_db, 'session_block', 'error', error_message=str(e))
             print(f"⚠️ Не удалось заблокировать сеансы для {target_db}: {e}")
-            # Не фатально, можно продолжить
 
-        log_1c_operation(job_id, target_db, 'restore_db', 'started', log_text="Начало восстановления БД из .bak")
-        restore_db_from_backup(target_db, backup_path, sql_login, sql_password)
-        log_1c_operation(job_id, target_db, 'restore_db', 'success', log_text="Восстановление БД завершено")
+        # Завершаем оставшиеся сеансы, чтобы RESTORE не ждал ROLLBACK IMMEDIATE по живым сеансам 1С
+        try:
+            with phases.phase('session_drain'):
+                drain = drain_sessions(target_db, exclude_users=[get_global_setting('app_user'), db_config.get('app_login')], job_id=job_id)
+            log_1c_operation(job_id, target_db, 'session_drain', 'success',
+                             log_text=f"Сеансов найдено: {drain['found']}, завершено: {drain['terminated']}, "
+                                      f"ошибок: {drain['failed']}, осталось: {drain['remaining']}, "
+                                      f"время: {drain['elapsed']:.1f} с")
+            print(f"✅ Сеансы {target_db} завершены за {drain['elapsed']:.1f} с")
+        except Exception as e:
+            log_1c_operation(job_id, target_db, 'session_drain', 'error', error_message=str(e))
+            print(f"⚠️ Не удалось завершить сеансы для {target_db}: {e}")
+
+        backup_bytes = files_size(backup_path)
+        # С сетевой папки бэкап один раз копируется на локальный диск сервера (если задан staging_path)
+        with ExitStack() as stack:
+            with phases.phase('staging', backup_bytes) as step:
+                restore_path, staging_error = stack.enter_context(staged_backup(backup_path, job_id))
+                # Ошибка копирования не прерывает задачу (RESTORE идёт из исходных файлов),
+                # но в отчёте шагов это сбой staging, а не пропуск
+                if staging_error:
+                    step.update(outcome='error', details=staging_error)
+                elif restore_path == backup_path:
+                    step['outcome'] = 'skipped'
+            set_job_progress(job_id, 0, 'RESTORE')
+            with phases.phase('restore', backup_bytes):
+                restore_db_from_backup(sql, target_db, restore_path)
+        # Конфигурация базы заменена содержимым бэкапа: узнаём её версию хранилища по отпечатку
+        def config_fingerprint():
+            return sql.config_fingerprint(target_db, bool(db_config.get('extension_name')))
+        record_restored_target(target_db, db_config, config_fingerprint)
+        set_job_progress(job_id, 100, 'Настройка 1С')
 
         # --- НОВОЕ: Работа с 1С (с пользовательскими логинами) ---
         extension_name = db_config.get('extension_name', '')
@@ -235,16 +315,14 @@ def perform_restore_job(job):
         app_password = db_config.get('app_password')
 
         if extension_name:
-            log_1c_operation(job_id, target_db, 'disconnect_from_storage', 'started', log_text=f"Отключение от хранилища {extension_name}")
-            run_1c_command_via_1cv8(target_db, f"DisconnectFromStorage;{extension_name}", app_login, app_password)
-            log_1c_operation(job_id, target_db, 'disconnect_from_storage', 'success', log_text=f"Отключено от хранилища {extension_name}")
+            with phases.phase('DisconnectFromStorage'):
+                run_1c_command_via_1cv8(target_db, f"DisconnectFromStorage;{extension_name}", app_login, app_password, job_id=job_id)
 
         header = db_config.get('header', 'Без заголовка')
         today_str = datetime.date.today().strftime("%d.%m.%Y")
         final_header = f"{header} {today_str}"
-        log_1c_operation(job_id, target_db, 'set_title', 'started', log_text=f"Установка заголовка: {final_header}")
-        run_1c_command_via_1cv8(target_db, f"SetTitle;{final_header}", app_login, app_password)
-        log_1c_operation(job_id, target_db, 'set_title', 'success', log_text=f"Заголовок установлен: {final_header}")
+        with phases.phase('SetTitle'):
+            run_1c_command_via_1cv8(target_db, f"SetTitle;{final_header}", app_login, app_password, job_id=job_id)
 
         if db_config.get('use_storage'):
             # Используем пользовательские логины от хранилища
@@ -252,46 +330,42 @@ def perform_restore_job(job):
             storage_password = db_config.get('storage_password')
             storage_path = db_config.get('storage_path')
             if storage_user and storage_password and storage_path:
-                log_1c_operation(job_id, target_db, 'connect_to_storage', 'started', log_text=f"Подключение к хранилищу {storage_path}")
-                run_1c_command_via_1cv8(target_db, f"ConnectToStorage;{storage_path};{storage_user};{storage_password};{extension_name}", app_login, app_password)
-                log_1c_operation(job_id, target_db, 'connect_to_storage', 'success', log_text=f"Подключено к хранилищу {storage_path}")
-
-                log_1c_operation(job_id, target_db, 'update_from_storage', 'started', log_text=f"Обновление из хранилища {extension_name}")
-                run_1c_command_via_1cv8(target_db, f"UpdateFromStorage;{extension_name}", app_login, app_password)
-                log_1c_operation(job_id, target_db, 'update_from_storage', 'success', log_text=f"Обновление из хранилища завершено")
-
-                log_1c_operation(job_id, target_db, 'update_cfg', 'started', log_text=f"Обновление конфигурации БД {extension_name}")
-                run_1c_command_via_1cv8(target_db, f"UpdateDBCfg;{extension_name}", app_login, app_password)
-                log_1c_operation(job_id, target_db, 'update_cfg', 'success', log_text=f"Конфигурация БД обновлена")
-
-        set_parallelism(target_db, 0, sql_login, sql_password)
-        log_1c_operation(job_id, target_db, 'set_parallelism', 'success', log_text="Параллелизм установлен в 0")
-        set_parallelism(target_db, 1, sql_login, sql_password)
-        log_1c_operation(job_id, target_db, 'set_parallelism', 'success', log_text="Параллелизм установлен в 1")
+                # Конфигурация берётся из общего кэша выгрузок хранилища, а не скачивается заново
+                set_job_progress(job_id, stage='Обновление из хранилища')
+                with phases.phase('UpdateFromStorage') as step:
+                    storage_update = update_from_storage(target_db, db_config, job_id=job_id,
+                                                         fingerprint=config_fingerprint)
+                    if storage_update['skipped']:
+                        step.update(outcome='skipped', details=f"версия {storage_update['version']}")
+                if storage_update['skipped']:
+                    print(f"ℹ️ {target_db} уже на версии хранилища {storage_update['version']}, UpdateDBCfg пропущен")
+                with phases.phase('ConnectToStorage'):
+                    run_1c_command_via_1cv8(target_db, f"ConnectToStorage;{storage_path};{storage_user};{storage_password};{extension_name}", app_login, app_password, job_id=job_id)
+
+        with phases.phase('tuning'):
+            sql.apply_tuning(target_db, get_tuning_profile(db_config.get('tuning_profile')))
+        log_1c_operation(job_id, target_db, 'sql_steps', 'success', log_text=sql.timings_text())
 
         # --- НОВОЕ: Разблокировка сеансов после восстановления ---
         try:
-            log_1c_operation(job_id, target_db, 'session_unblock', 'started', log_text="Разблокировка сеансов через rac")
-            run_1c_command_via_rac(target_db, "infobase update --sessions-deny=off")
-            log_1c_operation(job_id, target_db, 'session_unblock', 'success', log_text="Сеансы разблокированы")
+            with phases.phase('sessions_allow'):
+                run_1c_command_via_rac(target_db, "infobase update --sessions-deny=off", job_id=job_id)
             print(f"✅ Сеансы разблокированы для {target_db}")
         except Exception as e:
-            log_1c_operation(job_id, target_db, 'session_unblock', 'error', error_message=str(e))
             print(f"⚠️ Не удалось разблокировать сеансы для {target_db}: {e}")
 
         update_job_status(job_id, 'completed')
-
+        
         # --- НОВОЕ: Отправка уведомления пользователю ---
         notify_user = db_config.get('notify_user', False)
         if notify_user:
-            user_email = get_user_email(user)
+            user_email = get_user_email(user)  # новая функция
             if user_email:
                 notify_user_on_restore_complete(user_email, target_db, 'успешно завершено')
 
     except Exception as e:
         error_msg = str(e)
         update_job_status(job_id, 'failed', error_msg)
-        log_1c_operation(job_id, target_db, 'restore_process', 'error', error_message=error_msg)
 
         # --- НОВОЕ: Отправка уведомления пользователю об ошибке ---
         notify_user = db_config.get('notify_user', False)
@@ -301,10 +375,48 @@ def perform_restore_job(job):
                 notify_user_on_restore_complete(user_email, target_db, 'ошибка', error_msg)
 
     finally:
+        sql.close()
+        phases.flush()
+        observe_job(job, phases.source_db, time.monotonic() - job_started)
         running_tasks.discard(job_id)
-        
-def perform_restore_job(job):
-    # job = {'id': ..., 'windows_user': ..., 'target_db': ...}
+
+def get_user_email(windows_login):
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("SELECT email FROM Users WHERE windows_login = ?", windows_login)
+    row = cursor.fetchone()
+    conn.close()
+    return row[0] if row else None
+
+def get_user_backup_file(user_backup_id, windows_login):
+    """Путь к файлу личного бэкапа пользователя или None, если бэкапа нет или файл удалён."""
+    if not user_backup_id:
+        return None
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT ub.backup_file_path
+        FROM UserBackups ub
+        JOIN Users u ON ub.user_id = u.id
+        WHERE ub.id = ? AND u.windows_login = ?
+    """, user_backup_id, windows_login)
+    row = cursor.fetchone()
+    conn.close()
+    if not row or not os.path.exists(row[0]):
+        return None
+    return row[0]
+
+def get_user_backup_path(windows_login, target_db):
+    """Файл личного бэкапа: <backup_base_path>/<пользователь>/<база>_<ддммгггг_ччммсс>.bak."""
+    backup_base_path_setting = get_global_setting('backup_base_path') or r'D:\SQLBackups'
+    backup_base_path = os.path.join(backup_base_path_setting, windows_login) # <-- Папка по пользователю
+    Path(backup_base_path).mkdir(parents=True, exist_ok=True)
+    # Время в имени: второй бэкап за день не перезаписывает первый, на который ссылается UserBackups
+    stamp = datetime.datetime.now().strftime("%d%m%Y_%H%M%S")
+    return os.path.join(backup_base_path, f"{target_db}_{stamp}.bak")
+
+def perform_user_backup_job(job):
+    """Личный бэкап базы пользователя (job_type = 'user_backup'): BACKUP, UserBackups, каталог, уведомление."""
     job_id = job['id']
     user = job['windows_user']
     target_db = job['target_db']
@@ -314,154 +426,89 @@ def perform_restore_job(job):
         running_tasks.discard(job_id)
         return
 
-    source_db = db_config['source_db']
-    backup_path = get_backup_path_for_db(source_db)
-    if not backup_path:
-        if not allow_dynamic_backup:
-            update_job_status(job_id, 'failed', 'Бэкап отсутствует и создание запрещено')
-            running_tasks.discard(job_id)
-            return
-        print(f"⚠️ Нет бэкапа для {source_db}, создаю...")
-        from scripts.backup_task import create_backup_from_source
-        backup_path = create_backup_from_source(source_db)
-
-    # SQL-логины для восстановления БД (не зависят от пользователя)
-    sql_login = db_config['sql_login']
-    sql_password = db_config['sql_password']
+    backup_file_path = None
+    phases = JobPhases(job_id, 'user_backup', target_db, target_db)
+    job_started = time.monotonic()
+    sql = SqlSession(db_config['sql_login'], db_config['sql_password'], job_id=job_id)
+    sql.progress_callback = lambda percent: set_job_progress(job_id, percent)
     try:
-        # --- НОВОЕ: Блокировка сеансов через rac перед восстановлением ---
-        try:
-            run_1c_command_via_rac(target_db, "infobase update --sessions-deny=on")
-            print(f"✅ Сеансы заблокированы для {target_db}")
-        except Exception as e:
-            print(f"⚠️ Не удалось заблокировать сеансы для {target_db}: {e}")
-
-        restore_db_from_backup(target_db, backup_path, sql_login, sql_password)
-
-        # --- НОВОЕ: Работа с 1С (с пользовательскими логинами) ---
-        extension_name = db_config.get('extension_name', '')
-        
-        app_login = db_config.get('app_login')
-        app_password = db_config.get('app_password')
-
-        if extension_name:
-            run_1c_command_via_1cv8(target_db, f"DisconnectFromStorage;{extension_name}", app_login, app_password)
-
-        header = db_config.get('header', 'Без заголовка')
-        today_str = datetime.date.today().strftime("%d.%m.%Y")
-        final_header = f"{header} {today_str}"
-        run_1c_command_via_1cv8(target_db, f"SetTitle;{final_header}", app_login, app_password)
-
-        if db_config.get('use_storage'):
-            # Используем пользовательские логины от хранилища
-            storage_user = db_config.get('storage_user')
-            storage_password = db_config.get('storage_password')
-            storage_path = db_config.get('storage_path')
-            if storage_user and storage_password and storage_path:
-                run_1c_command_via_1cv8(target_db, f"ConnectToStorage;{storage_path};{storage_user};{storage_password};{extension_name}", app_login, app_password)
-                run_1c_command_via_1cv8(target_db, f"UpdateFromStorage;{extension_name}", app_login, app_password)
-                run_1c_command_via_1cv8(target_db, f"UpdateDBCfg;{extension_name}", app_login, app_password)
+        backup_file_path = get_user_backup_path(user, target_db)
+        set_job_progress(job_id, 0, 'BACKUP')
+        started = datetime.datetime.now()
+        with phases.phase('backup') as step:
+            sql.backup_database(target_db, [backup_file_path])
+            step['bytes'] = files_size(backup_file_path)
+        finished = datetime.datetime.now()
 
-        set_parallelism(target_db, 0, sql_login, sql_password)
-        set_parallelism(target_db, 1, sql_login, sql_password)
+        conn = get_svc_conn()
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO UserBackups (user_id, target_db_name, backup_file_path, description)
+            OUTPUT INSERTED.id
+            VALUES ((SELECT id FROM Users WHERE windows_login = ?), ?, ?, ?)
+        """, user, target_db, backup_file_path, f"Ручной бэкап {started:%d.%m.%Y %H:%M}")
+        user_backup_id = cursor.fetchone()[0]
+        cursor.execute("UPDATE RestoreQueue SET user_backup_id = ? WHERE id = ?", user_backup_id, job_id)
+        conn.commit()
+        conn.close()
 
-        # --- НОВОЕ: Разблокировка сеансов после восстановления ---
         try:
-            run_1c_command_via_rac(target_db, "infobase update --sessions-deny=off")
-            print(f"✅ Сеансы разблокированы для {target_db}")
+            with phases.phase('catalog'):
+                record_backup([backup_file_path], started, finished)
         except Exception as e:
-            print(f"⚠️ Не удалось разблокировать сеансы для {target_db}: {e}")
+            print(f"⚠️ {target_db} — личный бэкап не внесён в каталог: {e}")
 
+        log_1c_operation(job_id, target_db, 'sql_steps', 'success', log_text=sql.timings_text())
+        log_task_message(job_id, f"Бэкап создан: {backup_file_path}")
+        set_job_progress(job_id, 100, 'Готово')
         update_job_status(job_id, 'completed')
-        
-        # --- НОВОЕ: Отправка уведомления пользователю ---
-        notify_user = db_config.get('notify_user', False)
-        if notify_user:
-            user_email = get_user_email(user)  # новая функция
-            if user_email:
-                notify_user_on_restore_complete(user_email, target_db, 'успешно завершено')
+
+        if db_config.get('notify_user', False):
+            notify_user_on_backup_complete(get_user_email(user), target_db, 'успешно завершено', backup_file_path)
 
     except Exception as e:
         error_msg = str(e)
         update_job_status(job_id, 'failed', error_msg)
-
-        # --- НОВОЕ: Отправка уведомления пользователю об ошибке ---
-        notify_user = db_config.get('notify_user', False)
-        if notify_user:
-            user_email = get_user_email(user)
-            if user_email:
-                notify_user_on_restore_complete(user_email, target_db, 'ошибка', error_msg)
+        if db_config.get('notify_user', False):
+            notify_user_on_backup_complete(get_user_email(user), target_db, 'ошибка', error_msg=error_msg)
 
     finally:
+        sql.close()
+        phases.flush()
+        observe_job(job, phases.source_db, time.monotonic() - job_started)
         running_tasks.discard(job_id)
 
-def get_user_email(windows_login):
-    conn = get_svc_conn()
-    cursor = conn.cursor()
-    cursor.execute("SELECT email FROM Users WHERE windows_login = ?", windows_login)
-    row = cursor.fetchone()
-    conn.close()
-    return row[0] if row else None
-
 #def legacy_restore_worker():
 #    """Фоновый поток, который обрабатывает очередь задач RestoreQueue."""
 #    load_pending_jobs_from_db()  # <-- Загружаем pending задачи при старте
 #    worker_loop()  # <-- Запускаем основной цикл
     
-def get_backup_path_for_db(source_db_name):
-    today = datetime.date.today()
-    today_str = today.strftime("%d%m%Y")
-    conn = get_svc_conn()
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT backup_file_path FROM Backups WHERE source_db_name = ? AND backup_date = ?",
-        source_db_name, today
-    )
-    row = cursor.fetchone()
-    conn.close()
-    return row[0] if row else None
-
-def restore_db_from_backup(target_db_name, backup_file_path, sql_login, sql_password):
-   # Подключаемся к master через основной SQL Server
-    conn_str = get_sql_server_conn_config() # <-- Используем функцию из db_utils
-    # Перезаписываем логин/пароль из параметров функции (это могут быть логины из БД)
-    conn_str = f"DRIVER={{ODBC Driver 17 for SQL Server}};SERVER={get_global_setting('sql_server_address') or 'localhost'};UID={sql_login};PWD={sql_password};"
-    conn = pyodbc.connect(conn_str)
-    
-    conn.autocommit = True
-    cursor = conn.cursor()
-    quoted_name = get_quoted_name(target_db_name)
-    cursor.execute(f"ALTER DATABASE [{quoted_name} ] SET SINGLE_USER WITH ROLLBACK IMMEDIATE")
-    cursor.execute(f"""
-        RESTORE DATABASE [{quoted_name}]
-        FROM DISK = ?
-        WITH REPLACE, RECOVERY, STATS = 5
-    """, backup_file_path)
-    cursor.execute(f"ALTER DATABASE [{quoted_name}] SET MULTI_USER")
-    cursor.execute(f"ALTER AUTHORIZATION ON DATABASE::[{quoted_name}] TO [sa]")
-    cursor.execute(f"ALTER DATABASE [{quoted_name}] SET RECOVERY SIMPLE")
-    cursor.execute(f"USE [{quoted_name}]; DBCC SHRINKFILE (2, TRUNCATEONLY);")
-
-    conn.close()
-
-def set_parallelism(target_db_name, degree, sql_login, sql_password):
-    quoted_name = get_quoted_name(target_db_name)
-     # Подключаемся к master через основной SQL Server
-    conn_str = get_sql_server_conn_config() # <-- Используем функцию из db_utils
-    # Перезаписываем логин/пароль из параметров функции (это могут быть логины из БД)
-    conn_str = f"DRIVER={{ODBC Driver 17 for SQL Server}};SERVER={get_global_setting('sql_server_address') or 'localhost'};UID={sql_login};PWD={sql_password};"
-    
-    conn = pyodbc.connect(conn_str)
-    conn.autocommit = True
-    cursor = conn.cursor()
-    cursor.execute(f"""
-        USE [{quoted_name}];
-        EXEC sp_configure 'show advanced options', 1;
-        RECONFIGURE WITH OVERRIDE;
-        EXEC sp_configure 'max degree of parallelism', {degree};
-        RECONFIGURE WITH OVERRIDE;
-    """)
-    conn.close()
+def get_backup_path_for_db(source_db_name, backup_date=None):
+    """
+    Возвращает цепочку наборов бэкапа источника ([[полный], [разностный]] или [[полный]]) или None:
+    самый свежий в окне свежести либо за выбранную дату (см. backup_resolver).
+    """
+    return resolve_backup(source_db_name, backup_date)
+
+def restore_db_from_backup(sql, target_db_name, backup_file_path):
+    """
+    Восстанавливает БД из .bak в рамках сессии задачи (SqlSession).
+    backup_file_path — путь к файлу, список файлов полосатого набора или цепочка наборов
+    (полный, затем разностный): все наборы, кроме последнего, восстанавливаются с NORECOVERY.
+    """
+    if isinstance(backup_file_path, str):
+        chain = [[backup_file_path]]
+    elif backup_file_path and isinstance(backup_file_path[0], str):
+        chain = [backup_file_path]
+    else:
+        chain = backup_file_path
+    sql.set_single_user(target_db_name)
+    for position, backup_files in enumerate(chain):
+        sql.restore_database(target_db_name, backup_files, recovery=position == len(chain) - 1)
+    sql.set_multi_user(target_db_name)
+    sql.set_owner(target_db_name)
+    sql.set_recovery_simple(target_db_name)
+    sql.shrink_log(target_db_name)
 
 
 @bp.route('/')
@@ -534,6 +581,13 @@ def index():
     queue_data = cursor.fetchall()
     conn.close()
 
+    # Прогноз окончания задач и разбора всей очереди
+    try:
+        queue_eta = get_queue_eta()
+    except Exception as e:
+        current_app.logger.error(f"Ошибка расчёта ETA очереди: {e}")
+        queue_eta = None
+
     # Получаем статусы последних задач для отображения на главной
     status_data = {}
     for db in all_dbs:
@@ -621,7 +675,9 @@ def index():
         active_queue_count=active_queue_count,
         total_active_count=total_active_count,
         script_name=request.environ.get('SCRIPT_NAME', ''),
-        last_logs=last_logs  # <-- Передаём последние логи
+        last_logs=last_logs,  # <-- Передаём последние логи
+        queue_eta=queue_eta["jobs"] if queue_eta else {},
+        queue_drain_at=queue_eta["drain_at"] if queue_eta else None
     )    
     
 @bp.route('/profile', methods=['GET', 'POST'])
@@ -646,6 +702,13 @@ def profile():
 def restore():
     user = get_current_user()
     target_db = request.form.get('database')
+    # Необязательная дата бэкапа (ГГГГ-ММ-ДД); без неё берётся самый свежий в окне свежести
+    backup_date = request.form.get('backup_date') or None
+    if backup_date:
+        try:
+            backup_date = datetime.datetime.strptime(backup_date, '%Y-%m-%d').date()
+        except ValueError:
+            return jsonify({"error": "Неверная дата бэкапа"}), 400
 
     db_config = get_db_config(target_db, user)
     if not db_config:
@@ -655,22 +718,30 @@ def restore():
 
     log_user_action(user, 'restore_requested', target_db, 'Задача добавлена в очередь')
     # Добавляем задачу в очередь
-    conn = get_svc_conn()
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO RestoreQueue (windows_user, target_db, status, priority)
-        OUTPUT INSERTED.ID
-        VALUES (?, ?, 'pending', 10)
-    """, user, target_db)
-    job_id = cursor.fetchone()[0]
-    conn.commit()
-    conn.close()
+    job_id = enqueue_job(user, target_db, 'restore', backup_date=backup_date)
+    try:
+        record_prestage_hit(target_db, job_id)
+    except Exception as e:
+        current_app.logger.error(f"Не удалось отметить попадание прогноза для {target_db}: {e}")
 
     # Добавляем в очередь в памяти
     restore_queue.append({'id': job_id, 'windows_user': user, 'target_db': target_db})
 
     return jsonify({"status": "ok", "message": f"Задача восстановления для {target_db} добавлена в очередь", "job_id": job_id})
 
+@bp.route('/backups/available/<target_db>')
+def available_backups(target_db):
+    """Даты бэкапов источника базы, из которых можно восстановить (для выбора в форме)."""
+    user = get_current_user()
+    db_config = get_db_config(target_db, user)
+    if not db_config:
+        return jsonify({"error": "Нет доступа к БД"}), 403
+    backups = list_backups(db_config['source_db'])
+    return jsonify({"backups": [{
+        "backup_date": b["backup_date"].isoformat(),
+        "created_at": b["created_at"].isoformat() if b["created_at"] else None
+    } for b in backups]})
+
 @bp.route('/queue/status')
 def queue_status():
     user = get_current_user()
@@ -680,22 +751,32 @@ def queue_status():
     cursor = conn.cursor()
     if is_admin:
         cursor.execute("""
-            SELECT rq.id, rq.windows_user, rq.target_db, rq.status, rq.priority,rq.created_at, rq.started_at, rq.finished_at, rq.error_message
+            SELECT rq.id, rq.windows_user, rq.target_db, rq.status, rq.priority,rq.created_at, rq.started_at, rq.finished_at, rq.error_message,
+                   rq.job_type, rq.progress, rq.progress_stage
             FROM RestoreQueue rq
             ORDER BY rq.priority, rq.created_at
         """)
     else:
         cursor.execute("""
-            SELECT rq.id, rq.windows_user, rq.target_db, rq.status, rq.priority, rq.created_at, rq.started_at, rq.finished_at, rq.error_message
+            SELECT rq.id, rq.windows_user, rq.target_db, rq.status, rq.priority, rq.created_at, rq.started_at, rq.finished_at, rq.error_message,
+                   rq.job_type, rq.progress, rq.progress_stage
             FROM RestoreQueue rq
             WHERE rq.windows_user = ?
             ORDER BY rq.priority, rq.created_at
         """, user)
     rows = cursor.fetchall()
 
+    # Прогноз считается по всей очереди: место задачи пользователя зависит и от чужих задач
+    try:
+        eta = get_queue_eta()
+    except Exception as e:
+        current_app.logger.error(f"Ошибка расчёта ETA очереди: {e}")
+        eta = None
+
     # Преобразуем pyodbc.Row в словари
     queue_data = []
     for row in rows:
+        job_eta = eta["jobs"].get(row.id) if eta else None
         queue_data.append({
             "id": row.id,
             "windows_user": row.windows_user,
@@ -705,11 +786,21 @@ def queue_status():
             "created_at": row.created_at.isoformat() if row.created_at else None,
             "started_at": row.started_at.isoformat() if row.started_at else None,
             "finished_at": row.finished_at.isoformat() if row.finished_at else None,
-            "error_message": row.error_message
+            "error_message": row.error_message,
+            "job_type": row.job_type,
+            "progress": row.progress,
+            "progress_stage": row.progress_stage,
+            "estimated_seconds": job_eta["estimated_seconds"] if job_eta else None,
+            "remaining_seconds": job_eta["remaining_seconds"] if job_eta else None,
+            "eta_finish": job_eta["eta_finish"].isoformat() if job_eta else None
         })
     conn.close()
 
-    return jsonify({"queue": queue_data})
+    return jsonify({
+        "queue": queue_data,
+        "drain_seconds": eta["drain_seconds"] if eta else None,
+        "drain_at": eta["drain_at"].isoformat() if eta else None
+    })
 
 @bp.route('/settings/<target_db>', methods=['GET', 'POST'])
 def user_db_settings(target_db):
@@ -766,58 +857,27 @@ def user_db_settings(target_db):
 def user_logs(target_db):
     user = get_current_user()
     is_admin = is_user_admin(user)
-    conn = get_svc_conn()
-    cursor = conn.cursor()
-    
-    if is_admin:
-        # Админ видит все логи по БД
-        cursor.execute("""
-            SELECT windows_user, target_db, status, started_at, finished_at, error_message
-            FROM RestoreJobs
-            WHERE target_db = ?
-            ORDER BY started_at DESC
-        """, target_db)
-    else:
-        # Пользователь видит только свои логи по БД
-        cursor.execute("""
-            SELECT windows_user, target_db, status, started_at, finished_at, error_message
-            FROM RestoreJobs
-            WHERE target_db = ? AND windows_user = ?
-            ORDER BY started_at DESC
-        """, target_db, user)
-    
-    logs = cursor.fetchall()
-    conn.close()
-    return render_template('user_logs.html', logs=logs, target_db=target_db, is_admin=is_admin)
+    # Админ видит все логи по БД, пользователь — только свои
+    flt = LogFilter(types=('job',), target_db=target_db, windows_user=None if is_admin else user)
+    try:
+        page = query_logs(flt, request.args.get('before'))
+    except ValueError as e:
+        return str(e), 400
+    return render_template('user_logs.html', logs=page["rows"], next_cursor=page["next_cursor"],
+                           target_db=target_db, is_admin=is_admin)
 
 @bp.route('/logs/1c/<target_db>')
 def user_1c_logs(target_db):
     user = get_current_user()
     is_admin = is_user_admin(user)
-    conn = get_svc_conn()
-    cursor = conn.cursor()
-    
-    if is_admin:
-        # Админ видит все логи по БД
-        cursor.execute("""
-            SELECT job_id, operation, status, log_text, error_message, timestamp
-            FROM OneCOperationLog
-            WHERE target_db = ?
-            ORDER BY timestamp DESC
-        """, target_db)
-    else:
-        # Пользователь видит только свои логи по БД (проверка через UserDatabases)
-        cursor.execute("""
-            SELECT ocl.job_id, ocl.operation, ocl.status, ocl.log_text, ocl.error_message, ocl.timestamp
-            FROM OneCOperationLog ocl
-            JOIN RestoreQueue rq ON ocl.job_id = rq.id
-            WHERE ocl.target_db = ? AND rq.windows_user = ?
-            ORDER BY ocl.timestamp DESC
-        """, target_db, user)
-    
-    logs = cursor.fetchall()
-    conn.close()
-    return render_template('user_1c_logs.html', logs=logs, target_db=target_db, is_admin=is_admin)
+    # Пользователь видит только операции своих задач (владелец задачи — RestoreQueue.windows_user)
+    flt = LogFilter(types=('1c',), target_db=target_db, windows_user=None if is_admin else user)
+    try:
+        page = query_logs(flt, request.args.get('before'))
+    except ValueError as e:
+        return str(e), 400
+    return render_template('user_1c_logs.html', logs=page["rows"], next_cursor=page["next_cursor"],
+                           target_db=target_db, is_admin=is_admin)
 
 @bp.route('/backups')
 def user_backups():
@@ -833,6 +893,15 @@ def user_backups():
     """, user)
     backups = cursor.fetchall()
 
+    # Личные бэкапы и восстановления, которые ещё в очереди или выполняются
+    cursor.execute("""
+        SELECT id, job_type, target_db, status, progress, progress_stage, created_at
+        FROM RestoreQueue
+        WHERE windows_user = ? AND job_type IN ('user_backup', 'user_restore') AND status IN ('pending', 'running')
+        ORDER BY created_at
+    """, user)
+    active_jobs = cursor.fetchall()
+
     # Получим список БД, доступных пользователю, для возможности создания бэкапа
     user_dbs = get_user_databases(user)
     common_dbs = get_common_databases()
@@ -840,10 +909,11 @@ def user_backups():
     db_names = [db['target'] for db in all_dbs]
 
     conn.close()
-    return render_template('user_backups.html', backups=backups, databases=db_names, user=user)
+    return render_template('user_backups.html', backups=backups, databases=db_names, user=user, active_jobs=active_jobs)
 
 @bp.route('/backups/create', methods=['POST'])
 def create_user_backup():
+    """Ставит личный бэкап базы в очередь; BACKUP выполняет воркер (perform_user_backup_job)."""
     user = get_current_user()
     target_db = request.form.get('database')
 
@@ -853,54 +923,18 @@ def create_user_backup():
         db_config = get_db_config(target_db, user)
         if not db_config:
             return jsonify({"error": "Нет доступа к БД"}), 403
-
-    # Получим глобальные настройки
-    backup_base_path_setting = get_global_setting('backup_base_path') or r'D:\SQLBackups'
-    backup_base_path = os.path.join(backup_base_path_setting, user) # <-- Папка по пользователю
-    Path(backup_base_path).mkdir(parents=True, exist_ok=True)
-
-    # Сформируем имя файла
-    import datetime
-    today_str = datetime.date.today().strftime("%d%m%Y")
-    backup_filename = f"{target_db}_{today_str}.bak" # <-- Обновлённый формат
-    backup_file_path = os.path.join(backup_base_path, backup_filename)
-
-    # Получим настройки подключения к БД для бэкапа (из БД, через db_config)
-    db_config = get_db_config(target_db, user)
-    sql_login = db_config.get('sql_login', 'sa') # или получить из GlobalSettings
-    sql_password = db_config.get('sql_password', '...')
-
     try:
-        quoted_name = get_quoted_name(target_db)
-        # Подключаемся к prod-серверу (или к серверу БД, если это не prod)
-        # Используем настройки из config/app_config.json для основного сервера
-        sql_server_address = get_global_setting('sql_server_address') or 'localhost'
-        prod_conn_str = f"DRIVER={{ODBC Driver 17 for SQL Server}};SERVER={sql_server_address};DATABASE={quoted_name};UID={sql_login};PWD={sql_password}"
-        prod_conn = pyodbc.connect(prod_conn_str)
-
-        # ... (остальной код бэкапа)
-        prod_conn.close()
-
-        # ... (запись в БД)
-        conn = get_svc_conn() # <-- Используем функцию из db_utils
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO UserBackups (user_id, target_db_name, backup_file_path, description)
-            VALUES ((SELECT id FROM Users WHERE windows_login = ?), ?, ?, ?)
-        """, user, target_db, backup_file_path, f"Ручной бэкап {today_str}")
-        conn.commit()
-        conn.close()
-
-        log_user_action(user, 'backup_created', target_db, f"Бэкап создан: {backup_file_path}")
-        return jsonify({"status": "ok", "message": f"Бэкап БД {target_db} создан: {backup_file_path}"})
+        validate_db_name(target_db)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-    except Exception as e:
-        error_msg = str(e)
-        log_user_action(user, 'backup_failed', target_db, f"Ошибка создания бэкапа: {error_msg}")
-        return jsonify({"error": f"Ошибка создания бэкапа: {error_msg}"}), 500
+    job_id = enqueue_job(user, target_db, 'user_backup')
+    log_user_action(user, 'backup_requested', target_db, f"Задача бэкапа {job_id} добавлена в очередь")
+    return jsonify({"status": "ok", "message": f"Бэкап БД {target_db} добавлен в очередь", "job_id": job_id})
 
 @bp.route('/backups/restore', methods=['POST'])
 def restore_from_user_backup():
+    """Ставит восстановление из личного бэкапа в очередь (job_type = 'user_restore')."""
     user = get_current_user()
     backup_id = request.form.get('backup_id')
     target_db = request.form.get('target_db') # БД, КУДА восстанавливаем
@@ -915,8 +949,8 @@ def restore_from_user_backup():
         WHERE ub.id = ? AND u.windows_login = ?
     """, backup_id, user)
     row = cursor.fetchone()
+    conn.close()
     if not row:
-        conn.close()
         return jsonify({"error": "Бэкап не найден или доступ запрещён"}), 403
 
     backup_file_path = row[0]
@@ -925,99 +959,17 @@ def restore_from_user_backup():
     if not is_admin:
         db_config = get_db_config(target_db, user)
         if not db_config:
-            conn.close()
             return jsonify({"error": "Нет доступа к целевой БД"}), 403
 
     # Проверим, существует ли файл
     if not os.path.exists(backup_file_path):
-        conn.close()
         return jsonify({"error": "Файл бэкапа не найден на диске"}), 500
 
-    conn.close()
-
-    # --- Логика восстановления из backup_file_path в target_db ---
-    # Эта логика аналогична perform_restore_job, но с конкретным .bak-файлом
-    # и без проверки/создания бэкапа
-    # Используем db_config для получения sql_login/password для target_db
-    db_config = get_db_config(target_db, user)
-    sql_login = db_config['sql_login']
-    sql_password = db_config['sql_password']
-
-    try:
-        # Подключаемся к master
-        sql_server_address = get_global_setting('sql_server_address') or 'localhost'
-        restore_conn = pyodbc.connect(
-            f"DRIVER={{ODBC Driver 17 for SQL Server}};"
-            f"SERVER={sql_server_address};"
-            f"DATABASE=master;"
-            f"UID={sql_login};PWD={sql_password}"
-        )
-        restore_conn.autocommit = True
-        restore_cursor = restore_conn.cursor()
-        quoted_name = get_quoted_name(target_db)
-        # Отключаем пользователей
-        restore_cursor.execute(f"ALTER DATABASE [{quoted_name}] SET SINGLE_USER WITH ROLLBACK IMMEDIATE")
-
-        # Восстанавливаем
-        # Для простоты, используем MOVE с именами файлов из БД-источника
-        # или из настроек БД. Для этого нужно знать логические имена файлов.
-        # В простом случае, можно не указывать MOVE, и файлы будут восстановлены в те же папки.
-        # Или использовать путь из GlobalSettings для DATA/LOG.
-        restore_cursor.execute(f"""
-            RESTORE DATABASE [{quoted_name}]
-            FROM DISK = ?
-            WITH REPLACE, RECOVERY, STATS = 5
-        """, backup_file_path)
-
-        # Вернём в строй
-        restore_cursor.execute(f"ALTER DATABASE [{quoted_name}] SET MULTI_USER")
-        
-        # Остальные настройки: владелец, режим восстановления, сжатие
-        restore_cursor.execute(f"ALTER AUTHORIZATION ON DATABASE::[{quoted_name}] TO [sa]")
-        restore_cursor.execute(f"ALTER DATABASE [{quoted_name}] SET RECOVERY SIMPLE")
-        restore_cursor.execute(f"""
-            USE [{quoted_name}];
-            DBCC SHRINKFILE (2, TRUNCATEONLY);
-        """)
+    job_id = enqueue_job(user, target_db, 'user_restore', user_backup_id=int(backup_id))
+    log_user_action(user, 'restore_from_backup_requested', target_db,
+                    f"Задача {job_id}: восстановление из {backup_file_path} добавлено в очередь")
+    return jsonify({"status": "ok", "message": f"Восстановление {target_db} из бэкапа добавлено в очередь", "job_id": job_id})
 
-        restore_conn.close()
-
-        # --- НОВОЕ: Работа с 1С (с пользовательскими логинами) ---
-        extension_name = db_config.get('extension_name', '')
-        app_login = db_config.get('app_login')
-        app_password = db_config.get('app_password')
-
-        if extension_name:
-            run_1c_command_via_1cv8(target_db, f"DisconnectFromStorage;{extension_name}", app_login, app_password)
-
-        header = db_config.get('header', 'Без заголовка')
-        import datetime
-        today_str = datetime.date.today().strftime("%d.%m.%Y")
-        final_header = f"{header} {today_str}"
-        run_1c_command_via_1cv8(target_db, f"SetTitle;{final_header}", app_login, app_password)
-
-        if db_config.get('use_storage'):
-            storage_user = db_config.get('storage_user')
-            storage_password = db_config.get('storage_password')
-            storage_path = db_config.get('storage_path')
-            if storage_user and storage_password and storage_path:
-                run_1c_command_via_1cv8(target_db, f"ConnectToStorage;{storage_path};{storage_user};{storage_password};{extension_name}", app_login, app_password)
-                run_1c_command_via_1cv8(target_db, f"UpdateFromStorage;{extension_name}", app_login, app_password)
-                run_1c_command_via_1cv8(target_db, f"UpdateDBCfg;{extension_name}", app_login, app_password)
-
-        # Настройка параллелизма
-        from .db_ops import set_parallelism
-        set_parallelism(target_db, 0, sql_login, sql_password)
-        set_parallelism(target_db, 1, sql_login, sql_password)
-
-        log_user_action(user, 'restore_from_backup', target_db, f"Восстановлено из {backup_file_path}")
-        return jsonify({"status": "ok", "message": f"Восстановление из бэкапа {backup_file_path} в {target_db} завершено"})
-
-    except Exception as e:
-        error_msg = str(e)
-        log_user_action(user, 'restore_from_backup_failed', target_db, f"Ошибка восстановления из {backup_file_path}: {error_msg}")
-        return jsonify({"error": f"Ошибка восстановления: {error_msg}"}), 500
-    
 @bp.route('/logs/stream/<int:job_id>')
 def stream_logs(job_id):
     """SSE endpoint для потоковой передачи логов задачи."""
@@ -1037,29 +989,36 @@ def stream_logs(job_id):
     if not row:
         return "Нет доступа к задаче", 403
 
+    # Переподключившийся EventSource присылает Last-Event-ID; last_event_id — то же для ручных клиентов
+    try:
+        last_event_id = int(request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or 0)
+    except ValueError:
+        last_event_id = 0
+
     def generate():
-        last_id = 0
-        while True:
-            conn = get_svc_conn()
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT id, message, timestamp
-                FROM RestoreTaskLogs
-                WHERE job_id = ? AND id > ?
-                ORDER BY id
-            """, job_id, last_id)
-            rows = cursor.fetchall()
-            conn.close()
-
-            if rows:
-                for row in rows:
-                    log_id, message, timestamp = row
-                    yield f" {json.dumps({'id': log_id, 'message': message, 'timestamp': timestamp.isoformat()})}\n\n"
-                    last_id = log_id
+        for kind, payload in subscribe(job_id, last_event_id):
+            if kind == 'log':
+                log_id, message, timestamp = payload
+                data = json.dumps({'id': log_id, 'message': message, 'timestamp': timestamp.isoformat()}, ensure_ascii=False)
+                yield f"id: {log_id}\ndata: {data}\n\n"
+            elif kind == 'end':
+                # Клиент должен закрыть EventSource по событию end, иначе браузер переподключится
+                yield f"event: end\ndata: {json.dumps({'status': payload})}\n\n"
             else:
-                # Отправляем heartbeat, чтобы соединение не закрывалось
-                yield " {}\n\n"
-
-            time.sleep(1)  # Пауза 1 секунда
-
-    return Response(stream_with_context(generate()), mimetype="text/event-stream")
\ No newline at end of file
+                # Комментарий SSE: держит соединение открытым через прокси
+                yield ": keepalive\n\n"
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@bp.route('/metrics')
+def metrics():
+    """Метрики очереди и пулов 1С в текстовом формате Prometheus (app/services/metrics.py)."""
+    # Без пользователя Windows: доступ для сборщика — по токену из GlobalSettings.metrics_token
+    token = get_global_setting('metrics_token')
+    if token:
+        auth_header = request.headers.get('Authorization', '')
+        supplied = auth_header[7:] if auth_header.startswith('Bearer ') else request.args.get('token', '')
+        if not hmac.compare_digest(supplied.encode(), token.encode()):
+            return "Неверный токен", 403
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
@@ -48,6 +48,24 @@ def notify_user_on_restore_complete(user_email, target_db, status, error_msg=Non
     body += "\nС уважением,\nСистема восстановления БД"
     send_email(user_email, subject, body)
 
+def notify_user_on_backup_complete(user_email, target_db, status, backup_file_path=None, error_msg=None):
+    if not user_email:
+        return
+    subject = f"Бэкап базы {target_db} завершён"
+    body = f"""
+    Здравствуйте,
+
+    Создание бэкапа базы данных '{target_db}' завершено.
+
+    Статус: {status}
+    """
+    if backup_file_path:
+        body += f"Файл: {backup_file_path}\n"
+    if error_msg:
+        body += f"Ошибка: {error_msg}\n"
+    body += "\nС уважением,\nСистема восстановления БД"
+    send_email(user_email, subject, body)
+
 def notify_admin_on_backup_failure(error_msg):
     admin_email = get_global_setting('admin_email')  # можно добавить в GlobalSettings
     if not admin_email:
@@ -0,0 +1,45 @@
+"""
+Сжатое хранение длинных текстов журнала OneCOperationLog (вывод 1cv8/rac, шаги SQL).
+
+Текст длиннее log_compress_threshold символов пишется не в log_text/error_message,
+а в log_text_gz/error_message_gz (VARBINARY(MAX)) в формате GZIP от UTF-16LE —
+том же, что у COMPRESS() в SQL Server, поэтому в запросе его можно прочитать и так:
+CAST(DECOMPRESS(log_text_gz) AS NVARCHAR(MAX)). Короткие тексты хранятся как есть:
+на них сжатие почти ничего не даёт.
+"""
+
+import gzip
+import time
+
+from app.config_loader import get_global_setting
+
+DEFAULT_THRESHOLD = 4000  # символов; 0 — не сжимать
+SETTING_TTL = 60  # seconds
+
+_threshold = {"value": None, "loaded": 0.0}
+
+
+def _get_threshold():
+    # Порог читается не при каждой записи в журнал, а раз в SETTING_TTL секунд
+    if _threshold["value"] is None or time.monotonic() - _threshold["loaded"] > SETTING_TTL:
+        try:
+            _threshold["value"] = int(get_global_setting('log_compress_threshold') or DEFAULT_THRESHOLD)
+        except Exception:
+            _threshold["value"] = DEFAULT_THRESHOLD
+        _threshold["loaded"] = time.monotonic()
+    return _threshold["value"]
+
+
+def pack_text(text):
+    """Возвращает (текст, None) или (None, сжатый текст) — значения для пары столбцов text/text_gz."""
+    threshold = _get_threshold()
+    if text is None or threshold <= 0 or len(text) <= threshold:
+        return text, None
+    return None, gzip.compress(text.encode('utf-16-le'))
+
+
+def unpack_text(text, packed):
+    """Текст из пары столбцов text/text_gz."""
+    if packed is None:
+        return text
+    return gzip.decompress(bytes(packed)).decode('utf-16-le')
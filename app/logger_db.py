@@ -2,6 +2,7 @@ import pyodbc
 from flask import request
 import json
 import os
+from app.log_text import pack_text
 
 def get_svc_conn_config():
     """Читает настройки подключения к svc_sqlrestore из config/app_config.json"""
@@ -45,11 +46,62 @@ def log_user_action(user, action_type, target_db=None, details=None):
     conn.close()
 
 def log_1c_operation(job_id, target_db, operation, status, log_text=None, error_message=None):
+    # Длинный вывод 1С хранится сжатым (app/log_text.py), в поисковый индекс идёт исходный текст
+    stored_text, log_text_gz = pack_text(log_text)
+    stored_error, error_message_gz = pack_text(error_message)
     conn = get_svc_conn()
     cursor = conn.cursor()
     cursor.execute("""
-        INSERT INTO OneCOperationLog (job_id, target_db, operation, status, log_text, error_message)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, job_id, target_db, operation, status, log_text, error_message)
+        INSERT INTO OneCOperationLog (job_id, target_db, operation, status, log_text, error_message,
+                                      log_text_gz, error_message_gz)
+        OUTPUT INSERTED.id, INSERTED.timestamp
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, job_id, target_db, operation, status, stored_text, stored_error, log_text_gz, error_message_gz)
+    log_id, timestamp = cursor.fetchone()
     conn.commit()
-    conn.close()
\ No newline at end of file
+    from app.services.log_search import index_document
+    try:
+        if index_document(cursor, '1c', log_id, job_id, target_db, timestamp, log_text, error_message):
+            conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f"⚠️ Запись 1С {log_id} не добавлена в поисковый индекс: {e}")
+    conn.close()
+
+def log_task_message(job_id, message):
+    """Пишет строку в лог выполнения задачи (RestoreTaskLogs) и сразу передаёт её подписчикам /logs/stream."""
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO RestoreTaskLogs (job_id, message)
+        OUTPUT INSERTED.id, INSERTED.timestamp
+        VALUES (?, ?)
+    """, job_id, message)
+    log_id, timestamp = cursor.fetchone()
+    conn.commit()
+    conn.close()
+    # Импорт здесь: app.services при загрузке тянет db_ops, а тот — этот модуль
+    from app.services.log_broker import publish
+    publish(job_id, log_id, message, timestamp)
+
+
+def log_task_messages(job_id, messages, batch_size=500):
+    """Пишет несколько строк лога задачи одним подключением (INSERT пачками) и передаёт их подписчикам."""
+    if not messages:
+        return
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    rows = []
+    for start in range(0, len(messages), batch_size):
+        batch = messages[start:start + batch_size]
+        cursor.execute(f"""
+            INSERT INTO RestoreTaskLogs (job_id, message)
+            OUTPUT INSERTED.id, INSERTED.message, INSERTED.timestamp
+            VALUES {', '.join('(?, ?)' for _ in batch)}
+        """, *[value for message in batch for value in (job_id, message)])
+        rows += cursor.fetchall()
+    conn.commit()
+    conn.close()
+    from app.services.log_broker import publish
+    for log_id, message, timestamp in sorted(rows, key=lambda row: row[0]):
+        publish(job_id, log_id, message, timestamp)
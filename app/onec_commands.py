@@ -1,27 +1,22 @@
-import subprocess
 import os
-from .config_loader import get_global_setting, get_svc_conn
+import tempfile
+from .config_loader import get_global_setting
+from .cluster_cache import get_cluster_info, get_rac_setting
+from .services.onec_executor import run_command
 
 def get_cluster_info_for_db(target_db_name):
     """
-    Получает cluster_guid и infobase_guid из таблицы ClusterInfo по имени БД.
+    Возвращает cluster_guid и infobase_guid базы по имени из кэша топологии кластера
+    (ClusterInfo, с запасным вариантом infobase_guid из UserDatabases/CommonDatabases).
     """
-    conn = get_svc_conn()
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT cluster_guid, infobase_guid FROM ClusterInfo WHERE name = ?
-    """, target_db_name)
-    row = cursor.fetchone()
-    conn.close()
-    if row:
-        return {"cluster_guid": row[0], "infobase_guid": row[1]}
-    return None
-
-def run_1c_command_via_1cv8(db_name, command, app_login=None, app_password=None):
+    return get_cluster_info(target_db_name)
+
+def run_1c_command_via_1cv8(db_name, command, app_login=None, app_password=None, job_id=None, timeout=None):
     """
     Выполняет команду 1С через 1cv8.exe.
     command: строка, например: "SetTitle;Новый заголовок"
     app_login/app_password: если None — берутся из GlobalSettings
+    job_id: если задан — вывод процесса пишется в лог задачи
     """
     path_to_1cv8 = get_global_setting('path_to_1cv8')
     if not path_to_1cv8 or not os.path.exists(path_to_1cv8):
@@ -29,7 +24,7 @@ def run_1c_command_via_1cv8(db_name, command, app_login=None, app_password=None)
 
     server = get_global_setting('app_server')
     port = get_global_setting('app_port')
-    
+
     if not app_login:
         app_login = get_global_setting('app_user')
     if not app_password:
@@ -43,45 +38,96 @@ def run_1c_command_via_1cv8(db_name, command, app_login=None, app_password=None)
         "/C", command
     ]
 
-    result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8')
-    if result.returncode != 0:
-        raise RuntimeError(f"Ошибка выполнения команды 1С: {result.stderr}")
-    return result.stdout
+    # В метку метрики попадает только имя команды, без параметров (там бывают пароли)
+    label = f"1cv8:{command.split(';', 1)[0]}"
+    result = run_command(cmd, kind='1cv8', server=server, timeout=timeout, label=label, job_id=job_id)
+    if result['returncode'] != 0:
+        raise RuntimeError(f"Ошибка выполнения команды 1С: {result['stderr']}")
+    return result['stdout']
 
-def run_1c_command_via_rac(db_name, command):
+def run_1c_command_via_rac(db_name, command, job_id=None, timeout=None):
     """
     Выполняет команду через rac, используя GUID из кластера.
     command: например "session list", "infobase update --sessions-deny=on"
     """
-    path_to_rac = get_global_setting('path_to_rac')
-    if not os.path.exists(path_to_rac):
+    path_to_rac = get_rac_setting('path_to_rac')
+    if not path_to_rac or not os.path.exists(path_to_rac):
         raise FileNotFoundError(f"rac.exe не найден по пути: {path_to_rac}")
 
     cluster_info = get_cluster_info_for_db(db_name)
     if not cluster_info:
-        # Пробуем получить GUID из UserDatabases или CommonDatabases
-        # Это позволит использовать GUID, даже если база не в кластере (редко)
-        from .config_loader import get_db_config
-        # Предположим, что вызов идёт с известным пользователем, например, в контексте задачи
-        # Для простоты, пока не реализуем это, но идея ясна
         raise ValueError(f"Не найдены GUID для базы: {db_name} (ни в ClusterInfo, ни в БД)")
 
     cluster_guid = cluster_info['cluster_guid']
     infobase_guid = cluster_info['infobase_guid']
 
-    user = get_global_setting('app_server_admin')  # из backup.json
-    password = get_global_setting('app_server_admin_pwd')
+    user = get_rac_setting('app_server_admin')  # из backup.json
+    password = get_rac_setting('app_server_admin_pwd')
 
+    # "infobase update --sessions-deny=on" -> режим, команда и её параметры отдельными аргументами
+    command_parts = command.split()
     cmd = [
         path_to_rac,
-        command,
+        *command_parts,
         f"--cluster={cluster_guid}",
         f"--infobase={infobase_guid}",
         f"--cluster-user={user}",
         f"--cluster-pwd={password}"
     ]
 
-    result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8')
-    if result.returncode != 0:
-        raise RuntimeError(f"Ошибка выполнения команды rac: {result.stderr}")
-    return result.stdout
\ No newline at end of file
+    label = f"rac:{' '.join(p for p in command_parts[:2] if not p.startswith('--'))}"
+    result = run_command(cmd, kind='rac', server=get_rac_setting('app_server'), timeout=timeout,
+                         label=label, job_id=job_id)
+    if result['returncode'] != 0:
+        raise RuntimeError(f"Ошибка выполнения команды rac: {result['stderr']}")
+    return result['stdout']
+
+def run_1c_designer(db_name, designer_args, app_login=None, app_password=None, job_id=None, timeout=None, label=None):
+    """
+    Запускает 1cv8.exe в режиме конфигуратора (пакетный режим).
+    designer_args: список параметров, например ["/LoadCfg", "C:\\cache\\erp.cf"]
+    Возвращает текст служебного вывода (/Out); при job_id он дублируется в лог задачи.
+    """
+    path_to_1cv8 = get_global_setting('path_to_1cv8')
+    if not path_to_1cv8 or not os.path.exists(path_to_1cv8):
+        raise FileNotFoundError(f"1cv8.exe не найден по пути из настроек: {path_to_1cv8}")
+
+    server = get_global_setting('app_server')
+    port = get_global_setting('app_port')
+    if not app_login:
+        app_login = get_global_setting('app_user')
+    if not app_password:
+        app_password = get_global_setting('app_password')
+
+    out_fd, out_path = tempfile.mkstemp(prefix='1cv8_', suffix='.log')
+    os.close(out_fd)
+    cmd = [
+        path_to_1cv8, "DESIGNER",
+        "/S", f"{server}:{port}\\{db_name}",
+        "/N", app_login,
+        "/P", app_password,
+        "/DisableStartupDialogs", "/DisableStartupMessages",
+        "/Out", out_path,
+    ]
+    unlock_code = get_global_setting('unlock_code')
+    if unlock_code:
+        cmd += ["/UC", unlock_code]
+    cmd += list(designer_args)
+
+    label = label or f"1cv8:{designer_args[0].lstrip('/')}"
+    try:
+        result = run_command(cmd, kind='1cv8', server=server, timeout=timeout, label=label, job_id=job_id)
+        with open(out_path, 'r', encoding='utf-8-sig', errors='replace') as f:
+            out_text = f.read().strip()
+    finally:
+        try:
+            os.remove(out_path)
+        except OSError:
+            pass
+
+    if job_id is not None and out_text:
+        from .logger_db import log_task_message
+        log_task_message(job_id, out_text)
+    if result['returncode'] != 0:
+        raise RuntimeError(f"Ошибка выполнения конфигуратора 1С ({label}): {out_text or result['stderr']}")
+    return out_text
@@ -0,0 +1,204 @@
+# app/rac_client.py
+"""
+Клиент rac (утилита администрирования кластера 1С).
+
+Разбирает вывод rac в формате "ключ : значение" в записи сеансов и информационных баз
+и завершает сеансы пользователей перед восстановлением (аналог ОтключитьСеансы из createbackup.txt).
+"""
+
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+
+from .config_loader import get_global_setting
+from .cluster_cache import get_rac_setting
+from .onec_commands import get_cluster_info_for_db
+from .services.onec_executor import run_command, run_command_async, run_coroutine
+
+DEFAULT_DRAIN_TIMEOUT = 60  # seconds
+
+
+@dataclass
+class RacSession:
+    session: str
+    session_id: int = 0
+    infobase: str = ''
+    user_name: str = ''
+    host: str = ''
+    app_id: str = ''
+    started_at: str = ''
+    last_active_at: str = ''
+
+    @classmethod
+    def from_record(cls, record):
+        try:
+            session_id = int(record.get('session-id') or 0)
+        except ValueError:
+            session_id = 0
+        return cls(
+            session=record.get('session', ''),
+            session_id=session_id,
+            infobase=record.get('infobase', ''),
+            user_name=record.get('user-name', ''),
+            host=record.get('host', ''),
+            app_id=record.get('app-id', ''),
+            started_at=record.get('started-at', ''),
+            last_active_at=record.get('last-active-at', ''),
+        )
+
+
+@dataclass
+class RacInfobase:
+    infobase: str
+    name: str = ''
+    descr: str = ''
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(
+            infobase=record.get('infobase', ''),
+            name=record.get('name', ''),
+            descr=record.get('descr', ''),
+        )
+
+
+def parse_rac_output(text):
+    """
+    Разбирает вывод rac: блоки "ключ : значение", разделённые пустыми строками.
+    Возвращает список словарей (по одному на блок). Кавычки вокруг значений снимаются.
+    """
+    records = []
+    current = {}
+    for line in (text or '').splitlines():
+        if not line.strip():
+            if current:
+                records.append(current)
+                current = {}
+            continue
+        key, sep, value = line.partition(':')
+        if not sep:
+            continue
+        value = value.strip()
+        if len(value) >= 2 and value[0] == '"' and value[-1] == '"':
+            value = value[1:-1]
+        current[key.strip()] = value
+    if current:
+        records.append(current)
+    return records
+
+
+def _rac_args(mode, command, cluster_guid, *options):
+    """
+    Собирает argv для rac: rac [ras] <режим> <команда> --cluster=... [авторизация] [параметры].
+    Команда может состоять из нескольких слов ('summary list') — все они идут до --cluster.
+    """
+    path_to_rac = get_rac_setting('path_to_rac')
+    if not path_to_rac or not os.path.exists(path_to_rac):
+        raise FileNotFoundError(f"rac.exe не найден по пути: {path_to_rac}")
+    args = [path_to_rac]
+    ras_address = get_rac_setting('ras_address')
+    if ras_address:
+        args.append(ras_address)
+    args += [mode, *command.split(), f"--cluster={cluster_guid}"]
+    user = get_rac_setting('app_server_admin')
+    if user:
+        args += [f"--cluster-user={user}", f"--cluster-pwd={get_rac_setting('app_server_admin_pwd') or ''}"]
+    args += list(options)
+    return args
+
+
+def _run_rac(args, label, job_id=None, timeout=None):
+    result = run_command(args, kind='rac', server=get_rac_setting('app_server'),
+                         timeout=timeout, label=label, job_id=job_id)
+    if result['returncode'] != 0:
+        raise RuntimeError(f"Ошибка выполнения команды rac: {result['stderr']}")
+    return result['stdout']
+
+
+def list_clusters():
+    """Возвращает GUID кластеров сервера приложений (rac cluster list)."""
+    path_to_rac = get_rac_setting('path_to_rac')
+    if not path_to_rac or not os.path.exists(path_to_rac):
+        raise FileNotFoundError(f"rac.exe не найден по пути: {path_to_rac}")
+    ras_address = get_rac_setting('ras_address')
+    args = [path_to_rac] + ([ras_address] if ras_address else []) + ['cluster', 'list']
+    output = _run_rac(args, 'rac:cluster list')
+    return [r['cluster'] for r in parse_rac_output(output) if r.get('cluster')]
+
+
+def list_infobases(cluster_guid):
+    """Возвращает список RacInfobase кластера."""
+    output = _run_rac(_rac_args('infobase', 'summary list', cluster_guid), 'rac:infobase summary list')
+    return [RacInfobase.from_record(r) for r in parse_rac_output(output)]
+
+
+def list_sessions(cluster_guid, infobase_guid, job_id=None, timeout=None):
+    """Возвращает список RacSession информационной базы."""
+    args = _rac_args('session', 'list', cluster_guid, f"--infobase={infobase_guid}")
+    output = _run_rac(args, 'rac:session list', job_id=job_id, timeout=timeout)
+    return [RacSession.from_record(r) for r in parse_rac_output(output)]
+
+
+async def _terminate_all(args_list, server, timeout):
+    return await asyncio.gather(
+        *[run_command_async(args, kind='rac', server=server, timeout=timeout, label='rac:session terminate')
+          for args in args_list],
+        return_exceptions=True
+    )
+
+
+def drain_sessions(db_name, exclude_users=None, timeout=None, job_id=None):
+    """
+    Завершает все сеансы базы, кроме сеансов служебных пользователей, параллельно.
+    Повторяет список/завершение, пока сеансы не закончатся или не истечёт timeout (секунды).
+    Возвращает dict: found, terminated, failed, remaining, elapsed.
+    """
+    cluster_info = get_cluster_info_for_db(db_name)
+    if not cluster_info:
+        raise ValueError(f"Не найдены GUID для базы: {db_name}")
+    cluster_guid = cluster_info['cluster_guid']
+    infobase_guid = cluster_info['infobase_guid']
+
+    if timeout is None:
+        timeout = int(get_global_setting('session_drain_timeout') or DEFAULT_DRAIN_TIMEOUT)
+    if exclude_users is None:
+        exclude_users = [get_global_setting('app_user')]
+    excluded = {u.lower() for u in exclude_users if u}
+
+    started = time.monotonic()
+    deadline = started + timeout
+    seen, terminated, failed = set(), set(), set()
+    remaining = []
+    while True:
+        left = deadline - time.monotonic()
+        if left <= 0:
+            break
+        sessions = list_sessions(cluster_guid, infobase_guid, timeout=left)
+        remaining = [s for s in sessions if s.user_name.lower() not in excluded and s.session not in failed]
+        if not remaining:
+            break
+        seen.update(s.session for s in remaining)
+        left = deadline - time.monotonic()
+        if left <= 0:
+            break
+        args_list = [_rac_args('session', 'terminate', cluster_guid, f"--session={s.session}") for s in remaining]
+        results = run_coroutine(_terminate_all(args_list, get_rac_setting('app_server'), left))
+        for session, result in zip(remaining, results):
+            if isinstance(result, Exception) or result['returncode'] != 0:
+                failed.add(session.session)
+            else:
+                terminated.add(session.session)
+                if job_id is not None:
+                    from .logger_db import log_task_message
+                    log_task_message(job_id, f"Завершён сеанс {session.session_id} пользователя {session.user_name} ({session.host})")
+        # Даём кластеру время удалить завершённые сеансы из списка
+        time.sleep(min(1, max(0, deadline - time.monotonic())))
+
+    return {
+        'found': len(seen),
+        'terminated': len(terminated),
+        'failed': len(failed),
+        'remaining': len(remaining),
+        'elapsed': time.monotonic() - started,
+    }
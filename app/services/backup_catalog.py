@@ -0,0 +1,387 @@
+# app/services/backup_catalog.py
+"""
+Каталог файлов бэкапов (BackupCatalog): размер, контрольная сумма, длительность,
+степень сжатия и GUID набора (backup_set_uuid из msdb) для каждого .bak.
+
+Каталог заполняется при создании бэкапа (record_backup) и поддерживается
+инкрементальным сканером (scan_catalog): для каждой папки хранится её mtime
+(CatalogDirectories), и папки, в которых не добавлялись и не удалялись файлы,
+не перечитываются — вместо них берётся сохранённый список вложенных папок,
+а известные файлы таких папок сверяются по размеру/mtime через stat
+(файл могли перезаписать на месте).
+Контрольные суммы не считаются ни в record_backup, ни в scan_catalog: оба стоят
+на пути бэкапа или запроса, а чтение файла целиком по сети долгое. Новые и изменившиеся
+файлы попадают в каталог без суммы; её досчитывает fill_checksums (файлы с checksum
+IS NULL) — в фоновом потоке после record_backup и после сканирования из админки,
+а в daily_backup — отдельным шагом после всех бэкапов. wait_for_checksums дожидается
+фоновых подсчётов, чтобы процесс не завершился посреди них.
+"""
+
+import datetime
+import hashlib
+import os
+import threading
+import time
+
+from app.config_loader import get_svc_conn, get_global_setting, get_backup_profile
+
+CHUNK_SIZE = 8 * 1024 * 1024
+MSDB_BATCH = 200  # сколько путей искать в msdb одним запросом
+
+_checksum_lock = threading.Lock()  # фоновые подсчёты по одному, чтобы не делить диск с RESTORE/BACKUP
+_checksum_threads = []
+_threads_guard = threading.Lock()
+
+
+def _norm(path):
+    return os.path.normcase(os.path.normpath(path))
+
+
+def _mtime(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp)
+
+
+def get_backup_roots():
+    """Корневые папки бэкапов: backup_base_path и тома всех профилей BackupProfiles."""
+    roots = [get_global_setting('backup_base_path') or r'D:\SQLBackups']
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("SELECT profile_name FROM BackupProfiles")
+    for (profile_name,) in cursor.fetchall():
+        roots += get_backup_profile(profile_name)['volumes']
+    conn.close()
+    unique = {}
+    for root in roots:
+        unique.setdefault(_norm(root), root)
+    return list(unique.values())
+
+
+def file_checksum(path):
+    """SHA-256 файла (или None, если подсчёт отключён настройкой catalog_checksum = 0)."""
+    if get_global_setting('catalog_checksum') == '0':
+        return None
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _msdb_metadata(paths):
+    """
+    Сведения о наборах из msdb по пути файла: backup_set_uuid, длительность,
+    backup_size и compressed_backup_size. Возвращает {норм. путь: dict}.
+    """
+    from app.db_utils import get_sql_server_conn
+    result = {}
+    if not paths:
+        return result
+    conn = get_sql_server_conn()
+    cursor = conn.cursor()
+    for start in range(0, len(paths), MSDB_BATCH):
+        batch = paths[start:start + MSDB_BATCH]
+        placeholders = ', '.join('?' for _ in batch)
+        cursor.execute(f"""
+            SELECT bmf.physical_device_name, bs.backup_set_uuid, bs.backup_start_date, bs.backup_finish_date,
+                   bs.backup_size, bs.compressed_backup_size
+            FROM msdb.dbo.backupmediafamily bmf
+            JOIN msdb.dbo.backupset bs ON bs.media_set_id = bmf.media_set_id
+            WHERE bmf.physical_device_name IN ({placeholders})
+            ORDER BY bs.backup_finish_date
+        """, *batch)
+        for device, set_uuid, started, finished, size, compressed in cursor.fetchall():
+            result[_norm(device)] = {  # при повторном бэкапе в тот же файл побеждает последний
+                "backup_set_guid": str(set_uuid) if set_uuid else None,
+                "duration_seconds": (finished - started).total_seconds() if started and finished else None,
+                "compression_ratio": float(size) / float(compressed) if size and compressed else None,
+            }
+    conn.close()
+    return result
+
+
+def _upsert_file(cursor, path, directory, size, mtime, checksum, meta):
+    cursor.execute("""
+        MERGE BackupCatalog AS target
+        USING (SELECT ? AS file_path) AS source
+        ON target.file_path = source.file_path
+        WHEN MATCHED THEN
+            UPDATE SET dir_path = ?, size_bytes = ?, file_mtime = ?, checksum = ?,
+                       backup_set_guid = COALESCE(?, target.backup_set_guid),
+                       duration_seconds = COALESCE(?, target.duration_seconds),
+                       compression_ratio = COALESCE(?, target.compression_ratio),
+                       scanned_at = GETDATE()
+        WHEN NOT MATCHED THEN
+            INSERT (file_path, dir_path, size_bytes, file_mtime, checksum, backup_set_guid, duration_seconds, compression_ratio)
+            VALUES (source.file_path, ?, ?, ?, ?, ?, ?, ?);
+    """, path,
+        directory, size, mtime, checksum, meta.get("backup_set_guid"), meta.get("duration_seconds"), meta.get("compression_ratio"),
+        directory, size, mtime, checksum, meta.get("backup_set_guid"), meta.get("duration_seconds"), meta.get("compression_ratio"))
+
+
+def _link_catalog(cursor):
+    """Связывает файлы каталога со строками Backups/BackupFiles/UserBackups по пути."""
+    cursor.execute("""
+        UPDATE bc SET backup_id = b.id, source_db_name = b.source_db_name, user_backup_id = NULL
+        FROM BackupCatalog bc
+        JOIN Backups b ON b.backup_file_path = bc.file_path
+    """)
+    cursor.execute("""
+        UPDATE bc SET backup_id = b.id, source_db_name = b.source_db_name, user_backup_id = NULL
+        FROM BackupCatalog bc
+        JOIN BackupFiles bf ON bf.file_path = bc.file_path
+        JOIN Backups b ON b.id = bf.backup_id
+    """)
+    cursor.execute("""
+        UPDATE bc SET user_backup_id = ub.id, source_db_name = ub.target_db_name, backup_id = NULL
+        FROM BackupCatalog bc
+        JOIN UserBackups ub ON ub.backup_file_path = bc.file_path
+    """)
+    # Строки, чьи Backups/UserBackups удалены, становятся сиротами
+    cursor.execute("""
+        UPDATE BackupCatalog SET backup_id = NULL
+        WHERE backup_id IS NOT NULL AND backup_id NOT IN (SELECT id FROM Backups)
+    """)
+    cursor.execute("""
+        UPDATE BackupCatalog SET user_backup_id = NULL
+        WHERE user_backup_id IS NOT NULL AND user_backup_id NOT IN (SELECT id FROM UserBackups)
+    """)
+
+
+def _hash_files(files):
+    """Считает контрольные суммы файлов [(путь, mtime)] и дописывает их в каталог, если файл не менялся."""
+    done = 0
+    with _checksum_lock:
+        for path, mtime in files:
+            try:
+                checksum = file_checksum(path)
+                if checksum is None:
+                    break
+                conn = get_svc_conn()
+                cursor = conn.cursor()
+                cursor.execute("UPDATE BackupCatalog SET checksum = ? WHERE file_path = ? AND file_mtime = ?",
+                               checksum, path, mtime)
+                conn.commit()
+                conn.close()
+                done += 1
+            except Exception as e:
+                print(f"[catalog] контрольная сумма {path} не посчитана: {e}")
+    return done
+
+
+def _in_background(target, *args):
+    thread = threading.Thread(target=target, args=args, daemon=True, name='catalog-checksum')
+    with _threads_guard:
+        _checksum_threads[:] = [t for t in _checksum_threads if t.is_alive()] + [thread]
+    thread.start()
+
+
+def fill_checksums():
+    """Досчитывает контрольные суммы файлов каталога, у которых её нет; возвращает число посчитанных."""
+    if get_global_setting('catalog_checksum') == '0':
+        return 0
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("SELECT file_path, file_mtime FROM BackupCatalog WHERE checksum IS NULL ORDER BY file_mtime DESC")
+    files = [(row[0], row[1]) for row in cursor.fetchall()]
+    conn.close()
+    if not files:
+        return 0
+    started = time.monotonic()
+    done = _hash_files(files)
+    print(f"[catalog] контрольных сумм посчитано: {done} из {len(files)} за {time.monotonic() - started:.0f} с")
+    return done
+
+
+def fill_checksums_in_background():
+    """fill_checksums в фоновом потоке (для сканирования из админки)."""
+    _in_background(fill_checksums)
+
+
+def wait_for_checksums(timeout=None):
+    """Ждёт фоновые подсчёты контрольных сумм этого процесса (перед его завершением)."""
+    with _threads_guard:
+        threads = list(_checksum_threads)
+    for thread in threads:
+        thread.join(timeout)
+
+
+def record_backup(backup_files, started=None, finished=None):
+    """
+    Вносит в каталог файлы только что созданного набора (вызывается после BACKUP).
+    started/finished — время бэкапа, если известно; иначе берётся из msdb.
+    Контрольные суммы считаются в фоне (см. описание модуля).
+    """
+    try:
+        meta_by_path = _msdb_metadata(list(backup_files))
+    except Exception as e:
+        print(f"[catalog] не удалось прочитать msdb: {e}")
+        meta_by_path = {}
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    recorded = []
+    for path in backup_files:
+        st = os.stat(path)
+        meta = dict(meta_by_path.get(_norm(path), {}))
+        if started and finished and meta.get("duration_seconds") is None:
+            meta["duration_seconds"] = (finished - started).total_seconds()
+        _upsert_file(cursor, path, os.path.dirname(path), st.st_size, _mtime(st.st_mtime), None, meta)
+        recorded.append((path, _mtime(st.st_mtime)))
+    _link_catalog(cursor)
+    conn.commit()
+    conn.close()
+    if get_global_setting('catalog_checksum') != '0':
+        _in_background(_hash_files, recorded)
+
+
+def scan_catalog(full=False):
+    """
+    Синхронизирует каталог с диском. Без full перечитываются только папки с изменившимся mtime.
+    Файлы не читаются: новые и изменившиеся вносятся без контрольной суммы (см. fill_checksums).
+    Возвращает сводку: просмотрено/пропущено папок, добавлено/обновлено/удалено файлов.
+    """
+    started = time.monotonic()
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("SELECT dir_path, parent_path, dir_mtime FROM CatalogDirectories")
+    known_dirs = {}
+    children = {}
+    for dir_path, parent_path, dir_mtime in cursor.fetchall():
+        known_dirs[_norm(dir_path)] = (dir_path, dir_mtime)
+        if parent_path:
+            children.setdefault(_norm(parent_path), []).append(dir_path)
+    cursor.execute("SELECT file_path, dir_path, size_bytes, file_mtime FROM BackupCatalog")
+    known_files = {}
+    for file_path, dir_path, size, mtime in cursor.fetchall():
+        known_files.setdefault(_norm(dir_path), {})[_norm(file_path)] = (file_path, size, mtime)
+
+    summary = {"dirs_scanned": 0, "dirs_skipped": 0, "added": 0, "updated": 0, "removed": 0}
+    seen_dirs = set()
+    new_files = []  # (path, dir, size, mtime) — новые и изменившиеся файлы
+
+    def compare(path, directory, size, mtime, old):
+        if old is None:
+            new_files.append((path, directory, size, mtime))
+            summary["added"] += 1
+        elif old[1] != size or old[2] != mtime:
+            new_files.append((path, directory, size, mtime))
+            summary["updated"] += 1
+
+    stack = [(root, None) for root in get_backup_roots()]
+    while stack:
+        directory, parent = stack.pop()
+        key = _norm(directory)
+        try:
+            dir_mtime = _mtime(os.stat(directory).st_mtime)
+        except OSError:
+            continue
+        seen_dirs.add(key)
+        known = known_dirs.get(key)
+        if not full and known and known[1] == dir_mtime:
+            # Файлы не добавлялись и не удалялись — берём сохранённые вложенные папки,
+            # а известные файлы сверяем через stat: перезапись на месте mtime папки не меняет
+            summary["dirs_skipped"] += 1
+            for file_key, old in known_files.get(key, {}).items():
+                try:
+                    st = os.stat(old[0])
+                except FileNotFoundError:
+                    cursor.execute("DELETE FROM BackupCatalog WHERE file_path = ?", old[0])
+                    summary["removed"] += 1
+                    continue
+                except OSError as e:
+                    print(f"[catalog] не удалось прочитать {old[0]}: {e}")
+                    continue
+                compare(old[0], directory, st.st_size, _mtime(st.st_mtime), old)
+            stack += [(child, directory) for child in children.get(key, [])]
+            continue
+
+        summary["dirs_scanned"] += 1
+        on_disk = {}
+        subdirs = []
+        try:
+            for entry in os.scandir(directory):
+                if entry.is_dir(follow_symlinks=False):
+                    if not entry.name.startswith('_'):  # служебные папки (_storage_cache и т.п.)
+                        subdirs.append(entry.path)
+                elif entry.name.lower().endswith('.bak'):
+                    st = entry.stat()
+                    on_disk[_norm(entry.path)] = (entry.path, st.st_size, _mtime(st.st_mtime))
+        except OSError as e:
+            print(f"[catalog] не удалось прочитать {directory}: {e}")
+            continue
+
+        catalog = known_files.get(key, {})
+        for file_key, (path, size, mtime) in on_disk.items():
+            compare(path, directory, size, mtime, catalog.get(file_key))
+        for file_key, (path, _, _) in catalog.items():
+            if file_key not in on_disk:
+                cursor.execute("DELETE FROM BackupCatalog WHERE file_path = ?", path)
+                summary["removed"] += 1
+
+        cursor.execute("DELETE FROM CatalogDirectories WHERE dir_path = ?", directory)
+        cursor.execute("INSERT INTO CatalogDirectories (dir_path, parent_path, dir_mtime) VALUES (?, ?, ?)",
+                       directory, parent, dir_mtime)
+        stack += [(subdir, directory) for subdir in subdirs]
+
+    # Папки, которых больше нет, и их файлы
+    for key, (dir_path, _) in known_dirs.items():
+        if key not in seen_dirs:
+            cursor.execute("DELETE FROM BackupCatalog WHERE dir_path = ?", dir_path)
+            cursor.execute("DELETE FROM CatalogDirectories WHERE dir_path = ?", dir_path)
+            summary["removed"] += len(known_files.get(key, {}))
+    conn.commit()
+
+    try:
+        meta_by_path = _msdb_metadata([path for path, _, _, _ in new_files])
+    except Exception as e:
+        print(f"[catalog] не удалось прочитать msdb: {e}")
+        meta_by_path = {}
+    for path, directory, size, mtime in new_files:
+        # Сумма изменившегося файла устарела: NULL, её досчитает fill_checksums
+        _upsert_file(cursor, path, directory, size, mtime, None, meta_by_path.get(_norm(path), {}))
+
+    _link_catalog(cursor)
+    conn.commit()
+    conn.close()
+    summary["seconds"] = round(time.monotonic() - started, 1)
+    print(f"[catalog] папок просмотрено {summary['dirs_scanned']}, пропущено {summary['dirs_skipped']}, "
+          f"файлов добавлено {summary['added']}, обновлено {summary['updated']}, удалено {summary['removed']}")
+    return summary
+
+
+def get_catalog_report():
+    """Сводка для админки: объём по источникам, файлы-сироты и строки без файлов."""
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT COALESCE(source_db_name, '(сироты)'), COUNT(*), SUM(size_bytes),
+               AVG(compression_ratio), AVG(duration_seconds), MAX(file_mtime)
+        FROM BackupCatalog
+        GROUP BY source_db_name
+        ORDER BY SUM(size_bytes) DESC
+    """)
+    by_source = [{
+        "source_db_name": row[0], "files": row[1], "size_bytes": row[2],
+        "avg_compression_ratio": row[3], "avg_duration_seconds": row[4], "last_file_at": row[5],
+    } for row in cursor.fetchall()]
+
+    cursor.execute("""
+        SELECT file_path, size_bytes, file_mtime
+        FROM BackupCatalog
+        WHERE backup_id IS NULL AND user_backup_id IS NULL
+        ORDER BY file_mtime
+    """)
+    orphans = [{"file_path": row[0], "size_bytes": row[1], "file_mtime": row[2]} for row in cursor.fetchall()]
+
+    cursor.execute("""
+        SELECT 'Backups', b.id, b.source_db_name, COALESCE(bf.file_path, b.backup_file_path)
+        FROM Backups b
+        LEFT JOIN BackupFiles bf ON bf.backup_id = b.id
+        WHERE NOT EXISTS (SELECT 1 FROM BackupCatalog bc WHERE bc.file_path = COALESCE(bf.file_path, b.backup_file_path))
+        UNION ALL
+        SELECT 'UserBackups', ub.id, ub.target_db_name, ub.backup_file_path
+        FROM UserBackups ub
+        WHERE NOT EXISTS (SELECT 1 FROM BackupCatalog bc WHERE bc.file_path = ub.backup_file_path)
+    """)
+    missing = [{"table": row[0], "id": row[1], "db_name": row[2], "file_path": row[3]} for row in cursor.fetchall()]
+    conn.close()
+    return {"by_source": by_source, "orphans": orphans, "missing": missing}
@@ -0,0 +1,121 @@
+# app/services/backup_flight.py
+"""
+Единственный бэкап по требованию на источник и день (single-flight).
+
+Когда сразу несколько задач восстановления с одним источником не находят бэкап,
+бэкап с продуктива делает только первая, остальные ждут и получают её результат.
+В процессе задачи ждут общий _Flight; между процессами и узлами — блокировку
+sp_getapplock в svc-БД. Получив блокировку, задача ещё раз ищет бэкап,
+ведь его мог уже сделать другой узел.
+
+Ежедневный бэкап (scripts/backup_task.py) берёт ту же блокировку через
+create_backup_under_lock: Backups допускает один бэкап источника за день
+(IX_Backups_db_date), и ночной бэкап не должен столкнуться с бэкапом по требованию.
+"""
+
+import datetime
+import threading
+
+from app.config_loader import get_svc_conn, get_global_setting
+from app.backup_resolver import resolve_backup
+
+DEFAULT_LOCK_TIMEOUT = 7200  # seconds: дольше бэкапа одного источника ждать нет смысла
+
+
+class _Flight:
+    """Выполняющийся бэкап: ожидающие задачи получают его результат или ошибку."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_flights = {}
+_flights_guard = threading.Lock()
+
+
+def acquire_db_lock(resource, timeout_seconds):
+    """Берёт sp_getapplock на сессию отдельного подключения; возвращает подключение (держит блокировку)."""
+    conn = get_svc_conn()
+    conn.autocommit = True
+    cursor = conn.cursor()
+    cursor.execute("""
+        DECLARE @result INT;
+        EXEC @result = sp_getapplock @Resource = ?, @LockMode = 'Exclusive',
+                                     @LockOwner = 'Session', @LockTimeout = ?;
+        SELECT @result;
+    """, resource, int(timeout_seconds * 1000))
+    result = cursor.fetchone()[0]
+    if result < 0:
+        conn.close()
+        raise TimeoutError(f"Не удалось получить блокировку {resource} (код {result})")
+    return conn
+
+
+def release_db_lock(conn, resource):
+    try:
+        cursor = conn.cursor()
+        cursor.execute("EXEC sp_releaseapplock @Resource = ?, @LockOwner = 'Session'", resource)
+    finally:
+        conn.close()
+
+
+def _create_under_lock(source_db_name, backup_date, allow_diff=False):
+    """Возвращает (цепочка наборов, создан ли бэкап сейчас)."""
+    resource = f"backup:{source_db_name.lower()}:{backup_date:%Y%m%d}"
+    timeout = int(get_global_setting('backup_single_flight_timeout') or DEFAULT_LOCK_TIMEOUT)
+    conn = acquire_db_lock(resource, timeout)
+    try:
+        # Пока ждали блокировку, бэкап мог сделать другой узел
+        backup_files = resolve_backup(source_db_name, backup_date)
+        if backup_files:
+            print(f"ℹ️ Бэкап {source_db_name} уже создан другим процессом")
+            return backup_files, False
+        print(f"⚠️ Нет бэкапа для {source_db_name}, создаю...")
+        from scripts.backup_task import create_backup_from_source
+        return [create_backup_from_source(source_db_name, allow_diff=allow_diff)], True
+    finally:
+        release_db_lock(conn, resource)
+
+
+def create_backup_under_lock(source_db_name, allow_diff=False):
+    """
+    Сегодняшний бэкап источника под той же блокировкой, что и бэкап по требованию
+    (для ежедневного бэкапа). Если бэкап за сегодня уже есть, новый не создаётся.
+    Возвращает (цепочка наборов, создан ли бэкап сейчас).
+    """
+    return _create_under_lock(source_db_name, datetime.date.today(), allow_diff=allow_diff)
+
+
+def get_or_create_backup(source_db_name):
+    """
+    Возвращает цепочку наборов сегодняшнего бэкапа источника (как resolve_backup),
+    создавая бэкап не более одного раза на все задачи этого процесса и всех узлов.
+    """
+    backup_date = datetime.date.today()
+    key = (source_db_name.lower(), backup_date)
+    with _flights_guard:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _Flight()
+            _flights[key] = flight
+
+    if not leader:
+        print(f"ℹ️ Бэкап {source_db_name} уже создаётся, жду результата")
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    try:
+        flight.result = _create_under_lock(source_db_name, backup_date)[0]
+        return flight.result
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        flight.done.set()
+        with _flights_guard:
+            _flights.pop(key, None)
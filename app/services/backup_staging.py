@@ -0,0 +1,345 @@
+# app/services/backup_staging.py
+"""
+Локальные копии бэкапов (staging) для восстановления с сетевых папок.
+
+Если задана staging_path (папка на быстром диске сервера SQL Server, доступная воркеру
+на запись), файлы набора перед RESTORE один раз копируются туда, и RESTORE читает копию.
+Следующие восстановления из того же бэкапа сетевую папку уже не читают.
+
+Копирование:
+  * блоками по staging_chunk_mb во временный файл *.part;
+  * прерванное копирование продолжается с места остановки (хеш уже скопированной части
+    пересчитывается с локального диска, а не читается по сети заново);
+  * SHA-256 копии сверяется с BackupCatalog.checksum, если он есть; размер и mtime
+    исходного файла сверяются всегда — до и после копирования;
+  * один файл копирует один процесс (sp_getapplock), остальные ждут готовую копию.
+
+Копии учитываются в StagedBackups и вытесняются по давности использования (LRU),
+когда их объём превышает staging_max_gb. Задача, получившая копию, берёт на неё аренду
+(StagedBackups.lease_until) и продлевает её, пока открыт контекст staged_backup:
+арендованные копии не вытесняет ни один процесс, а их исходные файлы, как и файлы
+копируемых сейчас бэкапов, закреплены от удаления retention (get_pinned_sources).
+При любой ошибке staging восстановление идёт напрямую из исходных файлов, а контекст
+сообщает ошибку вызывающему (её записывают в шаг задачи как 'error').
+"""
+
+import contextlib
+import datetime
+import hashlib
+import os
+import threading
+import time
+
+from app.config_loader import get_svc_conn, get_global_setting
+from app.services.backup_flight import acquire_db_lock, release_db_lock
+from app.services.job_queue import set_job_progress
+
+DEFAULT_CHUNK_MB = 64
+DEFAULT_MAX_GB = 200
+COPY_RETRIES = 3
+LOCK_TIMEOUT = 7200          # seconds: столько ждём чужое копирование того же файла
+LEASE_SECONDS = 600          # seconds: аренда копии читающей задачей, продлевается каждую треть срока
+PROGRESS_INTERVAL = 10       # seconds: как часто сохранять bytes_copied и ход задачи
+GB = 1024 ** 3
+MB = 1024 ** 2
+
+def _norm(path):
+    return os.path.normcase(os.path.normpath(path))
+
+
+def _mtime(st_mtime):
+    return datetime.datetime.fromtimestamp(st_mtime).replace(microsecond=0)
+
+
+def _setting(key, default):
+    value = get_global_setting(key)
+    return float(value) if value not in (None, '') else default
+
+
+def _path_key(path):
+    return hashlib.sha1(_norm(path).encode('utf-8')).hexdigest()
+
+
+def _staged_name(staging_path, source_path):
+    """Имя копии: короткий хеш пути источника + имя файла (одинаковые имена из разных папок не конфликтуют)."""
+    return os.path.join(staging_path, f"{_path_key(source_path)[:12]}_{os.path.basename(source_path)}.stg")
+
+
+def _needs_staging(staging_path, path):
+    """Файлы, которые уже лежат на томе staging, не копируются."""
+    return os.path.splitdrive(os.path.abspath(path))[0].lower() != \
+        os.path.splitdrive(os.path.abspath(staging_path))[0].lower()
+
+
+def _remove(path):
+    if path and os.path.exists(path):
+        os.remove(path)
+
+
+def get_pinned_sources():
+    """
+    Закрепления для retention: исходные файлы копируемых сейчас и арендованных копий.
+    Берутся из StagedBackups, поэтому видны любому процессу (и ежедневному бэкапу).
+    """
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("SELECT source_path FROM StagedBackups WHERE status = 'copying' OR lease_until > GETDATE()")
+    paths = [row[0] for row in cursor.fetchall()]
+    conn.close()
+    return paths
+
+
+def _renew_leases(source_paths, stop):
+    """Продлевает аренду копий, пока задача не закроет контекст staged_backup."""
+    placeholders = ', '.join('?' for _ in source_paths)
+    while not stop.wait(LEASE_SECONDS / 3):
+        try:
+            conn = get_svc_conn()
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                UPDATE StagedBackups SET lease_until = DATEADD(second, ?, GETDATE())
+                WHERE status = 'ready' AND source_path IN ({placeholders})
+            """, LEASE_SECONDS, *source_paths)
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            print(f"[staging] аренда копий не продлена: {e}")
+
+
+def _make_room(cursor, source_path, needed, max_bytes):
+    """Вытесняет давно не использованные копии (LRU), пока needed байт не поместятся в max_bytes."""
+    if needed > max_bytes:
+        raise RuntimeError(f"{source_path} ({needed / GB:.1f} ГБ) больше staging_max_gb")
+    cursor.execute("""
+        SELECT id, source_path, staged_path, size_bytes, status,
+               CASE WHEN last_used_at < DATEADD(second, -?, GETDATE()) THEN 1 ELSE 0 END
+        FROM StagedBackups
+        ORDER BY last_used_at
+    """, LOCK_TIMEOUT)
+    rows = [row for row in cursor.fetchall() if _norm(row[1]) != _norm(source_path)]
+    total = sum(row[3] for row in rows)
+    for staged_id, staged_source, staged_path, size_bytes, status, abandoned in rows:
+        if total + needed <= max_bytes:
+            break
+        # Копируемые сейчас копии не трогаем; 'copying' без движения дольше
+        # LOCK_TIMEOUT — брошенное копирование упавшего процесса
+        if status != 'ready' and not abandoned:
+            continue
+        # Строка удаляется, только если копию никто не арендовал: аренду и удаление
+        # разделяет SQL Server, поэтому выданную другой задаче копию не удалит ни один процесс
+        cursor.execute("""
+            DELETE FROM StagedBackups
+            WHERE id = ? AND (lease_until IS NULL OR lease_until <= GETDATE())
+        """, staged_id)
+        if cursor.rowcount != 1:
+            continue
+        cursor.commit()
+        try:
+            _remove(staged_path)
+            _remove(staged_path + '.part')
+        except OSError as e:
+            print(f"[staging] {staged_path} не удалён: {e}")
+        total -= size_bytes
+        print(f"[staging] вытеснена копия {staged_source} ({size_bytes / GB:.1f} ГБ)")
+    cursor.commit()
+    if total + needed > max_bytes:
+        raise RuntimeError(f"Нет места в staging для {source_path}: занятые копии используются")
+
+
+def _copy_resumable(source_path, part_path, size, chunk_size, on_chunk):
+    """Докопирует source_path в part_path с текущего размера part_path; возвращает SHA-256 копии."""
+    digest = hashlib.sha256()
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if offset > size:
+        os.remove(part_path)
+        offset = 0
+    if offset:
+        print(f"[staging] продолжаю копирование {source_path} с {offset / GB:.1f} ГБ")
+        with open(part_path, 'rb') as part:
+            for chunk in iter(lambda: part.read(chunk_size), b''):
+                digest.update(chunk)
+    attempts = 0
+    with open(part_path, 'ab') as part:
+        while offset < size:
+            try:
+                with open(source_path, 'rb') as src:
+                    src.seek(offset)
+                    while offset < size:
+                        chunk = src.read(min(chunk_size, size - offset))
+                        if not chunk:
+                            raise OSError(f"Файл {source_path} короче ожидаемого ({offset} из {size} байт)")
+                        part.write(chunk)
+                        digest.update(chunk)
+                        offset += len(chunk)
+                        on_chunk(offset)
+            except OSError as e:
+                # Обрыв сетевого чтения: повтор с того же места, уже скопированное не перечитывается
+                attempts += 1
+                if attempts > COPY_RETRIES:
+                    raise
+                print(f"[staging] ошибка чтения {source_path} на {offset / MB:.0f} МБ, повтор {attempts}: {e}")
+                part.flush()
+                time.sleep(5 * attempts)
+        part.flush()
+        os.fsync(part.fileno())
+    return digest.hexdigest()
+
+
+def _ready_copy(cursor, source_path, size, mtime):
+    """Путь готовой актуальной копии (с отметкой использования и арендой) или None."""
+    cursor.execute("""
+        UPDATE StagedBackups
+        SET last_used_at = GETDATE(), lease_until = DATEADD(second, ?, GETDATE())
+        OUTPUT INSERTED.staged_path
+        WHERE source_path = ? AND status = 'ready' AND size_bytes = ? AND source_mtime = ?
+    """, LEASE_SECONDS, source_path, size, mtime)
+    row = cursor.fetchone()
+    cursor.commit()
+    if row and os.path.exists(row[0]):
+        return row[0]
+    return None
+
+
+def _stage_file(source_path, staging_path, chunk_size, max_bytes, on_progress):
+    """Возвращает путь локальной копии source_path, при необходимости копируя файл."""
+    st = os.stat(source_path)
+    size, mtime = st.st_size, _mtime(st.st_mtime)
+    conn = get_svc_conn()
+    try:
+        cursor = conn.cursor()
+        staged = _ready_copy(cursor, source_path, size, mtime)
+        if staged:
+            on_progress(size)
+            return staged
+
+        resource = f"staging:{_path_key(source_path)}"
+        lock_conn = acquire_db_lock(resource, LOCK_TIMEOUT)
+        try:
+            # Пока ждали блокировку, файл мог скопировать другой процесс
+            staged = _ready_copy(cursor, source_path, size, mtime)
+            if staged:
+                on_progress(size)
+                return staged
+
+            staged_path = _staged_name(staging_path, source_path)
+            part_path = staged_path + '.part'
+            cursor.execute("SELECT size_bytes, source_mtime FROM StagedBackups WHERE source_path = ?", source_path)
+            row = cursor.fetchone()
+            if row and (row[0] != size or row[1] != mtime):
+                # Исходный файл изменился: недокопированная часть и старая копия не годятся
+                _remove(part_path)
+                _remove(staged_path)
+            _make_room(cursor, source_path, size, max_bytes)
+            os.makedirs(staging_path, exist_ok=True)
+            cursor.execute("""
+                MERGE StagedBackups AS t
+                USING (SELECT ? AS source_path) AS s ON t.source_path = s.source_path
+                WHEN MATCHED THEN UPDATE SET staged_path = ?, size_bytes = ?, source_mtime = ?,
+                    status = 'copying', checksum = NULL, last_used_at = GETDATE()
+                WHEN NOT MATCHED THEN INSERT (source_path, staged_path, size_bytes, source_mtime, status)
+                    VALUES (?, ?, ?, ?, 'copying');
+            """, source_path, staged_path, size, mtime, source_path, staged_path, size, mtime)
+            cursor.commit()
+
+            last_saved = [time.monotonic()]
+
+            def on_chunk(copied):
+                on_progress(copied)
+                if time.monotonic() - last_saved[0] >= PROGRESS_INTERVAL:
+                    cursor.execute("""
+                        UPDATE StagedBackups SET bytes_copied = ?, last_used_at = GETDATE()
+                        WHERE source_path = ?
+                    """, copied, source_path)
+                    cursor.commit()
+                    last_saved[0] = time.monotonic()
+
+            started = time.monotonic()
+            checksum = _copy_resumable(source_path, part_path, size, chunk_size, on_chunk)
+
+            after = os.stat(source_path)
+            if after.st_size != size or _mtime(after.st_mtime) != mtime:
+                _remove(part_path)
+                raise RuntimeError(f"{source_path} изменился во время копирования")
+            cursor.execute("SELECT checksum FROM BackupCatalog WHERE file_path = ?", source_path)
+            row = cursor.fetchone()
+            if row and row[0] and row[0] != checksum:
+                _remove(part_path)
+                raise RuntimeError(f"Контрольная сумма копии {source_path} не совпала с каталогом")
+
+            os.replace(part_path, staged_path)
+            cursor.execute("""
+                UPDATE StagedBackups
+                SET status = 'ready', bytes_copied = size_bytes, checksum = ?, last_used_at = GETDATE(),
+                    lease_until = DATEADD(second, ?, GETDATE())
+                WHERE source_path = ?
+            """, checksum, LEASE_SECONDS, source_path)
+            cursor.commit()
+            elapsed = time.monotonic() - started
+            print(f"[staging] {source_path} скопирован за {elapsed:.0f} с ({size / MB / max(elapsed, 1):.0f} МБ/с)")
+            return staged_path
+        finally:
+            release_db_lock(lock_conn, resource)
+    finally:
+        conn.close()
+
+
+def _stage_chain(chain, staging_path, job_id=None):
+    """Копирует файлы цепочки наборов, которых нет на томе staging; возвращает цепочку путей копий."""
+    chunk_size = int(_setting('staging_chunk_mb', DEFAULT_CHUNK_MB) * MB)
+    max_bytes = int(_setting('staging_max_gb', DEFAULT_MAX_GB) * GB)
+    files = [path for backup_files in chain for path in backup_files if _needs_staging(staging_path, path)]
+    total = sum(os.path.getsize(path) for path in files) or 1
+    done = [0]
+    last_reported = [0.0]
+
+    def progress(copied):
+        if job_id and time.monotonic() - last_reported[0] >= PROGRESS_INTERVAL:
+            set_job_progress(job_id, (done[0] + copied) * 100 // total, 'Копирование бэкапа')
+            last_reported[0] = time.monotonic()
+
+    staged_chain = []
+    for backup_files in chain:
+        staged_files = []
+        for path in backup_files:
+            if path in files:
+                staged_files.append(_stage_file(path, staging_path, chunk_size, max_bytes, progress))
+                done[0] += os.path.getsize(path)
+            else:
+                staged_files.append(path)
+        staged_chain.append(staged_files)
+    return staged_chain
+
+
+@contextlib.contextmanager
+def staged_backup(backup_path, job_id=None):
+    """
+    Контекст восстановления: отдаёт (путь, ошибка) — backup_path (путь, список файлов или
+    цепочка наборов, как в restore_db_from_backup) с путями локальных копий и None.
+    Пока контекст открыт, аренда копий продлевается: они не вытесняются, а исходные файлы
+    закреплены от retention. Без staging_path отдаёт (backup_path, None), при ошибке
+    копирования — backup_path без изменений и текст ошибки.
+    """
+    staging_path = get_global_setting('staging_path')
+    if not staging_path or not backup_path:
+        yield backup_path, None
+        return
+    if isinstance(backup_path, str):
+        chain, unwrap = [[backup_path]], lambda c: c[0][0]
+    elif isinstance(backup_path[0], str):
+        chain, unwrap = [list(backup_path)], lambda c: c[0]
+    else:
+        chain, unwrap = backup_path, lambda c: c
+    sources = [path for backup_files in chain for path in backup_files if _needs_staging(staging_path, path)]
+    error = None
+    try:
+        staged = unwrap(_stage_chain(chain, staging_path, job_id))
+    except Exception as e:
+        print(f"⚠️ Staging не удался, восстановление из исходных файлов: {e}")
+        staged, error = backup_path, str(e)
+    stop = threading.Event()
+    if sources and staged is not backup_path:
+        threading.Thread(target=_renew_leases, args=(sources, stop), daemon=True).start()
+    try:
+        yield staged, error
+    finally:
+        stop.set()
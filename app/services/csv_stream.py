@@ -0,0 +1,42 @@
+# app/services/csv_stream.py
+"""
+Потоковая выгрузка CSV: строки превращаются в байты блоками по мере чтения,
+без накопления всего файла в памяти. При gzip блоки сжимаются потоковым zlib
+(формат gzip), заголовок отправляется сразу (Z_SYNC_FLUSH), чтобы первый байт
+ушёл клиенту до чтения данных.
+"""
+
+import csv
+import io
+import zlib
+
+CHUNK_BYTES = 64 * 1024
+GZIP_LEVEL = 6
+
+
+def iter_csv(header, rows, compress=False, chunk_bytes=CHUNK_BYTES):
+    """Генератор байтов CSV (UTF-8) из заголовка и итератора строк; compress — gzip."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31) if compress else None
+
+    def take(flush_mode=None):
+        data = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        if compressor is None:
+            return data
+        data = compressor.compress(data)
+        if flush_mode is not None:
+            data += compressor.flush(flush_mode)
+        return data
+
+    writer.writerow(header)
+    yield take(zlib.Z_SYNC_FLUSH)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= chunk_bytes:
+            data = take()
+            if data:
+                yield data
+    yield take(zlib.Z_FINISH)
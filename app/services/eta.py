@@ -0,0 +1,295 @@
+# app/services/eta.py
+"""
+Оценка длительности восстановлений и прогноз очереди (ETA).
+
+Статистика собирается из истории портала и кэшируется в памяти процесса
+на eta_refresh_minutes:
+  * JobPhases — длительность каждого шага завершённых задач (app/services/job_phases.py):
+    медиана по шагу для базы, для источника и по всем задачам; скорость RESTORE
+    (секунд на ГБ) — по объёму, который восстановила именно эта задача (bytes шага 'restore');
+  * Backups и BackupCatalog — размер последней цепочки источника (полный и разностный
+    поверх него) по размерам из каталога, без обращения к сетевым папкам;
+  * msdb.dbo.restorehistory — размеры бэкапов, восстановленных в целевые базы
+    (в том числе вне портала), если бэкапа источника нет в каталоге;
+  * RestoreQueue — полная длительность задач, если замеров шагов ещё нет.
+Ожидаемое время задачи — сумма медиан её шагов, где RESTORE пересчитан по объёму
+текущего бэкапа и скорости источника.
+
+Прогноз очереди: задачи раскладываются по max_concurrent_restores слотам
+в порядке выборки воркера (priority, created_at). Считаются только задачи
+job_type = 'restore': у личных бэкапов и восстановлений свои слоты.
+"""
+
+import datetime
+import heapq
+import statistics
+import threading
+import time
+from collections import defaultdict
+
+from app.config_loader import get_svc_conn, get_global_setting
+
+DEFAULT_JOB_MINUTES = 30
+DEFAULT_REFRESH_MINUTES = 10
+HISTORY_DAYS = 90
+HISTORY_PER_KEY = 20      # сколько последних задач учитывать по одной базе
+MIN_REMAINING = 30        # seconds: выполняющейся задаче всегда оставляем хотя бы столько
+GB = 1024 ** 3
+
+_lock = threading.Lock()
+_stats = None
+_loaded_at = 0.0
+
+
+def _median(values):
+    return statistics.median(values) if values else None
+
+
+def _load_target_sources(cursor):
+    cursor.execute("""
+        SELECT restore_target_db, source_db_name FROM UserDatabases
+        UNION ALL
+        SELECT restore_target_db, source_db_name FROM CommonDatabases
+    """)
+    return {target.lower(): source for target, source in cursor.fetchall()}
+
+
+def _load_backup_sizes(cursor):
+    """
+    Размер последней цепочки каждого источника: все полосы последнего набора и, для
+    разностного, его полного. Размеры берутся из BackupCatalog, а не с сетевых папок.
+    """
+    cursor.execute("""
+        WITH latest AS (
+            SELECT source_db_name, id, base_backup_id,
+                   ROW_NUMBER() OVER (PARTITION BY source_db_name ORDER BY created_at DESC, id DESC) AS rn
+            FROM Backups
+        )
+        SELECT l.source_db_name, SUM(bc.size_bytes)
+        FROM latest l
+        JOIN BackupCatalog bc ON bc.backup_id = l.id OR bc.backup_id = l.base_backup_id
+        WHERE l.rn = 1
+        GROUP BY l.source_db_name
+    """)
+    return {source.lower(): int(size) for source, size in cursor.fetchall() if size}
+
+
+def import_restore_history(days=HISTORY_DAYS):
+    """
+    Читает из msdb.dbo.restorehistory размеры последних бэкапов, восстановленных в каждую базу.
+    В restorehistory нет времени окончания RESTORE, поэтому длительность оттуда не берём —
+    только объём, который пересчитывается во время по накопленной скорости.
+    """
+    from app.db_utils import get_sql_server_conn
+    conn = get_sql_server_conn()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT rh.destination_database_name,
+               COALESCE(bs.compressed_backup_size, bs.backup_size)
+        FROM msdb.dbo.restorehistory rh
+        JOIN msdb.dbo.backupset bs ON bs.backup_set_id = rh.backup_set_id
+        WHERE rh.restore_type = 'D' AND rh.restore_date >= DATEADD(day, -?, GETDATE())
+        ORDER BY rh.restore_date
+    """, days)
+    sizes = {}
+    for target, size in cursor.fetchall():
+        if size:
+            sizes[target.lower()] = int(size)  # более поздние восстановления перезаписывают ранние
+    conn.close()
+    return sizes
+
+
+def _step_medians(jobs):
+    """Медиана каждого шага по задачам ({шаг: секунд}); шаг, которого в задаче не было, — 0 секунд."""
+    phases = {phase for job in jobs for phase in job}
+    return {phase: _median([job.get(phase, 0) for job in jobs]) for phase in phases}
+
+
+def _load_stats():
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    target_sources = _load_target_sources(cursor)
+    backup_sizes = _load_backup_sizes(cursor)
+
+    # Полная длительность завершённых задач — запасной вариант, пока нет замеров шагов
+    cursor.execute("""
+        SELECT target_db, DATEDIFF(second, started_at, finished_at)
+        FROM RestoreQueue
+        WHERE status = 'completed' AND job_type = 'restore' AND started_at IS NOT NULL AND finished_at IS NOT NULL
+          AND finished_at >= DATEADD(day, -?, GETDATE())
+        ORDER BY finished_at DESC
+    """, HISTORY_DAYS)
+    all_totals = []
+    by_target = defaultdict(list)
+    by_source = defaultdict(list)
+    for target_db, seconds in cursor.fetchall():
+        if seconds is None or seconds <= 0:
+            continue
+        all_totals.append(seconds)
+        if len(by_target[target_db.lower()]) < HISTORY_PER_KEY:
+            by_target[target_db.lower()].append(seconds)
+        source = target_sources.get(target_db.lower())
+        if source and len(by_source[source.lower()]) < HISTORY_PER_KEY:
+            by_source[source.lower()].append(seconds)
+
+    # Шаги завершённых задач, от новых к старым
+    cursor.execute("""
+        SELECT jp.job_id, jp.target_db, jp.source_db, jp.phase, jp.duration_seconds, jp.bytes, jp.outcome
+        FROM JobPhases jp
+        JOIN RestoreQueue rq ON rq.id = jp.job_id
+        WHERE jp.job_type = 'restore' AND rq.status = 'completed'
+          AND jp.started_at >= DATEADD(day, -?, GETDATE())
+        ORDER BY jp.started_at DESC
+    """, HISTORY_DAYS)
+    jobs = {}                        # job_id -> (target, source, {шаг: секунд})
+    rates = defaultdict(list)        # source -> секунд на ГБ
+    for job_id, target_db, source_db, phase, seconds, size, outcome in cursor.fetchall():
+        target, source = target_db.lower(), (source_db or '').lower()
+        job = jobs.setdefault(job_id, (target, source, {}))
+        job[2][phase] = job[2].get(phase, 0) + seconds
+        if phase == 'restore' and outcome == 'success' and size and source:
+            rates[source].append(seconds / (size / GB))
+    conn.close()
+
+    steps_by_target = defaultdict(list)
+    steps_by_source = defaultdict(list)
+    for target, source, job_steps in jobs.values():
+        if len(steps_by_target[target]) < HISTORY_PER_KEY:
+            steps_by_target[target].append(job_steps)
+        if source and len(steps_by_source[source]) < HISTORY_PER_KEY:
+            steps_by_source[source].append(job_steps)
+
+    try:
+        restored_sizes = import_restore_history()
+    except Exception as e:
+        print(f"[eta] не удалось прочитать msdb.dbo.restorehistory: {e}")
+        restored_sizes = {}
+
+    all_rates = [rate for values in rates.values() for rate in values]
+    return {
+        "target_sources": target_sources,
+        "backup_sizes": backup_sizes,
+        "restored_sizes": restored_sizes,
+        "by_target": {key: _median(values) for key, values in by_target.items()},
+        "by_source": {key: _median(values) for key, values in by_source.items()},
+        "steps_by_target": {key: _step_medians(values) for key, values in steps_by_target.items()},
+        "steps_by_source": {key: _step_medians(values) for key, values in steps_by_source.items()},
+        "global_steps": _step_medians([job_steps for _, _, job_steps in jobs.values()]),
+        "rates": {key: _median(values) for key, values in rates.items()},
+        "global_total": _median(all_totals),
+        "global_rate": _median(all_rates),
+    }
+
+
+def get_stats():
+    """Возвращает накопленную статистику, перечитывая её не чаще eta_refresh_minutes."""
+    global _stats, _loaded_at
+    refresh = float(get_global_setting('eta_refresh_minutes') or DEFAULT_REFRESH_MINUTES) * 60
+    with _lock:
+        if _stats is None or time.monotonic() - _loaded_at > refresh:
+            _stats = _load_stats()
+            _loaded_at = time.monotonic()
+            print(f"[eta] статистика обновлена: баз с замерами шагов {len(_stats['steps_by_target'])}, "
+                  f"источников со скоростью RESTORE {len(_stats['rates'])}")
+        return _stats
+
+
+def invalidate():
+    """Сбрасывает статистику; следующий прогноз перечитает историю."""
+    global _stats
+    with _lock:
+        _stats = None
+
+
+def estimate_job_seconds(target_db, stats=None):
+    """
+    Ожидаемая длительность восстановления базы, секунд: сумма медиан шагов (по базе,
+    иначе по источнику, иначе по всем задачам), где RESTORE пересчитан по объёму бэкапа
+    и скорости источника. Без замеров шагов — медиана прошлых задач по базе, по источнику, по всем.
+    """
+    stats = stats or get_stats()
+    target = target_db.lower()
+    source = (stats["target_sources"].get(target) or '').lower()
+
+    steps = stats["steps_by_target"].get(target) or stats["steps_by_source"].get(source) or stats["global_steps"]
+    if steps:
+        size = stats["backup_sizes"].get(source) or stats["restored_sizes"].get(target)
+        rate = stats["rates"].get(source) or stats["global_rate"]
+        restore = size / GB * rate if size and rate is not None else steps.get('restore', 0)
+        return sum(seconds for phase, seconds in steps.items() if phase != 'restore') + restore
+
+    for value in (stats["by_target"].get(target), stats["by_source"].get(source), stats["global_total"]):
+        if value:
+            return value
+    return float(get_global_setting('eta_default_minutes') or DEFAULT_JOB_MINUTES) * 60
+
+
+def estimate_queue(jobs, now=None):
+    """
+    Прогноз по очереди.
+    jobs: dict-и с id, target_db, status, priority, created_at, started_at (все pending/running задачи).
+    Возвращает {"jobs": {id: {...}}, "drain_seconds": ..., "drain_at": datetime}.
+    """
+    now = now or datetime.datetime.now()
+    stats = get_stats()
+    slots_count = max(int(get_global_setting('max_concurrent_restores') or 2), 1)
+
+    result = {}
+    slots = []  # через сколько секунд освободится слот
+    for job in jobs:
+        if job["status"] != 'running':
+            continue
+        estimated = estimate_job_seconds(job["target_db"], stats)
+        elapsed = (now - job["started_at"]).total_seconds() if job.get("started_at") else 0
+        remaining = max(estimated - elapsed, MIN_REMAINING)
+        slots.append(remaining)
+        result[job["id"]] = {
+            "estimated_seconds": int(estimated),
+            "remaining_seconds": int(remaining),
+            "eta_start": job.get("started_at"),
+            "eta_finish": now + datetime.timedelta(seconds=remaining),
+        }
+
+    # Выполняющихся задач может быть больше слотов (несколько процессов) — новые ждут самый ранний
+    heapq.heapify(slots)
+    while len(slots) < slots_count:
+        heapq.heappush(slots, 0)
+
+    pending = sorted((job for job in jobs if job["status"] == 'pending'),
+                     key=lambda job: (job["priority"], job["created_at"]))
+    for job in pending:
+        estimated = estimate_job_seconds(job["target_db"], stats)
+        start = heapq.heappop(slots)
+        finish = start + estimated
+        heapq.heappush(slots, finish)
+        result[job["id"]] = {
+            "estimated_seconds": int(estimated),
+            "remaining_seconds": int(finish),
+            "eta_start": now + datetime.timedelta(seconds=start),
+            "eta_finish": now + datetime.timedelta(seconds=finish),
+        }
+
+    drain_seconds = int(max(slots)) if slots else 0
+    return {
+        "jobs": result,
+        "drain_seconds": drain_seconds,
+        "drain_at": now + datetime.timedelta(seconds=drain_seconds),
+    }
+
+
+def get_queue_eta():
+    """Читает активные задачи RestoreQueue и возвращает прогноз estimate_queue."""
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT id, target_db, status, priority, created_at, started_at
+        FROM RestoreQueue
+        WHERE status IN ('pending', 'running') AND job_type = 'restore'
+    """)
+    jobs = [
+        {"id": row[0], "target_db": row[1], "status": row[2], "priority": row[3],
+         "created_at": row[4], "started_at": row[5]}
+        for row in cursor.fetchall()
+    ]
+    conn.close()
+    return estimate_queue(jobs)
@@ -0,0 +1,149 @@
+# app/services/job_phases.py
+"""
+Длительность шагов задач очереди и отчёт по ним.
+
+Каждый шаг задачи (сеансы 1С, staging, RESTORE, команды 1С, обновление из хранилища,
+BACKUP...) оборачивается в JobPhases.phase: фиксируются начало, конец, длительность,
+объём данных (bytes — для шагов, которые читают или пишут бэкап) и исход —
+'success', 'error' (исключение в шаге) или 'skipped' (шаг не понадобился).
+Замеры копятся в памяти и пишутся в таблицу JobPhases одной пачкой в конце задачи (flush).
+
+get_phase_report считает p50/p95 длительности по шагу, по шагу и источнику
+или по шагу и дню — чтобы видеть, где уходит время и когда шаг стал медленнее.
+"""
+
+import datetime
+import os
+import time
+from contextlib import contextmanager
+
+from app.config_loader import get_svc_conn
+
+REPORT_GROUPS = {
+    'phase': [],
+    'source': ['source_db'],
+    'day': ['CAST(started_at AS DATE)'],
+}
+DEFAULT_REPORT_DAYS = 30
+
+
+class JobPhases:
+    """Замеры шагов одной задачи."""
+
+    def __init__(self, job_id, job_type, target_db, source_db=None):
+        self.job_id = job_id
+        self.job_type = job_type
+        self.target_db = target_db
+        self.source_db = source_db
+        self.rows = []
+
+    @contextmanager
+    def phase(self, name, bytes=None):
+        """
+        Замер шага. Шаг может уточнить результат через выданный dict:
+        bytes, outcome ('skipped'), details. Исключение отмечает шаг как 'error' и пробрасывается.
+        """
+        info = {"bytes": bytes, "outcome": 'success', "details": None}
+        started_at = datetime.datetime.now()
+        started = time.monotonic()
+        try:
+            yield info
+        except Exception as e:
+            info.update(outcome='error', details=str(e))
+            raise
+        finally:
+            self.record(name, started_at, time.monotonic() - started, info["outcome"], info["bytes"], info["details"])
+
+    def record(self, name, started_at, seconds, outcome='success', bytes=None, details=None):
+        """Добавляет замер шага, выполненного без phase()."""
+        self.rows.append((self.job_id, self.job_type, self.target_db, self.source_db, name, started_at,
+                          started_at + datetime.timedelta(seconds=seconds), seconds, bytes, outcome,
+                          (details or '')[:512] or None))
+
+    def flush(self):
+        """Пишет накопленные замеры в JobPhases; ошибка записи не влияет на задачу."""
+        if not self.rows:
+            return
+        try:
+            conn = get_svc_conn()
+            cursor = conn.cursor()
+            cursor.executemany("""
+                INSERT INTO JobPhases (job_id, job_type, target_db, source_db, phase, started_at, finished_at,
+                                       duration_seconds, bytes, outcome, details)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, self.rows)
+            conn.commit()
+            conn.close()
+            self.rows = []
+        except Exception as e:
+            print(f"⚠️ Замеры шагов задачи {self.job_id} не записаны: {e}")
+
+
+def files_size(paths):
+    """Суммарный размер файлов бэкапа (путь, список или цепочка наборов); недоступные не считаются."""
+    if not paths:
+        return None
+    if isinstance(paths, str):
+        paths = [paths]
+    flat = [p for item in paths for p in ([item] if isinstance(item, str) else item)]
+    total = 0
+    for path in flat:
+        try:
+            total += os.path.getsize(path)
+        except OSError:
+            pass
+    return total or None
+
+
+def get_phase_report(group='phase', days=DEFAULT_REPORT_DAYS, phase=None, source_db=None):
+    """
+    p50/p95 длительности шагов за days дней, по группам: 'phase' — по шагу,
+    'source' — по шагу и источнику, 'day' — по шагу и дню.
+    [{phase, key, runs, errors, p50, p95, max, mb_per_second}], по шагу и ключу.
+    """
+    if group not in REPORT_GROUPS:
+        raise ValueError(f"Неизвестная группировка: {group}")
+    partition = ', '.join(['phase'] + REPORT_GROUPS[group])
+    key = REPORT_GROUPS[group][0] if REPORT_GROUPS[group] else 'NULL'
+    where, params = ["started_at >= ?"], [datetime.datetime.now() - datetime.timedelta(days=days)]
+    if phase:
+        where.append("phase = ?")
+        params.append(phase)
+    if source_db:
+        where.append("source_db = ?")
+        params.append(source_db)
+
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    # Перцентили — только по успешным запускам, ошибки считаются отдельно
+    cursor.execute(f"""
+        SELECT DISTINCT phase, {key} AS group_key,
+               COUNT(*) OVER (PARTITION BY {partition}),
+               SUM(CASE WHEN outcome = 'error' THEN 1 ELSE 0 END) OVER (PARTITION BY {partition}),
+               PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY ok_seconds) OVER (PARTITION BY {partition}),
+               PERCENTILE_CONT(0.95) WITHIN GROUP (ORDER BY ok_seconds) OVER (PARTITION BY {partition}),
+               MAX(ok_seconds) OVER (PARTITION BY {partition}),
+               SUM(CASE WHEN ok_seconds IS NOT NULL THEN bytes END) OVER (PARTITION BY {partition}),
+               SUM(CASE WHEN bytes IS NOT NULL THEN ok_seconds END) OVER (PARTITION BY {partition})
+        FROM (
+            SELECT *, CASE WHEN outcome = 'success' THEN duration_seconds END AS ok_seconds
+            FROM JobPhases
+            WHERE outcome <> 'skipped' AND {' AND '.join(where)}
+        ) p
+        ORDER BY phase, group_key
+    """, *params)
+    report = []
+    for name, group_key, runs, errors, p50, p95, longest, total_bytes, bytes_seconds in cursor.fetchall():
+        report.append({
+            "phase": name,
+            "key": group_key.isoformat() if hasattr(group_key, 'isoformat') else group_key,
+            "runs": runs,
+            "errors": errors,
+            "p50": round(p50, 1) if p50 is not None else None,
+            "p95": round(p95, 1) if p95 is not None else None,
+            "max": round(longest, 1) if longest is not None else None,
+            "mb_per_second": round(total_bytes / bytes_seconds / (1024 * 1024), 1)
+                             if total_bytes and bytes_seconds else None,
+        })
+    conn.close()
+    return report
@@ -0,0 +1,121 @@
+# app/services/job_queue.py
+"""
+Типы задач RestoreQueue и их захват воркером.
+
+В одной очереди одним воркером выполняются:
+  * 'restore'      — восстановление базы из бэкапа источника;
+  * 'user_backup'  — личный бэкап базы пользователя (результат — строка UserBackups);
+  * 'user_restore' — восстановление базы из личного бэкапа (RestoreQueue.user_backup_id).
+
+У каждого типа свой предел одновременных задач (GlobalSettings). Задача захватывается,
+только если для её типа есть свободный слот; занятые слоты считаются по строкам
+RestoreQueue со статусом 'running', поэтому пределы общие для всех процессов и узлов.
+Подсчёт слотов и захват идут в одной транзакции под блокировкой sp_getapplock
+'queue-claim', иначе два узла могли бы одновременно увидеть один свободный слот.
+Ход выполнения пишется в RestoreQueue.progress (проценты текущего BACKUP/RESTORE)
+и progress_stage (название шага).
+"""
+
+from app.config_loader import get_svc_conn, get_global_setting
+from app.services.metrics import inc
+
+# тип задачи -> (настройка предела, предел по умолчанию)
+JOB_TYPES = {
+    'restore': ('max_concurrent_restores', 2),
+    'user_backup': ('max_concurrent_user_backups', 1),
+    'user_restore': ('max_concurrent_user_restores', 1),
+}
+CLAIM_LOCK_TIMEOUT = 10  # seconds: не дождались — задачу возьмём в следующем цикле воркера
+
+
+def get_type_limits():
+    """Пределы одновременных задач по типам."""
+    limits = {}
+    for job_type, (setting_key, default) in JOB_TYPES.items():
+        try:
+            limits[job_type] = int(get_global_setting(setting_key) or default)
+        except ValueError:
+            limits[job_type] = default
+    return limits
+
+
+def enqueue_job(windows_user, target_db, job_type='restore', priority=10, backup_date=None, user_backup_id=None):
+    """Добавляет задачу в RestoreQueue и возвращает её id."""
+    if job_type not in JOB_TYPES:
+        raise ValueError(f"Неизвестный тип задачи: {job_type}")
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO RestoreQueue (windows_user, target_db, status, priority, backup_date, job_type, user_backup_id)
+        OUTPUT INSERTED.id
+        VALUES (?, ?, 'pending', ?, ?, ?, ?)
+    """, windows_user, target_db, priority, backup_date, job_type, user_backup_id)
+    job_id = cursor.fetchone()[0]
+    conn.commit()
+    conn.close()
+    inc('jobs_enqueued_total', {'job_type': job_type})
+    return job_id
+
+
+def claim_next_job():
+    """
+    Атомарно переводит в 'running' следующую задачу (priority, created_at) среди типов
+    со свободным слотом. Возвращает dict {id, windows_user, target_db, job_type, user_backup_id,
+    created_at, started_at} или None.
+    """
+    limits = get_type_limits()
+    conn = get_svc_conn()
+    try:
+        cursor = conn.cursor()
+        # Блокировка транзакции: снимается при commit/закрытии подключения
+        cursor.execute("""
+            DECLARE @result INT;
+            EXEC @result = sp_getapplock @Resource = 'queue-claim', @LockMode = 'Exclusive',
+                                         @LockOwner = 'Transaction', @LockTimeout = ?;
+            SELECT @result;
+        """, CLAIM_LOCK_TIMEOUT * 1000)
+        if cursor.fetchone()[0] < 0:
+            return None
+        cursor.execute("SELECT job_type, COUNT(*) FROM RestoreQueue WHERE status = 'running' GROUP BY job_type")
+        running = {row[0]: row[1] for row in cursor.fetchall()}
+        free_types = [t for t, limit in limits.items() if running.get(t, 0) < limit]
+        if not free_types:
+            return None
+        placeholders = ', '.join('?' for _ in free_types)
+        cursor.execute(f"""
+            WITH next_job AS (
+                SELECT TOP (1) *
+                FROM RestoreQueue WITH (UPDLOCK, READPAST, ROWLOCK)
+                WHERE status = 'pending' AND job_type IN ({placeholders})
+                ORDER BY priority, created_at
+            )
+            UPDATE next_job
+            SET status = 'running', started_at = GETDATE(), progress = 0, progress_stage = NULL
+            OUTPUT INSERTED.id, INSERTED.windows_user, INSERTED.target_db, INSERTED.job_type, INSERTED.user_backup_id,
+                   INSERTED.created_at, INSERTED.started_at
+        """, *free_types)
+        row = cursor.fetchone()
+        conn.commit()
+    finally:
+        conn.close()
+    if not row:
+        return None
+    inc('jobs_claimed_total', {'job_type': row[3]})
+    return {"id": row[0], "windows_user": row[1], "target_db": row[2],
+            "job_type": row[3], "user_backup_id": row[4], "created_at": row[5], "started_at": row[6]}
+
+
+def set_job_progress(job_id, percent=None, stage=None):
+    """Обновляет ход задачи; None оставляет прежнее значение. Ошибки не прерывают задачу."""
+    try:
+        conn = get_svc_conn()
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE RestoreQueue
+            SET progress = COALESCE(?, progress), progress_stage = COALESCE(?, progress_stage)
+            WHERE id = ?
+        """, None if percent is None else int(percent), stage, job_id)
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        print(f"⚠️ Не удалось обновить ход задачи {job_id}: {e}")
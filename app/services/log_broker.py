@@ -0,0 +1,187 @@
+# app/services/log_broker.py
+"""
+Рассылка строк лога задачи подписчикам SSE (/logs/stream/<job_id>) внутри процесса.
+
+Строки, которые пишет этот процесс (log_task_message), публикуются сразу после INSERT.
+Строки других процессов (воркер в отдельном процессе IIS) и завершение задачи
+подхватывает один общий опросчик: раз в POLL_INTERVAL секунд он двумя запросами читает
+статусы и новые строки RestoreTaskLogs сразу всех задач, у которых есть подписчики,
+вместо запроса каждую секунду на каждого зрителя. Без подписчиков опросчик останавливается.
+
+Для задачи хранится кольцевой буфер последних RING_SIZE строк: переподключившийся
+клиент получает пропущенное после Last-Event-ID из буфера, а то, что из буфера уже
+вытеснено, — одним запросом к БД. Когда задача завершена, подписчик получает
+событие end и поток закрывается.
+"""
+
+import threading
+import time
+from collections import deque
+
+from app.config_loader import get_svc_conn
+
+RING_SIZE = 500
+POLL_INTERVAL = 1.0         # seconds
+HEARTBEAT_SECONDS = 15
+IDLE_KEEP_SECONDS = 300     # сколько хранить буфер задачи без подписчиков
+FINAL_STATUSES = ('completed', 'failed')
+
+
+class _JobChannel:
+    """Буфер строк одной задачи; loaded — опросчик уже загрузил строки, записанные до подписки."""
+
+    def __init__(self):
+        self.events = deque(maxlen=RING_SIZE)  # (id, message, timestamp)
+        self.last_id = 0
+        self.dropped_upto = 0  # id последней строки, вытесненной из буфера
+        self.loaded = False
+        self.finished = None   # статус завершения задачи
+        self.subscribers = 0
+        self.touched = time.monotonic()
+
+    def append(self, event_id, message, timestamp):
+        if event_id <= self.last_id:
+            return
+        if len(self.events) == self.events.maxlen:
+            self.dropped_upto = self.events[0][0]
+        self.events.append((event_id, message, timestamp))
+        self.last_id = event_id
+
+
+_channels = {}
+_cond = threading.Condition()
+_poller = None
+
+
+def publish(job_id, event_id, message, timestamp):
+    """Передаёт строку лога подписчикам задачи (если они есть в этом процессе)."""
+    with _cond:
+        channel = _channels.get(job_id)
+        # До первой загрузки опросчиком строка придёт вместе с более ранними, в правильном порядке
+        if channel is None or not channel.loaded:
+            return
+        channel.append(event_id, message, timestamp)
+        _cond.notify_all()
+
+
+def finish(job_id, status):
+    """Отмечает задачу завершённой; подписчики дочитают буфер и получат end."""
+    with _cond:
+        channel = _channels.get(job_id)
+        if channel is not None and channel.loaded:
+            channel.finished = status
+            _cond.notify_all()
+
+
+def _read_backlog(job_id, after_id, upto_id):
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT id, message, timestamp FROM RestoreTaskLogs
+        WHERE job_id = ? AND id > ? AND id <= ?
+        ORDER BY id
+    """, job_id, after_id, upto_id)
+    rows = [tuple(row) for row in cursor.fetchall()]
+    conn.close()
+    return rows
+
+
+def _poll_once(watch):
+    """Статусы и новые строки всех наблюдаемых задач: {job_id: last_id} -> (statuses, rows)."""
+    job_ids = list(watch)
+    placeholders = ', '.join('?' for _ in job_ids)
+    conn = get_svc_conn()
+    try:
+        cursor = conn.cursor()
+        # Сначала статус: строки, записанные до завершения задачи, прочитаются вторым запросом
+        cursor.execute(f"SELECT id, status FROM RestoreQueue WHERE id IN ({placeholders})", *job_ids)
+        statuses = {row[0]: row[1] for row in cursor.fetchall()}
+        cursor.execute(f"""
+            SELECT id, job_id, message, timestamp FROM RestoreTaskLogs
+            WHERE job_id IN ({placeholders}) AND id > ?
+            ORDER BY id
+        """, *job_ids, min(watch.values()))
+        rows = cursor.fetchall()
+    finally:
+        conn.close()
+    return statuses, rows
+
+
+def _poll_loop():
+    global _poller
+    while True:
+        with _cond:
+            now = time.monotonic()
+            for job_id in [j for j, c in _channels.items() if c.subscribers == 0 and now - c.touched > IDLE_KEEP_SECONDS]:
+                del _channels[job_id]
+            if not _channels:
+                _poller = None
+                return
+            watch = {job_id: c.last_id for job_id, c in _channels.items() if c.finished is None}
+        if watch:
+            try:
+                statuses, rows = _poll_once(watch)
+            except Exception as e:
+                print(f"[log_broker] ошибка опроса логов: {e}")
+                time.sleep(POLL_INTERVAL * 5)
+                continue
+            with _cond:
+                for event_id, job_id, message, timestamp in rows:
+                    channel = _channels.get(job_id)
+                    if channel is not None:
+                        channel.append(event_id, message, timestamp)
+                for job_id in watch:
+                    channel = _channels.get(job_id)
+                    if channel is None:
+                        continue
+                    channel.loaded = True
+                    status = statuses.get(job_id, 'missing')
+                    if status in FINAL_STATUSES or status == 'missing':
+                        channel.finished = status
+                _cond.notify_all()
+        time.sleep(POLL_INTERVAL)
+
+
+def subscribe(job_id, last_event_id=0):
+    """
+    События лога задачи после last_event_id: ('log', (id, message, timestamp)),
+    ('heartbeat', None) при простое и последним — ('end', статус).
+    """
+    global _poller
+    with _cond:
+        channel = _channels.get(job_id)
+        if channel is None:
+            channel = _channels[job_id] = _JobChannel()
+        channel.subscribers += 1
+        if _poller is None or not _poller.is_alive():
+            _poller = threading.Thread(target=_poll_loop, daemon=True)
+            _poller.start()
+
+    cursor_id = last_event_id
+
+    def has_news():
+        return channel.loaded and (channel.last_id > cursor_id or channel.finished is not None)
+
+    try:
+        while True:
+            with _cond:
+                _cond.wait_for(has_news, timeout=HEARTBEAT_SECONDS)
+                gap_upto = channel.dropped_upto if channel.loaded and cursor_id < channel.dropped_upto else None
+                events = [e for e in channel.events if e[0] > cursor_id] if channel.loaded else []
+                finished = channel.finished
+            if gap_upto:
+                # Клиент отстал дальше буфера: пропущенное — из БД
+                events = _read_backlog(job_id, cursor_id, gap_upto) + events
+            if events:
+                for event in events:
+                    yield 'log', event
+                    cursor_id = event[0]
+                continue
+            if finished is not None:
+                yield 'end', finished
+                return
+            yield 'heartbeat', None
+    finally:
+        with _cond:
+            channel.subscribers -= 1
+            channel.touched = time.monotonic()
@@ -0,0 +1,230 @@
+# app/services/log_query.py
+"""
+Единый запрос к журналам портала с постраничной выборкой по ключу (keyset).
+
+Источники — AuthLog, UserActionsLog, OneCOperationLog и RestoreJobs — приводятся
+к одной строке (см. COLUMNS). Фильтры (LogFilter) передаются в запрос каждого источника
+отдельно: период, пользователь, база и задача попадают в WHERE, а TOP (limit + 1) —
+в сам запрос, поэтому SQL Server читает по индексу только одну страницу каждого журнала.
+Источник без нужного поля (например, AuthLog при фильтре по базе) не запрашивается.
+Уже ограниченные и отсортированные потоки сливаются в Python (heapq.merge).
+
+Порядок — от новых к старым по (timestamp, источник, id). Курсор страницы — ключ
+последней выданной строки; следующая страница начинается строго после него, без OFFSET,
+так что любая страница стоит одинаково при любом объёме журналов. Время журналов хранится
+как DATETIME2(3) (scripts/create_svc_db.sql): pyodbc возвращает его без потерь, и строки
+с тем же временем, что у последней строки страницы, не теряются на границе страниц.
+
+Длинные тексты OneCOperationLog хранятся сжатыми (app/log_text.py): источник выбирает
+их столбцы *_gz последними ('packed'), а _row распаковывает только выданные строки.
+
+Для выгрузки stream_logs читает каждый источник одним запросом через fetchmany
+(отдельное подключение на источник) и сливает потоки по мере чтения: в памяти
+одновременно не больше batch_size строк на источник при любом объёме выгрузки.
+"""
+
+import datetime
+import heapq
+from dataclasses import dataclass
+
+from app.config_loader import get_svc_conn
+from app.log_text import unpack_text
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+ALL_TYPES = ('auth', 'action', '1c', 'job')
+
+COLUMNS = ('type', 'id', 'timestamp', 'windows_user', 'ip_address', 'target_db', 'job_id',
+           'event', 'status', 'details', 'error_message', 'finished_at')
+
+# Ранг источника задаёт порядок строк с одинаковым timestamp
+_SOURCES = {
+    'auth': {
+        'rank': 0, 'label': 'Auth',
+        'from': "AuthLog t",
+        'select': "t.id, t.timestamp, t.windows_user, t.ip_address, NULL, NULL, t.action, NULL, t.details, NULL, NULL",
+        'columns': {'id': 't.id', 'timestamp': 't.timestamp', 'windows_user': 't.windows_user'},
+    },
+    'action': {
+        'rank': 1, 'label': 'Action',
+        'from': "UserActionsLog t",
+        'select': "t.id, t.timestamp, t.windows_user, t.ip_address, t.target_db, NULL, t.action_type, NULL, t.details, NULL, NULL",
+        'columns': {'id': 't.id', 'timestamp': 't.timestamp', 'windows_user': 't.windows_user',
+                    'target_db': 't.target_db'},
+    },
+    '1c': {
+        'rank': 2, 'label': '1C',
+        # Пользователь задачи — соединением, а не коррелированным подзапросом на каждую строку
+        'from': "OneCOperationLog t LEFT JOIN RestoreQueue rq ON rq.id = t.job_id",
+        'select': "t.id, t.timestamp, rq.windows_user, NULL, t.target_db, t.job_id, t.operation, t.status, "
+                  "t.log_text, t.error_message, NULL, t.log_text_gz, t.error_message_gz",
+        'packed': ('details', 'error_message'),
+        'columns': {'id': 't.id', 'timestamp': 't.timestamp', 'windows_user': 'rq.windows_user',
+                    'target_db': 't.target_db', 'job_id': 't.job_id'},
+    },
+    'job': {
+        'rank': 3, 'label': 'Job',
+        'from': "RestoreJobs t",
+        'select': "t.id, t.started_at, t.windows_user, NULL, t.target_db, t.job_id, 'restore', t.status, "
+                  "NULL, t.error_message, t.finished_at",
+        'columns': {'id': 't.id', 'timestamp': 't.started_at', 'windows_user': 't.windows_user',
+                    'target_db': 't.target_db', 'job_id': 't.job_id'},
+    },
+}
+
+
+@dataclass
+class LogFilter:
+    """Фильтр журналов; end — исключающая граница."""
+    types: tuple = ('action', '1c')
+    start: datetime.datetime = None
+    end: datetime.datetime = None
+    windows_user: str = None
+    target_db: str = None
+    job_id: int = None
+
+    @classmethod
+    def from_args(cls, args, default_types=('action', '1c')):
+        """
+        Фильтр из параметров запроса: start_date/end_date (ГГГГ-ММ-ДД, конец включительно),
+        user, database, job_id, log_type. Неверные значения — ValueError.
+        """
+        def parse_date(value):
+            return datetime.datetime.strptime(value, '%Y-%m-%d') if value else None
+
+        log_type = args.get('log_type')
+        if log_type and log_type not in _SOURCES:
+            raise ValueError(f"Неизвестный тип журнала: {log_type}")
+        end = parse_date(args.get('end_date'))
+        job_id = args.get('job_id')
+        return cls(
+            types=(log_type,) if log_type else tuple(default_types),
+            start=parse_date(args.get('start_date')),
+            end=end + datetime.timedelta(days=1) if end else None,
+            windows_user=args.get('user') or None,
+            target_db=args.get('database') or None,
+            job_id=int(job_id) if job_id else None,
+        )
+
+
+def encode_cursor(row):
+    """Курсор страницы: ключ строки (timestamp, ранг источника, id)."""
+    return f"{row['timestamp']:%Y-%m-%dT%H:%M:%S.%f}_{_SOURCES[row['type_key']]['rank']}_{row['id']}"
+
+
+def decode_cursor(value):
+    if not value:
+        return None
+    try:
+        timestamp, rank, row_id = value.split('_')
+        return datetime.datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%f'), int(rank), int(row_id)
+    except ValueError:
+        raise ValueError(f"Неверный курсор страницы: {value}")
+
+
+def _source_query(log_type, flt, after, limit):
+    """SQL и параметры выборки одного источника или None, если источник не может дать строк; limit None — без TOP."""
+    source = _SOURCES[log_type]
+    columns = source['columns']
+    where, params = [], []
+    for field in ('windows_user', 'target_db', 'job_id'):
+        value = getattr(flt, field)
+        if value is None:
+            continue
+        if field not in columns:
+            return None
+        where.append(f"{columns[field]} = ?")
+        params.append(value)
+    ts, row_id = columns['timestamp'], columns['id']
+    if flt.start:
+        where.append(f"{ts} >= ?")
+        params.append(flt.start)
+    if flt.end:
+        where.append(f"{ts} < ?")
+        params.append(flt.end)
+    if after:
+        after_ts, after_rank, after_id = after
+        if source['rank'] > after_rank:
+            where.append(f"{ts} < ?")
+            params.append(after_ts)
+        elif source['rank'] == after_rank:
+            where.append(f"({ts} < ? OR ({ts} = ? AND {row_id} < ?))")
+            params += [after_ts, after_ts, after_id]
+        else:
+            where.append(f"{ts} <= ?")
+            params.append(after_ts)
+    top = "TOP (?) " if limit is not None else ""
+    sql = (f"SELECT {top}{source['select']} FROM {source['from']}"
+           + (f" WHERE {' AND '.join(where)}" if where else "")
+           + f" ORDER BY {ts} DESC, {row_id} DESC")
+    return sql, ([limit] if limit is not None else []) + params
+
+
+def _row(log_type, values):
+    width = len(COLUMNS) - 1
+    row = dict(zip(COLUMNS[1:], values[:width]))
+    for field, packed in zip(_SOURCES[log_type].get('packed', ()), values[width:]):
+        row[field] = unpack_text(row[field], packed)
+    row['type'] = _SOURCES[log_type]['label']
+    row['type_key'] = log_type
+    return row
+
+
+def query_logs(flt, before=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Страница журналов от новых к старым: {"rows": [...], "next_cursor": курсор следующей страницы или None}.
+    before — курсор из предыдущей страницы.
+    """
+    limit = max(1, min(int(limit or DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE))
+    after = decode_cursor(before) if isinstance(before, str) else before
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    streams = []
+    for log_type in flt.types:
+        query = _source_query(log_type, flt, after, limit + 1)
+        if query is None:
+            continue
+        cursor.execute(query[0], *query[1])
+        rank = _SOURCES[log_type]['rank']
+        streams.append([(row[1], rank, row[0], _row(log_type, row)) for row in cursor.fetchall()])
+    conn.close()
+
+    merged = heapq.merge(*streams, key=lambda item: item[:3], reverse=True)
+    rows = []
+    for item in merged:
+        if len(rows) == limit:
+            return {"rows": rows, "next_cursor": encode_cursor(rows[-1])}
+        rows.append(item[3])
+    return {"rows": rows, "next_cursor": None}
+
+
+def _stream_source(conn, log_type, query, batch_size):
+    cursor = conn.cursor()
+    cursor.execute(query[0], *query[1])
+    rank = _SOURCES[log_type]['rank']
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        for row in rows:
+            yield row[1], rank, row[0], _row(log_type, row)
+
+
+def stream_logs(flt, batch_size=STREAM_BATCH_SIZE):
+    """Все строки журналов по фильтру от новых к старым, с постоянным расходом памяти (для выгрузки)."""
+    connections = []
+    try:
+        streams = []
+        for log_type in flt.types:
+            query = _source_query(log_type, flt, None, None)
+            if query is None:
+                continue
+            conn = get_svc_conn()
+            connections.append(conn)
+            streams.append(_stream_source(conn, log_type, query, batch_size))
+        for item in heapq.merge(*streams, key=lambda item: item[:3], reverse=True):
+            yield item[3]
+    finally:
+        for conn in connections:
+            conn.close()
@@ -0,0 +1,226 @@
+# app/services/log_search.py
+"""
+Поиск по выводу 1С и ошибкам задач.
+
+Инвертированный индекс LogSearchIndex (термин -> документ) пополняется при записи журналов:
+log_1c_operation индексирует текст и ошибку строки OneCOperationLog (до сжатия в
+app/log_text.py), update_job_status — ошибку завершившейся задачи (RestoreJobs).
+Полнотекстовый индекс SQL Server здесь не подходит: длинные тексты хранятся сжатыми.
+
+Термин — слово в нижнем регистре с отброшенным русским окончанием (_stem), поэтому
+«лицензия не обнаружена» находит и «лицензии не обнаружено»; последнее слово запроса
+ищется ещё и как начало термина. Документ должен содержать все слова запроса. Оценка —
+сумма (1 + ln tf) * idf по словам, при равенстве выше более новые документы.
+
+Индекс секционирован по месяцам вместе с журналами и очищается вместе с ними
+(app/services/log_storage.py); rebuild_index перестраивает его за период.
+"""
+
+import datetime
+import math
+import re
+import time
+from collections import Counter
+
+from app.config_loader import get_svc_conn
+from app.log_text import unpack_text
+
+DOC_TYPES = ('1c', 'job')
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 100
+MAX_TERMS_PER_DOC = 2000
+MAX_QUERY_TERMS = 8
+MAX_TERM_LENGTH = 50
+SNIPPET_CHARS = 160
+# Окно поиска документа по времени: время из индекса не точнее времени строки журнала
+_TIME_WINDOW = datetime.timedelta(milliseconds=1)
+
+_WORD_RE = re.compile(r'\w{2,}')
+_CYRILLIC_RE = re.compile(r'[а-яё]')
+# Окончания, от длинных к коротким; отбрасывается первое подошедшее, если остаётся не меньше 4 букв
+_ENDINGS = sorted((
+    'ами', 'ями', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'ать', 'ять', 'ить', 'еть',
+    'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ый', 'ий', 'ой', 'ом', 'ем', 'ам', 'ям', 'ах', 'ях',
+    'ов', 'ев', 'ию', 'ия', 'ии', 'ей', 'ую', 'юю', 'на', 'но', 'ны', 'ен',
+    'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь',
+), key=len, reverse=True)
+
+
+def _stem(word):
+    if not _CYRILLIC_RE.search(word):
+        return word[:MAX_TERM_LENGTH]
+    for ending in _ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 4:
+            word = word[:-len(ending)]
+            break
+    return word[:MAX_TERM_LENGTH]
+
+
+def _terms(text):
+    return [_stem(word) for word in _WORD_RE.findall(text.lower().replace('ё', 'е'))]
+
+
+def index_document(cursor, doc_type, doc_id, job_id, target_db, timestamp, *texts):
+    """Добавляет термины текстов документа в индекс (в транзакции cursor); возвращает число терминов."""
+    counts = Counter()
+    for text in texts:
+        if text:
+            counts.update(_terms(text))
+    if not counts:
+        return 0
+    rows = [(term, timestamp, doc_type, doc_id, job_id, target_db, min(tf, 32767))
+            for term, tf in counts.most_common(MAX_TERMS_PER_DOC)]
+    cursor.fast_executemany = True
+    cursor.executemany("""
+        INSERT INTO LogSearchIndex (term, timestamp, doc_type, doc_id, job_id, target_db, tf)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+    return len(rows)
+
+
+def rebuild_index(start, end):
+    """Перестраивает индекс за период [start, end) по OneCOperationLog и ошибкам RestoreJobs."""
+    conn = get_svc_conn()
+    read_conn = get_svc_conn()
+    cursor = conn.cursor()
+    read_cursor = read_conn.cursor()
+    cursor.execute("DELETE FROM LogSearchIndex WHERE timestamp >= ? AND timestamp < ?", start, end)
+    documents = 0
+    read_cursor.execute("""
+        SELECT id, job_id, target_db, timestamp, log_text, error_message, log_text_gz, error_message_gz
+        FROM OneCOperationLog
+        WHERE timestamp >= ? AND timestamp < ?
+    """, start, end)
+    for row in read_cursor:
+        if index_document(cursor, '1c', row[0], row[1], row[2], row[3],
+                          unpack_text(row[4], row[6]), unpack_text(row[5], row[7])):
+            documents += 1
+    read_cursor.execute("""
+        SELECT id, job_id, target_db, started_at, error_message
+        FROM RestoreJobs
+        WHERE started_at >= ? AND started_at < ? AND error_message IS NOT NULL
+    """, start, end)
+    for row in read_cursor:
+        if index_document(cursor, 'job', row[0], row[1], row[2], row[3], row[4]):
+            documents += 1
+    conn.commit()
+    conn.close()
+    read_conn.close()
+    print(f"[log_search] индекс за {start:%d.%m.%Y}–{end:%d.%m.%Y} перестроен, документов: {documents}")
+    return documents
+
+
+def _snippet(text, words):
+    """Фрагмент текста вокруг первого найденного слова запроса."""
+    if not text:
+        return ''
+    lowered = text.lower().replace('ё', 'е')
+    positions = [lowered.find(word) for word in words if word in lowered]
+    center = min(positions) if positions else 0
+    start = max(center - SNIPPET_CHARS // 3, 0)
+    fragment = text[start:start + SNIPPET_CHARS].replace('\r', ' ').replace('\n', ' ')
+    return ('…' if start else '') + fragment + ('…' if start + SNIPPET_CHARS < len(text) else '')
+
+
+def _load_documents(cursor, hits, words):
+    """
+    Название и фрагмент текста для найденных документов. Строка ищется по id в окне
+    [время документа, + _TIME_WINDOW): это поиск по кластерному ключу (время, id), который
+    не зависит от точного совпадения времени из индекса с временем в журнале.
+    """
+    for doc_type, table, ts_column, columns in (
+            ('1c', 'OneCOperationLog', 'timestamp',
+             'id, operation, status, log_text, error_message, log_text_gz, error_message_gz'),
+            ('job', 'RestoreJobs', 'started_at', 'id, status, error_message')):
+        wanted = [hit for hit in hits if hit['doc_type'] == doc_type]
+        if not wanted:
+            continue
+        where = ' OR '.join(f"({ts_column} >= ? AND {ts_column} < ? AND id = ?)" for _ in wanted)
+        params = [value for hit in wanted
+                  for value in (hit['timestamp'], hit['timestamp'] + _TIME_WINDOW, hit['doc_id'])]
+        cursor.execute(f"SELECT {columns} FROM {table} WHERE {where}", *params)
+        by_id = {row[0]: row for row in cursor.fetchall()}
+        for hit in wanted:
+            row = by_id.get(hit['doc_id'])
+            if row is None:
+                continue
+            if doc_type == '1c':
+                error, text = unpack_text(row[4], row[6]), unpack_text(row[3], row[5])
+                hit['title'] = f"1С: {row[1]} ({row[2]})"
+                # Фрагмент — из ошибки, если слово найдено в ней, иначе из вывода 1С
+                if not error or not any(word in error.lower() for word in words):
+                    error = text or error
+                hit['snippet'] = _snippet(error, words)
+            else:
+                hit['title'] = f"Задача: {row[1]}"
+                hit['snippet'] = _snippet(row[2], words)
+
+
+def search_logs(query, flt=None, limit=DEFAULT_LIMIT):
+    """
+    Документы, содержащие все слова запроса, по убыванию оценки:
+    {"query", "terms", "hits": [{doc_type, doc_id, job_id, target_db, timestamp, score, title, snippet}], "seconds"}.
+    Из фильтра (LogFilter) учитываются период, база, задача и типы '1c'/'job'.
+    """
+    started = time.monotonic()
+    words = list(dict.fromkeys(_terms(query or '')))[:MAX_QUERY_TERMS]
+    result = {"query": query, "terms": words, "hits": [], "seconds": 0.0}
+    doc_types = [t for t in (flt.types if flt else DOC_TYPES) if t in DOC_TYPES]
+    if not words or not doc_types:
+        return result
+    limit = max(1, min(int(limit or DEFAULT_LIMIT), MAX_LIMIT))
+
+    filters = [f"doc_type IN ({', '.join('?' for _ in doc_types)})"]
+    filter_params = list(doc_types)
+    if flt is not None:
+        for condition, value in (("timestamp >= ?", flt.start), ("timestamp < ?", flt.end),
+                                 ("target_db = ?", flt.target_db), ("job_id = ?", flt.job_id)):
+            if value is not None:
+                filters.append(condition)
+                filter_params.append(value)
+    # Последнее слово — ещё и начало термина: запрос можно не дописывать
+    matches = [("term = ?", word) for word in words[:-1]]
+    matches.append(("term LIKE ?", words[-1].replace('[', '[[]').replace('_', '[_]') + '%'))
+
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT SUM(rows) FROM sys.partitions
+        WHERE object_id IN (OBJECT_ID('OneCOperationLog'), OBJECT_ID('RestoreJobs')) AND index_id IN (0, 1)
+    """)
+    total = cursor.fetchone()[0] or 1
+    weights = []
+    for condition, value in matches:
+        cursor.execute(f"SELECT COUNT(*) FROM LogSearchIndex WHERE {condition}", value)
+        df = cursor.fetchone()[0]
+        if not df:
+            conn.close()
+            result["seconds"] = round(time.monotonic() - started, 3)
+            return result
+        weights.append(math.log(1 + total / df))
+
+    parts, params = [], [limit]
+    for number, ((condition, value), weight) in enumerate(zip(matches, weights)):
+        parts.append(f"SELECT doc_type, doc_id, job_id, target_db, timestamp, {number} AS q, "
+                     f"(1 + LOG(tf)) * ? AS w FROM LogSearchIndex WHERE {condition} AND {' AND '.join(filters)}")
+        params += [weight, value] + filter_params
+    params.append(len(matches))
+    cursor.execute(f"""
+        SELECT TOP (?) doc_type, doc_id, job_id, target_db, timestamp, SUM(w) AS score
+        FROM (
+            SELECT doc_type, doc_id, job_id, target_db, timestamp, q, MAX(w) AS w
+            FROM ({' UNION ALL '.join(parts)}) p
+            GROUP BY doc_type, doc_id, job_id, target_db, timestamp, q
+        ) m
+        GROUP BY doc_type, doc_id, job_id, target_db, timestamp
+        HAVING COUNT(*) = ?
+        ORDER BY score DESC, timestamp DESC
+    """, *params)
+    hits = [{"doc_type": row[0], "doc_id": row[1], "job_id": row[2], "target_db": row[3],
+             "timestamp": row[4], "score": round(row[5], 3), "title": "", "snippet": ""}
+            for row in cursor.fetchall()]
+    _load_documents(cursor, hits, words)
+    conn.close()
+    result["hits"] = hits
+    result["seconds"] = round(time.monotonic() - started, 3)
+    return result
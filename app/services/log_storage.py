@@ -0,0 +1,276 @@
+# app/services/log_storage.py
+"""
+Помесячные секции журналов и их очистка по сроку хранения.
+
+AuthLog, UserActionsLog, OneCOperationLog, RestoreTaskLogs, RestoreJobs и JobPhases лежат на схеме
+секционирования PS_LogMonth (функция PF_LogMonth, RANGE RIGHT по первым числам месяцев,
+scripts/create_svc_db.sql). Кластерный ключ каждой таблицы — (время записи, id), поэтому
+выборка за период читает только свои секции, а все индексы выровнены по тем же секциям.
+
+Все операции здесь затрагивают только метаданные:
+  * ensure_partitions заранее добавляет пустые секции на MONTHS_AHEAD месяцев вперёд
+    (SPLIT пустой секции не перемещает строк);
+  * apply_log_retention очищает месяцы старше log_retention_months через
+    TRUNCATE ... WITH (PARTITIONS) либо, при log_archive_months > 0, переключает их
+    (SWITCH) в таблицы <журнал>_Archive с той же структурой, где они хранятся ещё
+    log_archive_months месяцев; затем опустевшие старые границы сливаются (MERGE).
+Поисковый индекс LogSearchIndex лежит на той же схеме и очищается вместе с журналами, без архива.
+TRUNCATE по секциям требует SQL Server 2016 и новее.
+
+apply_data_compression перестраивает журналы со сжатием страниц (log_data_compression:
+NONE, ROW или PAGE). Оно сжимает строки в страницах данных и индексах, но не тексты
+NVARCHAR(MAX), вынесенные из строки, — длинный вывод 1С сжимается отдельно (app/log_text.py).
+"""
+
+import datetime
+import time
+
+from app.config_loader import get_svc_conn, get_global_setting
+
+# журнал -> столбец секционирования
+LOG_TABLES = {
+    'AuthLog': 'timestamp',
+    'UserActionsLog': 'timestamp',
+    'OneCOperationLog': 'timestamp',
+    'RestoreTaskLogs': 'timestamp',
+    'RestoreJobs': 'started_at',
+    'JobPhases': 'started_at',
+}
+PARTITION_FUNCTION = 'PF_LogMonth'
+PARTITION_SCHEME = 'PS_LogMonth'
+# производные от журналов таблицы: очищаются вместе с журналами, но не архивируются
+INDEX_TABLES = {
+    'LogSearchIndex': 'timestamp',
+}
+ARCHIVE_SUFFIX = '_Archive'
+MONTHS_AHEAD = 2
+DEFAULT_RETENTION_MONTHS = 12
+COMPRESSION_MODES = ('NONE', 'ROW', 'PAGE')
+
+
+def _setting_int(key, default):
+    try:
+        return int(get_global_setting(key) or default)
+    except ValueError:
+        return default
+
+
+def _compression_mode():
+    mode = (get_global_setting('log_data_compression') or 'NONE').upper()
+    return mode if mode in COMPRESSION_MODES else 'NONE'
+
+
+def _all_tables():
+    return list(LOG_TABLES) + [table + ARCHIVE_SUFFIX for table in LOG_TABLES] + list(INDEX_TABLES)
+
+
+def _add_months(day, months):
+    month = day.month - 1 + months
+    return datetime.datetime(day.year + month // 12, month % 12 + 1, 1)
+
+
+def _month_start(day=None):
+    day = day or datetime.datetime.now()
+    return datetime.datetime(day.year, day.month, 1)
+
+
+def _boundaries(cursor):
+    """Границы PF_LogMonth по возрастанию; секция N (с 1) заканчивается перед границей N-1 (с 0)."""
+    cursor.execute("""
+        SELECT CAST(prv.value AS DATETIME2)
+        FROM sys.partition_range_values prv
+        JOIN sys.partition_functions pf ON pf.function_id = prv.function_id
+        WHERE pf.name = ?
+        ORDER BY prv.boundary_id
+    """, PARTITION_FUNCTION)
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _partition_rows(cursor, table):
+    """Строк по номерам секций; для отсутствующей таблицы — пусто."""
+    cursor.execute("""
+        SELECT partition_number, SUM(rows)
+        FROM sys.partitions
+        WHERE object_id = OBJECT_ID(?) AND index_id IN (0, 1)
+        GROUP BY partition_number
+    """, table)
+    return {row[0]: row[1] for row in cursor.fetchall()}
+
+
+def ensure_partitions(months_ahead=MONTHS_AHEAD):
+    """Добавляет границы до первого числа месяца через months_ahead; возвращает добавленные."""
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    boundaries = _boundaries(cursor)
+    target = _add_months(_month_start(), months_ahead)
+    added = []
+    next_boundary = _add_months(boundaries[-1], 1) if boundaries else _month_start()
+    while next_boundary <= target:
+        cursor.execute(f"ALTER PARTITION SCHEME {PARTITION_SCHEME} NEXT USED [PRIMARY]")
+        cursor.execute(f"ALTER PARTITION FUNCTION {PARTITION_FUNCTION}() SPLIT RANGE (?)", next_boundary)
+        added.append(next_boundary)
+        next_boundary = _add_months(next_boundary, 1)
+    conn.commit()
+    conn.close()
+    return added
+
+
+def _ensure_archive_table(cursor, table, column):
+    """Создаёт <table>_Archive с теми же столбцами и индексами на той же схеме секций (для SWITCH)."""
+    archive = table + ARCHIVE_SUFFIX
+    cursor.execute("SELECT OBJECT_ID(?)", archive)
+    if cursor.fetchone()[0] is not None:
+        return archive
+    compression = f"WITH (DATA_COMPRESSION = {_compression_mode()})"
+    cursor.execute(f"SELECT TOP (0) * INTO {archive} FROM {table}")
+    cursor.execute(f"CREATE UNIQUE CLUSTERED INDEX PK_{archive} ON {archive} ({column}, id) "
+                   f"{compression} ON {PARTITION_SCHEME}({column})")
+    # Некластерные индексы копируются из журнала: без них секцию нельзя переключить
+    cursor.execute("""
+        SELECT i.name, c.name, ic.key_ordinal, ic.is_descending_key, ic.is_included_column
+        FROM sys.indexes i
+        JOIN sys.index_columns ic ON ic.object_id = i.object_id AND ic.index_id = i.index_id
+        JOIN sys.columns c ON c.object_id = ic.object_id AND c.column_id = ic.column_id
+        WHERE i.object_id = OBJECT_ID(?) AND i.type = 2
+        ORDER BY i.name, ic.key_ordinal, ic.index_column_id
+    """, table)
+    indexes = {}
+    for index_name, column_name, key_ordinal, descending, included in cursor.fetchall():
+        keys, includes = indexes.setdefault(index_name, ([], []))
+        if included:
+            includes.append(column_name)
+        elif key_ordinal > 0:
+            keys.append(column_name + (' DESC' if descending else ''))
+    for index_name, (keys, includes) in indexes.items():
+        include_sql = f" INCLUDE ({', '.join(includes)})" if includes else ""
+        cursor.execute(f"CREATE INDEX {index_name} ON {archive} ({', '.join(keys)}){include_sql} "
+                       f"{compression} ON {PARTITION_SCHEME}({column})")
+    print(f"[log_storage] создана архивная таблица {archive}")
+    return archive
+
+
+def apply_log_retention():
+    """
+    Очищает или архивирует месяцы журналов старше log_retention_months, удаляет
+    просроченные месяцы архива и сливает пустые старые границы.
+    Возвращает {таблица: строк очищено/перенесено}.
+    """
+    retention_months = _setting_int('log_retention_months', DEFAULT_RETENTION_MONTHS)
+    archive_months = _setting_int('log_archive_months', 0)
+    ensure_partitions()
+    if retention_months <= 0:
+        return {}
+    cutoff = _add_months(_month_start(), -retention_months)
+    archive_cutoff = _add_months(cutoff, -archive_months)
+
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    boundaries = _boundaries(cursor)
+    # Секция n заканчивается перед границей boundaries[n - 1]
+    def expired(before):
+        return [n for n in range(1, len(boundaries) + 1) if boundaries[n - 1] <= before]
+
+    summary = {}
+    for table, column in LOG_TABLES.items():
+        rows = _partition_rows(cursor, table)
+        for number in expired(cutoff):
+            count = rows.get(number, 0)
+            if not count:
+                continue
+            if archive_months > 0:
+                archive = _ensure_archive_table(cursor, table, column)
+                cursor.execute(f"ALTER TABLE {table} SWITCH PARTITION {number} TO {archive} PARTITION {number}")
+            else:
+                cursor.execute(f"TRUNCATE TABLE {table} WITH (PARTITIONS ({number}))")
+            summary[table] = summary.get(table, 0) + count
+        archive_rows = _partition_rows(cursor, table + ARCHIVE_SUFFIX)
+        for number in expired(archive_cutoff):
+            if archive_rows.get(number):
+                cursor.execute(f"TRUNCATE TABLE {table}{ARCHIVE_SUFFIX} WITH (PARTITIONS ({number}))")
+                summary[table + ARCHIVE_SUFFIX] = summary.get(table + ARCHIVE_SUFFIX, 0) + archive_rows[number]
+    for table in INDEX_TABLES:
+        rows = _partition_rows(cursor, table)
+        for number in expired(cutoff):
+            if rows.get(number):
+                cursor.execute(f"TRUNCATE TABLE {table} WITH (PARTITIONS ({number}))")
+                summary[table] = summary.get(table, 0) + rows[number]
+    conn.commit()
+
+    # Слияние самой старой границы объединяет секции 1 и 2 — без перемещения строк, если обе пусты везде
+    tables = _all_tables()
+    merged = 0
+    while len(boundaries) > 1 and boundaries[1] <= archive_cutoff:
+        counts = [_partition_rows(cursor, table) for table in tables]
+        if any(rows.get(1) or rows.get(2) for rows in counts):
+            break
+        cursor.execute(f"ALTER PARTITION FUNCTION {PARTITION_FUNCTION}() MERGE RANGE (?)", boundaries[0])
+        conn.commit()
+        boundaries.pop(0)
+        merged += 1
+    conn.close()
+    print(f"[log_storage] очистка журналов до {cutoff:%m.%Y}: {summary or 'нечего очищать'}, слито границ: {merged}")
+    return summary
+
+
+def get_partition_report():
+    """Строк по месяцам для каждого журнала и архива: [{month, <таблица>: строк, ...}] от новых к старым."""
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    boundaries = _boundaries(cursor)
+    by_table = {}
+    for table in _all_tables():
+        rows = _partition_rows(cursor, table)
+        if rows:
+            by_table[table] = rows
+    conn.close()
+
+    report = []
+    for number in range(1, len(boundaries) + 2):
+        month = boundaries[number - 2] if number > 1 else None
+        item = {"month": f"{month:%Y-%m}" if month else f"до {boundaries[0]:%Y-%m}" if boundaries else "все"}
+        item.update({table: rows.get(number, 0) for table, rows in by_table.items()})
+        report.append(item)
+    report.reverse()
+    return report
+
+
+def get_data_compression():
+    """Текущее сжатие страниц журналов: {таблица: NONE/ROW/PAGE} (по кластерному индексу)."""
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    result = {}
+    for table in _all_tables():
+        cursor.execute("""
+            SELECT MAX(data_compression_desc) FROM sys.partitions
+            WHERE object_id = OBJECT_ID(?) AND index_id IN (0, 1)
+        """, table)
+        row = cursor.fetchone()
+        if row and row[0]:
+            result[table] = row[0]
+    conn.close()
+    return result
+
+
+def apply_data_compression(mode=None):
+    """
+    Перестраивает все индексы журналов и архивов с DATA_COMPRESSION = mode и сохраняет mode
+    в log_data_compression. Перестройка переписывает таблицы целиком — это не операция
+    над метаданными, её стоит запускать вне рабочего времени. Возвращает get_data_compression().
+    """
+    mode = (mode or _compression_mode()).upper()
+    if mode not in COMPRESSION_MODES:
+        raise ValueError(f"Неизвестный режим сжатия: {mode}")
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    for table in _all_tables():
+        cursor.execute("SELECT OBJECT_ID(?)", table)
+        if cursor.fetchone()[0] is None:
+            continue
+        started = time.monotonic()
+        cursor.execute(f"ALTER INDEX ALL ON {table} REBUILD PARTITION = ALL WITH (DATA_COMPRESSION = {mode})")
+        conn.commit()
+        print(f"[log_storage] {table}: DATA_COMPRESSION = {mode} за {time.monotonic() - started:.0f} с")
+    cursor.execute("UPDATE GlobalSettings SET setting_value = ? WHERE setting_key = 'log_data_compression'", mode)
+    conn.commit()
+    conn.close()
+    return get_data_compression()
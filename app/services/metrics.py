@@ -0,0 +1,157 @@
+# app/services/metrics.py
+"""
+Метрики очереди задач для Prometheus (/metrics, текстовый формат 0.0.4).
+
+Счётчики и гистограммы живут в памяти процесса: запись — обновление словаря под одной
+блокировкой, без обращений к БД и без сторонних библиотек. Каждый процесс отдаёт свои
+значения с момента запуска; суммирование по процессам и rate() — на стороне Prometheus.
+
+При выдаче (render) к ним добавляются снимки:
+  * глубина очереди RestoreQueue по статусу и типу и пределы слотов типов — один запрос;
+  * занятость пулов запуска 1С и счётчики команд (app/services/onec_executor.py).
+"""
+
+import math
+import threading
+
+PREFIX = 'restore_portal_'
+WAIT_BUCKETS = (5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200)              # seconds
+RUN_BUCKETS = (30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400)         # seconds
+
+# имя -> (тип, описание[, границы корзин])
+METRICS = {
+    'jobs_enqueued_total': ('counter', 'Задач добавлено в очередь'),
+    'jobs_claimed_total': ('counter', 'Задач взято воркером'),
+    'jobs_completed_total': ('counter', 'Задач завершено успешно'),
+    'jobs_failed_total': ('counter', 'Задач завершено с ошибкой'),
+    'jobs_active': ('gauge', 'Задач выполняется в этом процессе'),
+    'job_wait_seconds': ('histogram', 'Ожидание задачи в очереди до захвата', WAIT_BUCKETS),
+    'job_run_seconds': ('histogram', 'Время выполнения задачи', RUN_BUCKETS),
+}
+
+_lock = threading.Lock()
+_values = {}       # (имя, метки) -> значение счётчика/показателя
+_histograms = {}   # (имя, метки) -> [счётчики корзин..., сумма, количество]
+
+
+def _key(name, labels):
+    return name, tuple(sorted((labels or {}).items()))
+
+
+def inc(name, labels=None, value=1):
+    """Увеличивает счётчик (или показатель при отрицательном value)."""
+    key = _key(name, labels)
+    with _lock:
+        _values[key] = _values.get(key, 0) + value
+
+
+def observe(name, value, labels=None):
+    """Добавляет наблюдение в гистограмму."""
+    if value is None or value < 0:
+        return
+    buckets = METRICS[name][2]
+    key = _key(name, labels)
+    with _lock:
+        data = _histograms.get(key)
+        if data is None:
+            data = _histograms[key] = [0] * (len(buckets) + 2)
+        # Корзины накопительные, как в формате Prometheus: наблюдение попадает во все границы >= value
+        for position, bound in enumerate(buckets):
+            if value <= bound:
+                data[position] += 1
+        data[-2] += value
+        data[-1] += 1
+
+
+def observe_job(job, source_db, run_seconds):
+    """Учитывает выполненную задачу: ожидание в очереди (по времени захвата) и длительность."""
+    labels = {'job_type': job.get('job_type') or 'restore', 'source_db': source_db or ''}
+    if job.get('created_at') and job.get('started_at'):
+        observe('job_wait_seconds', (job['started_at'] - job['created_at']).total_seconds(), labels)
+    observe('job_run_seconds', run_seconds, labels)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels_text(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in items) + '}'
+
+
+def _number(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+def _family(lines, name, kind, help_text, samples):
+    """samples: [(метки, значение)] или для гистограмм [(метки, данные)]."""
+    full = PREFIX + name
+    lines.append(f"# HELP {full} {help_text}")
+    lines.append(f"# TYPE {full} {kind}")
+    for labels, value in samples:
+        if kind == 'histogram':
+            for bound, count in zip(METRICS[name][2], value):
+                lines.append(f"{full}_bucket{_labels_text(labels, [('le', _number(float(bound)))])} {count}")
+            lines.append(f"{full}_bucket{_labels_text(labels, [('le', '+Inf')])} {value[-1]}")
+            lines.append(f"{full}_sum{_labels_text(labels)} {_number(float(value[-2]))}")
+            lines.append(f"{full}_count{_labels_text(labels)} {value[-1]}")
+        else:
+            lines.append(f"{full}{_labels_text(labels)} {_number(value)}")
+
+
+def _queue_snapshot(lines):
+    from app.config_loader import get_svc_conn
+    from app.services.job_queue import get_type_limits
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("SELECT status, job_type, COUNT(*) FROM RestoreQueue "
+                   "WHERE status IN ('pending', 'running') GROUP BY status, job_type")
+    depth = [((('job_type', job_type), ('status', status)), count) for status, job_type, count in cursor.fetchall()]
+    conn.close()
+    _family(lines, 'queue_jobs', 'gauge', 'Задач в очереди по статусу (все процессы)', depth)
+    _family(lines, 'job_type_slots', 'gauge', 'Предел одновременных задач типа',
+            [((('job_type', job_type),), limit) for job_type, limit in get_type_limits().items()])
+
+
+def _executor_snapshot(lines):
+    from app.services.onec_executor import get_command_metrics, get_pool_usage
+    pools = get_pool_usage()
+    _family(lines, 'onec_pool_in_use', 'gauge', 'Занято слотов пула запуска 1С',
+            [((('pool', pool),), usage['in_use']) for pool, usage in pools.items()])
+    _family(lines, 'onec_pool_limit', 'gauge', 'Размер пула запуска 1С',
+            [((('pool', pool),), usage['limit']) for pool, usage in pools.items()])
+    commands = get_command_metrics()
+    for name, field, help_text in (
+            ('onec_commands_total', 'count', 'Запусков команд 1С'),
+            ('onec_command_errors_total', 'errors', 'Команд 1С с ненулевым кодом возврата'),
+            ('onec_command_timeouts_total', 'timeouts', 'Команд 1С, прерванных по таймауту'),
+            ('onec_command_seconds_total', 'total_seconds', 'Суммарное время выполнения команд 1С'),
+            ('onec_command_wait_seconds_total', 'total_wait_seconds', 'Суммарное ожидание слота пула')):
+        _family(lines, name, 'counter', help_text,
+                [((('command', label),), item[field]) for label, item in sorted(commands.items())])
+
+
+def render():
+    """Все метрики процесса в текстовом формате Prometheus."""
+    with _lock:
+        values = dict(_values)
+        histograms = {key: list(data) for key, data in _histograms.items()}
+    lines = []
+    for name, spec in METRICS.items():
+        kind, help_text = spec[0], spec[1]
+        source = histograms if kind == 'histogram' else values
+        _family(lines, name, kind, help_text,
+                [(labels, value) for (metric, labels), value in sorted(source.items()) if metric == name])
+    for snapshot in (_queue_snapshot, _executor_snapshot):
+        try:
+            snapshot(lines)
+        except Exception as e:
+            print(f"[metrics] снимок {snapshot.__name__} не получен: {e}")
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,315 @@
+# app/services/onec_executor.py
+"""
+Единый движок запуска внешних программ 1С (1cv8.exe, rac.exe) на asyncio.
+
+Все процессы выполняются в отдельном фоновом event loop. Движок:
+- ограничивает число одновременных запусков на сервер приложений и по лицензиям;
+- прерывает зависшие процессы по таймауту вместе со всем деревом дочерних процессов;
+- читает stdout/stderr блоками (строка любой длины не ломает чтение) и пишет их в лог
+  задачи (RestoreTaskLogs) пачками раз в LOG_FLUSH_INTERVAL, одним подключением на пачку;
+- при любой ошибке ожидания (не только по таймауту) останавливает дерево процессов;
+- собирает метрики длительности по каждой команде и занятость пулов (для /metrics).
+"""
+
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+DEFAULT_TIMEOUT = 3600            # seconds
+DEFAULT_MAX_PER_SERVER = 2        # одновременных 1cv8 на один сервер приложений
+DEFAULT_MAX_LICENSES = 4          # одновременных 1cv8 всего (клиентские лицензии)
+DEFAULT_RAC_MAX_PARALLEL = 8      # одновременных rac на один сервер
+OUTPUT_ENCODING = 'utf-8'
+READ_CHUNK = 64 * 1024            # bytes: блок чтения stdout/stderr
+LOG_FLUSH_INTERVAL = 1.0          # seconds: как часто накопленный вывод пишется в лог задачи
+
+_loop = None
+_loop_thread = None
+_loop_lock = threading.Lock()
+_limits = None
+_semaphores = {}
+_pool_usage = {}  # ключ семафора -> [занято, предел]; меняется только в потоке event loop
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+class CommandTimeoutError(TimeoutError):
+    """Процесс не завершился за отведённое время и был принудительно остановлен."""
+
+
+def read_executor_config():
+    """
+    Читает лимиты движка из GlobalSettings.
+    Если настройка не задана или БД недоступна — используются значения по умолчанию.
+    """
+    limits = {
+        'timeout': DEFAULT_TIMEOUT,
+        'max_per_server': DEFAULT_MAX_PER_SERVER,
+        'max_licenses': DEFAULT_MAX_LICENSES,
+        'rac_max_parallel': DEFAULT_RAC_MAX_PARALLEL,
+    }
+    settings = {
+        'timeout': 'onec_command_timeout',
+        'max_per_server': 'onec_max_per_server',
+        'max_licenses': 'onec_max_licenses',
+        'rac_max_parallel': 'rac_max_parallel',
+    }
+    try:
+        from app.config_loader import get_global_setting
+        for name, key in settings.items():
+            try:
+                value = get_global_setting(key)
+                if value:
+                    limits[name] = int(value)
+            except Exception:
+                pass
+    except Exception:
+        pass
+    return limits
+
+
+def _get_limits():
+    global _limits
+    if _limits is None:
+        _limits = read_executor_config()
+    return _limits
+
+
+def _ensure_loop():
+    """Запускает фоновый event loop (один на процесс), если он ещё не запущен."""
+    global _loop, _loop_thread
+    with _loop_lock:
+        if _loop is not None and _loop_thread is not None and _loop_thread.is_alive():
+            return _loop
+        loop = asyncio.new_event_loop()
+
+        def _run():
+            asyncio.set_event_loop(loop)
+            loop.run_forever()
+
+        _loop_thread = threading.Thread(target=_run, name='onec-executor', daemon=True)
+        _loop_thread.start()
+        _loop = loop
+        print("[onec_executor] event loop запущен")
+        return _loop
+
+
+def _semaphore(key, limit):
+    """Возвращает семафор по ключу; вызывается только из потока event loop."""
+    sem = _semaphores.get(key)
+    if sem is None:
+        sem = asyncio.Semaphore(max(1, limit))
+        _semaphores[key] = sem
+        _pool_usage[key] = [0, max(1, limit)]
+    return sem
+
+
+def get_pool_usage():
+    """Снимок занятости пулов: {'server:<имя>' | 'license' | 'rac:<имя>': {in_use, limit}}."""
+    return {':'.join(key): {'in_use': usage[0], 'limit': usage[1]} for key, usage in list(_pool_usage.items())}
+
+
+def _kill_process_tree(pid):
+    """Принудительно завершает процесс и всех его потомков."""
+    try:
+        if sys.platform == 'win32':
+            subprocess.run(['taskkill', '/F', '/T', '/PID', str(pid)],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        else:
+            os.killpg(os.getpgid(pid), signal.SIGKILL)
+    except Exception as e:
+        print(f"[onec_executor] не удалось завершить дерево процессов {pid}: {e}")
+
+
+def _record_metric(label, elapsed, wait, status):
+    with _metrics_lock:
+        m = _metrics.setdefault(label, {
+            'count': 0, 'errors': 0, 'timeouts': 0,
+            'total_seconds': 0.0, 'max_seconds': 0.0, 'last_seconds': 0.0,
+            'total_wait_seconds': 0.0,
+        })
+        m['count'] += 1
+        if status == 'error':
+            m['errors'] += 1
+        elif status == 'timeout':
+            m['timeouts'] += 1
+        m['total_seconds'] += elapsed
+        m['last_seconds'] = elapsed
+        m['max_seconds'] = max(m['max_seconds'], elapsed)
+        m['total_wait_seconds'] += wait
+
+
+def get_command_metrics():
+    """Возвращает снимок метрик: {label: {count, errors, timeouts, avg_seconds, ...}}."""
+    with _metrics_lock:
+        result = {}
+        for label, m in _metrics.items():
+            item = dict(m)
+            item['avg_seconds'] = m['total_seconds'] / m['count'] if m['count'] else 0.0
+            result[label] = item
+        return result
+
+
+class _JobLog:
+    """Вывод процесса для лога задачи: строки копятся в потоке event loop и пишутся пачкой."""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.pending = []
+
+    def __call__(self, stream_name, line):
+        self.pending.append(line if stream_name == 'stdout' else f"[stderr] {line}")
+
+    def take(self):
+        lines, self.pending = self.pending, []
+        return lines
+
+    def write(self, lines):
+        from app.logger_db import log_task_messages
+        try:
+            log_task_messages(self.job_id, lines)
+        except Exception as e:
+            print(f"[onec_executor] не удалось записать лог задачи {self.job_id}: {e}")
+
+
+async def _flush_job_log(job_log, done):
+    """Пишет накопленный вывод раз в LOG_FLUSH_INTERVAL и последний раз после завершения процесса."""
+    loop = asyncio.get_running_loop()
+    finished = False
+    while not finished:
+        try:
+            await asyncio.wait_for(done.wait(), timeout=LOG_FLUSH_INTERVAL)
+            finished = True
+        except asyncio.TimeoutError:
+            pass
+        lines = job_log.take()
+        if lines:
+            await loop.run_in_executor(None, job_log.write, lines)
+
+
+async def _pump(stream, stream_name, lines, on_output, job_log):
+    """Читает поток блоками и делит на строки сам: у readline() предел длины строки (64 КБ)."""
+    loop = asyncio.get_running_loop()
+    tail = b''
+    while True:
+        chunk = await stream.read(READ_CHUNK)
+        if chunk:
+            *complete, tail = (tail + chunk).split(b'\n')
+        else:
+            complete, tail = ([tail] if tail else []), b''
+        for raw in complete:
+            line = raw.decode(OUTPUT_ENCODING, errors='replace').rstrip('\r')
+            lines.append(line)
+            if line and job_log:
+                job_log(stream_name, line)
+            if line and on_output:
+                await loop.run_in_executor(None, on_output, stream_name, line)
+        if not chunk:
+            break
+
+
+async def run_command_async(args, kind='1cv8', server=None, timeout=None, label=None,
+                            job_id=None, on_output=None):
+    """
+    Запускает процесс и ждёт завершения с учётом лимитов.
+    kind: '1cv8' — занимает слот сервера приложений и лицензию; 'rac' — слот rac на сервере.
+    Возвращает dict: returncode, stdout, stderr, elapsed, wait.
+    При превышении таймаута убивает дерево процессов и выбрасывает CommandTimeoutError.
+    """
+    limits = _get_limits()
+    timeout = timeout or limits['timeout']
+    label = label or f"{kind}:{os.path.basename(str(args[0]))}"
+    server_key = server or 'default'
+    job_log = _JobLog(job_id) if on_output is None and job_id is not None else None
+
+    if kind == 'rac':
+        pool_keys = [('rac', server_key)]
+        semaphores = [_semaphore(pool_keys[0], limits['rac_max_parallel'])]
+    else:
+        pool_keys = [('server', server_key), ('license',)]
+        semaphores = [_semaphore(pool_keys[0], limits['max_per_server']),
+                      _semaphore(pool_keys[1], limits['max_licenses'])]
+
+    queued_at = time.monotonic()
+    acquired = []
+    try:
+        for key, sem in zip(pool_keys, semaphores):
+            await sem.acquire()
+            acquired.append((key, sem))
+            _pool_usage[key][0] += 1
+        wait = time.monotonic() - queued_at
+        started_at = time.monotonic()
+        kwargs = {}
+        if sys.platform == 'win32':
+            kwargs['creationflags'] = subprocess.CREATE_NEW_PROCESS_GROUP
+        else:
+            kwargs['start_new_session'] = True
+        proc = await asyncio.create_subprocess_exec(
+            *[str(a) for a in args],
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            **kwargs
+        )
+        stdout_lines, stderr_lines = [], []
+        log_done = asyncio.Event()
+        flusher = asyncio.ensure_future(_flush_job_log(job_log, log_done)) if job_log else None
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(
+                    _pump(proc.stdout, 'stdout', stdout_lines, on_output, job_log),
+                    _pump(proc.stderr, 'stderr', stderr_lines, on_output, job_log),
+                    proc.wait(),
+                ),
+                timeout=timeout
+            )
+        except BaseException as e:
+            # Таймаут, ошибка чтения вывода или отмена: процесс не должен остаться жить
+            # с неразбираемыми каналами, поэтому дерево останавливается в любом случае
+            if proc.returncode is None:
+                _kill_process_tree(proc.pid)
+                try:
+                    await asyncio.wait_for(proc.wait(), timeout=30)
+                except asyncio.TimeoutError:
+                    pass
+            elapsed = time.monotonic() - started_at
+            timed_out = isinstance(e, asyncio.TimeoutError)
+            _record_metric(label, elapsed, wait, 'timeout' if timed_out else 'error')
+            if timed_out:
+                raise CommandTimeoutError(f"{label}: процесс не завершился за {timeout} с и был остановлен")
+            raise
+        finally:
+            if flusher:
+                log_done.set()
+                await flusher
+
+        elapsed = time.monotonic() - started_at
+        _record_metric(label, elapsed, wait, 'ok' if proc.returncode == 0 else 'error')
+        return {
+            'returncode': proc.returncode,
+            'stdout': '\n'.join(stdout_lines),
+            'stderr': '\n'.join(stderr_lines),
+            'elapsed': elapsed,
+            'wait': wait,
+        }
+    finally:
+        for key, sem in reversed(acquired):
+            _pool_usage[key][0] -= 1
+            sem.release()
+
+
+def run_coroutine(coro):
+    """Выполняет корутину в фоновом event loop движка и возвращает её результат."""
+    loop = _ensure_loop()
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+def run_command(args, kind='1cv8', server=None, timeout=None, label=None, job_id=None, on_output=None):
+    """Синхронная обёртка над run_command_async для вызова из рабочих потоков."""
+    return run_coroutine(run_command_async(
+        args, kind=kind, server=server, timeout=timeout, label=label,
+        job_id=job_id, on_output=on_output
+    ))
@@ -0,0 +1,287 @@
+# app/services/prestage.py
+"""
+Предсказание восстановлений и подготовка к ним заранее (pre-staging).
+
+Запросы восстановления повторяются: одни и те же пользователи обновляют одни и те же
+базы по утрам рабочих дней. По истории RestoreQueue за prestage_history_days для каждой
+целевой базы оценивается вероятность запроса в день прогноза:
+  * доля таких же дней недели с запросом, с затуханием по давности (полураспад
+    HALF_LIFE_DAYS) — основной вклад (WEEKDAY_SHARE);
+  * доля всех дней окна с запросом — поправка для баз без недельного ритма.
+
+После daily_backup plan_prestage записывает в PrestagePredictions базы с оценкой
+не ниже prestage_min_score (не больше prestage_max_targets). Воркер, когда в очереди
+нет ни ожидающих, ни выполняющихся задач, выполняет план в одном фоновом потоке (run_due_prestage):
+  * находит бэкап источника и проверяет его файлы, прогревает кэш кластера 1С;
+  * копирует бэкап в staging (если задан staging_path);
+  * при prestage_storage = 1 заранее выгружает конфигурацию хранилища в общий кэш.
+Как только в очереди появляются задачи, подготовка уступает им до следующего простоя:
+копирование в staging не должно делить сеть и диск с идущими RESTORE.
+
+Запрос восстановления отмечает попадание прогноза (record_prestage_hit);
+точность и полноту прогнозов по дням возвращает get_prestage_stats.
+"""
+
+import datetime
+import threading
+import time
+from collections import defaultdict
+
+from app.config_loader import get_svc_conn, get_global_setting, get_db_config
+from app.backup_resolver import resolve_backup
+from app.cluster_cache import get_cluster_info
+from app.services.backup_staging import staged_backup
+
+DEFAULT_HISTORY_DAYS = 56
+DEFAULT_MIN_SCORE = 0.3
+DEFAULT_MAX_TARGETS = 10
+HALF_LIFE_DAYS = 21
+WEEKDAY_SHARE = 0.7
+CHECK_INTERVAL = 60  # seconds: как часто воркер при простое проверяет план
+
+_thread = None
+_last_check = 0.0
+_guard = threading.Lock()
+
+
+def _setting(key, default):
+    value = get_global_setting(key)
+    return float(value) if value not in (None, '') else default
+
+
+def prediction_date(now=None):
+    """День прогноза: после полудня готовимся к завтрашнему утру, до полудня — к сегодняшнему."""
+    now = now or datetime.datetime.now()
+    return now.date() if now.hour < 12 else now.date() + datetime.timedelta(days=1)
+
+
+def predict_targets(predicted_for=None):
+    """
+    Оценки вероятности запроса по целевым базам на день predicted_for, по убыванию:
+    [{target_db, windows_user, score, expected_hour}].
+    """
+    predicted_for = predicted_for or prediction_date()
+    history_days = int(_setting('prestage_history_days', DEFAULT_HISTORY_DAYS))
+    first_day = predicted_for - datetime.timedelta(days=history_days)
+
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT target_db, CAST(created_at AS DATE), MIN(DATEPART(hour, created_at)), MAX(windows_user)
+        FROM RestoreQueue
+        WHERE job_type = 'restore' AND created_at >= ? AND created_at < ?
+        GROUP BY target_db, CAST(created_at AS DATE)
+    """, first_day, predicted_for)
+    requests = defaultdict(dict)  # target -> {день: (час первого запроса, пользователь)}
+    for target_db, day, hour, windows_user in cursor.fetchall():
+        requests[target_db][day] = (hour, windows_user)
+    conn.close()
+
+    def weight(day):
+        return 0.5 ** ((predicted_for - day).days / HALF_LIFE_DAYS)
+
+    weekday = predicted_for.weekday()
+    window = [first_day + datetime.timedelta(days=n) for n in range(history_days)]
+    total_all = sum(weight(day) for day in window) or 1
+    total_same = sum(weight(day) for day in window if day.weekday() == weekday) or 1
+
+    predictions = []
+    for target_db, by_day in requests.items():
+        same_days = [day for day in by_day if day.weekday() == weekday]
+        score = (WEEKDAY_SHARE * sum(weight(day) for day in same_days) / total_same
+                 + (1 - WEEKDAY_SHARE) * sum(weight(day) for day in by_day) / total_all)
+        hours = sorted(by_day[day][0] for day in (same_days or by_day))
+        predictions.append({
+            "target_db": target_db,
+            "windows_user": by_day[max(by_day)][1],  # последний запросивший — его доступ к базе
+            "score": round(score, 3),
+            "expected_hour": hours[len(hours) // 2],
+        })
+    predictions.sort(key=lambda p: p["score"], reverse=True)
+    return predictions
+
+
+def plan_prestage(predicted_for=None):
+    """Записывает в PrestagePredictions базы, к запросу которых стоит подготовиться; возвращает их."""
+    predicted_for = predicted_for or prediction_date()
+    min_score = _setting('prestage_min_score', DEFAULT_MIN_SCORE)
+    max_targets = int(_setting('prestage_max_targets', DEFAULT_MAX_TARGETS))
+    planned = [p for p in predict_targets(predicted_for) if p["score"] >= min_score][:max_targets]
+
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    for p in planned:
+        cursor.execute("""
+            IF NOT EXISTS (SELECT 1 FROM PrestagePredictions WHERE predicted_for = ? AND target_db = ?)
+                INSERT INTO PrestagePredictions (predicted_for, target_db, windows_user, score, expected_hour)
+                VALUES (?, ?, ?, ?, ?)
+        """, predicted_for, p["target_db"], predicted_for, p["target_db"], p["windows_user"], p["score"], p["expected_hour"])
+    conn.commit()
+    conn.close()
+    print(f"[prestage] на {predicted_for:%d.%m.%Y} запланировано баз: {len(planned)}")
+    return planned
+
+
+def _claim_next():
+    """Атомарно берёт следующую запланированную подготовку (ближайший день, самая вероятная база)."""
+    conn = get_svc_conn()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            WITH next_item AS (
+                SELECT TOP (1) *
+                FROM PrestagePredictions WITH (UPDLOCK, READPAST, ROWLOCK)
+                WHERE status = 'planned' AND predicted_for >= CAST(GETDATE() AS DATE)
+                ORDER BY predicted_for, score DESC
+            )
+            UPDATE next_item SET status = 'running'
+            OUTPUT INSERTED.id, INSERTED.target_db, INSERTED.windows_user
+        """)
+        row = cursor.fetchone()
+        conn.commit()
+        return row
+    finally:
+        conn.close()
+
+
+def _queue_busy():
+    """Очередь занята, если есть ожидающие или выполняющиеся задачи: подготовка не делит с ними диск и сеть."""
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*) FROM RestoreQueue WHERE status IN ('pending', 'running')")
+    busy = cursor.fetchone()[0] > 0
+    conn.close()
+    return busy
+
+
+def _prepare(target_db, windows_user):
+    """Выполняет подготовку к восстановлению базы; возвращает описание сделанного."""
+    db_config = get_db_config(target_db, windows_user)
+    if not db_config:
+        raise RuntimeError(f"У {windows_user} больше нет доступа к {target_db}")
+    chain = resolve_backup(db_config['source_db'])
+    if not chain:
+        raise RuntimeError(f"Нет бэкапа источника {db_config['source_db']}")
+    get_cluster_info(target_db)
+    done = [f"бэкап {db_config['source_db']}: наборов {len(chain)}"]
+
+    if get_global_setting('staging_path'):
+        with staged_backup(chain) as (staged, error):
+            if error:
+                raise RuntimeError(f"Staging не удался: {error}")
+            if staged != chain:
+                done.append("скопирован в staging")
+
+    if get_global_setting('prestage_storage') == '1' and db_config.get('use_storage') and db_config.get('storage_path'):
+        from app.services.storage_cache import get_storage_artifact
+        _, version = get_storage_artifact(
+            db_config['storage_path'], db_config.get('extension_name', ''),
+            db_config.get('storage_user'), db_config.get('storage_password'),
+            target_db, db_config.get('app_login'), db_config.get('app_password'))
+        done.append(f"выгрузка хранилища {version}")
+    return ', '.join(done)
+
+
+def run_prestage():
+    """Выполняет запланированные подготовки, пока очередь восстановлений пуста."""
+    prepared = 0
+    while True:
+        if _queue_busy():
+            print("[prestage] в очереди есть ожидающие или выполняющиеся задачи, подготовка отложена")
+            break
+        item = _claim_next()
+        if not item:
+            break
+        item_id, target_db, windows_user = item
+        started = time.monotonic()
+        try:
+            details, status = _prepare(target_db, windows_user), 'done'
+            prepared += 1
+        except Exception as e:
+            details, status = str(e), 'failed'
+        conn = get_svc_conn()
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE PrestagePredictions
+            SET status = ?, details = ?, prepared_at = GETDATE(), prepare_seconds = ?
+            WHERE id = ?
+        """, status, details, time.monotonic() - started, item_id)
+        conn.commit()
+        conn.close()
+        print(f"[prestage] {target_db}: {status} ({details})")
+    return prepared
+
+
+def run_due_prestage():
+    """Вызывается воркером при пустой очереди: запускает run_prestage в фоне, если он ещё не идёт."""
+    global _thread, _last_check
+    with _guard:
+        if _thread is not None and _thread.is_alive():
+            return
+        if time.monotonic() - _last_check < CHECK_INTERVAL:
+            return
+        _last_check = time.monotonic()
+        _thread = threading.Thread(target=_run_safely, daemon=True)
+        _thread.start()
+
+
+def _run_safely():
+    try:
+        run_prestage()
+    except Exception as e:
+        print(f"[prestage] ошибка подготовки: {e}")
+
+
+def record_prestage_hit(target_db, job_id):
+    """Отмечает прогноз на сегодня для базы как сбывшийся (первый запрос дня)."""
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE PrestagePredictions SET hit_job_id = ?
+        WHERE predicted_for = CAST(GETDATE() AS DATE) AND target_db = ? AND hit_job_id IS NULL
+    """, job_id, target_db)
+    conn.commit()
+    conn.close()
+
+
+def get_prestage_stats(days=30):
+    """
+    Попадания и промахи прогнозов по дням за days дней:
+    predicted, prepared, hits, false_positives (подготовили зря),
+    requested (базы с запросом), unpredicted (запросы без прогноза), precision, recall.
+    """
+    first_day = datetime.date.today() - datetime.timedelta(days=days)
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT predicted_for, COUNT(*),
+               SUM(CASE WHEN status = 'done' THEN 1 ELSE 0 END),
+               SUM(CASE WHEN hit_job_id IS NOT NULL THEN 1 ELSE 0 END)
+        FROM PrestagePredictions
+        WHERE predicted_for >= ? AND predicted_for <= CAST(GETDATE() AS DATE)
+        GROUP BY predicted_for
+    """, first_day)
+    by_day = {row[0]: {"predicted": row[1], "prepared": row[2], "hits": row[3]} for row in cursor.fetchall()}
+    cursor.execute("""
+        SELECT CAST(created_at AS DATE), COUNT(DISTINCT target_db)
+        FROM RestoreQueue
+        WHERE job_type = 'restore' AND created_at >= ?
+        GROUP BY CAST(created_at AS DATE)
+    """, first_day)
+    requested = {row[0]: row[1] for row in cursor.fetchall()}
+    conn.close()
+
+    def rates(item):
+        item["false_positives"] = item["predicted"] - item["hits"]
+        item["unpredicted"] = max(item["requested"] - item["hits"], 0)
+        item["precision"] = round(item["hits"] / item["predicted"], 3) if item["predicted"] else None
+        item["recall"] = round(item["hits"] / item["requested"], 3) if item["requested"] else None
+        return item
+
+    result = []
+    for day in sorted(set(by_day) | set(requested)):
+        item = dict(by_day.get(day, {"predicted": 0, "prepared": 0, "hits": 0}))
+        item.update(day=day.isoformat(), requested=requested.get(day, 0))
+        result.append(rates(item))
+    totals = {key: sum(item[key] for item in result) for key in ("predicted", "prepared", "hits", "requested")}
+    return {"days": result, "totals": rates(totals)}
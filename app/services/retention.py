@@ -0,0 +1,382 @@
+# app/services/retention.py
+"""
+Хранение бэкапов: удаление старых файлов и сверка каталога с диском.
+
+За один проход по папкам бэкапов (backup_base_path и тома профилей BackupProfiles):
+  * строки Backups/UserBackups, файлов которых нет на диске, удаляются;
+  * .bak-файлы, которых нет в каталоге (сироты) и которые старше retention_orphan_hours
+    (чтобы не тронуть пишущийся сейчас бэкап), попадают в план как отчёт: их мог положить
+    DBA или другой инструмент, поэтому удаляются они только при retention_delete_orphans = 1;
+  * к наборам Backups применяются политики: возраст (retention_max_age_days),
+    число наборов на источник (retention_keep_per_source) и объём на том
+    (retention_max_volume_gb); к UserBackups — возраст (retention_user_backup_days).
+
+Недоступная папка (отключённая шара, ошибка чтения) не означает, что файлов нет:
+строки каталога с файлами в такой папке не сверяются и не удаляются в этом проходе.
+
+Полный бэкап не удаляется, пока хранится хоть один разностный от него,
+а разностные без полного удаляются вместе с ним.
+Никогда не удаляются самый свежий набор источника и закреплённые файлы:
+бэкапы в окне свежести источников, по которым есть pending/running задачи,
+бэкапы за выбранную в задаче дату, личные бэкапы, из которых ждут или идут
+восстановления (RestoreQueue.user_backup_id), исходные файлы копируемых и арендованных
+копий staging (StagedBackups, app/services/backup_staging.py) и пути
+от зарегистрированных поставщиков закреплений (register_pin_provider).
+"""
+
+import datetime
+import os
+import time
+from collections import defaultdict
+
+from app.config_loader import get_svc_conn, get_global_setting
+from app.backup_resolver import get_max_age_hours
+from app.services.backup_catalog import get_backup_roots
+from app.services.backup_staging import get_pinned_sources
+
+DEFAULT_MAX_AGE_DAYS = 14
+DEFAULT_KEEP_PER_SOURCE = 3
+DEFAULT_ORPHAN_HOURS = 24
+DEFAULT_USER_BACKUP_DAYS = 30
+GB = 1024 ** 3
+
+_pin_providers = []
+
+
+def register_pin_provider(provider):
+    """Регистрирует функцию без аргументов, возвращающую пути файлов, которые нельзя удалять."""
+    _pin_providers.append(provider)
+
+
+def _norm(path):
+    return os.path.normcase(os.path.normpath(path))
+
+
+def _setting(key, default):
+    value = get_global_setting(key)
+    return float(value) if value not in (None, '') else default
+
+
+def scan_files(roots, unreadable=None):
+    """
+    Один проход по папкам: {норм. путь: (путь, размер, mtime)} для всех .bak.
+    В список unreadable (если передан) добавляются недоступные корни и папки, которые не удалось прочитать.
+    """
+    files = {}
+    stack = []
+    for root in roots:
+        if os.path.isdir(root):
+            stack.append(root)
+        else:
+            print(f"[retention] папка бэкапов недоступна: {root}")
+            if unreadable is not None:
+                unreadable.append(root)
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError as e:
+            print(f"[retention] не удалось прочитать {directory}: {e}")
+            if unreadable is not None:
+                unreadable.append(directory)
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                # Служебные папки (_storage_cache и т.п.) не трогаем
+                if not entry.name.startswith('_'):
+                    stack.append(entry.path)
+            elif entry.name.lower().endswith('.bak'):
+                st = entry.stat()
+                files[_norm(entry.path)] = (entry.path, st.st_size, st.st_mtime)
+    return files
+
+
+def _load_catalog(cursor):
+    """Наборы Backups с файлами полос и строки UserBackups."""
+    cursor.execute("""
+        SELECT b.id, b.source_db_name, b.backup_date, b.created_at, b.base_backup_id, b.backup_file_path, bf.file_path
+        FROM Backups b
+        LEFT JOIN BackupFiles bf ON bf.backup_id = b.id
+        ORDER BY b.id, bf.file_index
+    """)
+    sets = {}
+    for backup_id, source, backup_date, created_at, base_backup_id, main_path, stripe_path in cursor.fetchall():
+        item = sets.setdefault(backup_id, {
+            "id": backup_id, "source": source, "backup_date": backup_date,
+            "created_at": created_at, "base_backup_id": base_backup_id, "files": [],
+        })
+        item["files"].append(stripe_path or main_path)
+    cursor.execute("SELECT id, backup_file_path, created_at FROM UserBackups")
+    user_backups = [{"id": row[0], "file": row[1], "created_at": row[2]} for row in cursor.fetchall()]
+    return list(sets.values()), user_backups
+
+
+def _pinned_ids(cursor, sets):
+    """Наборы, нужные очереди: выбранная дата задачи или окно свежести источника активной задачи."""
+    cursor.execute("""
+        SELECT d.source_db_name, rq.backup_date
+        FROM RestoreQueue rq
+        JOIN (
+            SELECT restore_target_db, source_db_name FROM UserDatabases
+            UNION ALL
+            SELECT restore_target_db, source_db_name FROM CommonDatabases
+        ) d ON d.restore_target_db = rq.target_db
+        WHERE rq.status IN ('pending', 'running')
+    """)
+    dates = defaultdict(set)
+    fresh_sources = set()
+    for source, backup_date in cursor.fetchall():
+        if backup_date:
+            dates[source.lower()].add(backup_date)
+        else:
+            fresh_sources.add(source)
+    windows = {source.lower(): datetime.datetime.now() - datetime.timedelta(hours=get_max_age_hours(source))
+               for source in fresh_sources}
+    pinned = set()
+    for item in sets:
+        source = item["source"].lower()
+        if item["backup_date"] in dates.get(source, ()):
+            pinned.add(item["id"])
+        elif source in windows and item["created_at"] and item["created_at"] >= windows[source]:
+            pinned.add(item["id"])
+    return pinned
+
+
+def _pinned_user_backups(cursor):
+    """Файлы личных бэкапов, на которые ссылаются ожидающие и выполняющиеся задачи user_restore."""
+    cursor.execute("""
+        SELECT ub.backup_file_path
+        FROM RestoreQueue rq
+        JOIN UserBackups ub ON ub.id = rq.user_backup_id
+        WHERE rq.status IN ('pending', 'running')
+    """)
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _under(path, directories):
+    key = _norm(path)
+    return any(key.startswith(_norm(directory).rstrip(os.sep) + os.sep) for directory in directories)
+
+
+def _volume(path):
+    from scripts.backup_task import get_volume
+    return get_volume(path)
+
+
+def plan_retention():
+    """
+    Сканирует диск и каталог и возвращает план: что удалить и почему, без изменений.
+    План выполняет apply_retention; run_retention делает оба шага.
+    """
+    now = datetime.datetime.now()
+    max_age_days = _setting('retention_max_age_days', DEFAULT_MAX_AGE_DAYS)
+    keep_per_source = int(_setting('retention_keep_per_source', DEFAULT_KEEP_PER_SOURCE))
+    max_volume_gb = _setting('retention_max_volume_gb', 0)
+    orphan_hours = _setting('retention_orphan_hours', DEFAULT_ORPHAN_HOURS)
+    user_backup_days = _setting('retention_user_backup_days', DEFAULT_USER_BACKUP_DAYS)
+    delete_orphans = get_global_setting('retention_delete_orphans') == '1'
+
+    roots = get_backup_roots()
+    unreadable = []
+    on_disk = scan_files(roots, unreadable)
+
+    def exists(path):
+        # Отсутствующие в скане (вне корней или в служебных папках) проверяем по одному
+        return _norm(path) in on_disk or os.path.exists(path)
+
+    def unknown(path):
+        """Наличие файла не проверить: его папка не прочитана или недоступен сам том."""
+        if _norm(path) in on_disk:
+            return False
+        if _under(path, unreadable):
+            return True
+        if _under(path, roots):
+            return False
+        anchor = os.path.splitdrive(path)[0] or os.path.dirname(path)
+        return not os.path.isdir(anchor + os.sep)
+
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    sets, user_backups = _load_catalog(cursor)
+    pinned_ids = _pinned_ids(cursor, sets)
+    pinned_files = {_norm(path) for path in _pinned_user_backups(cursor)}
+    conn.close()
+    for provider in [get_pinned_sources] + _pin_providers:
+        try:
+            pinned_files.update(_norm(path) for path in provider())
+        except Exception as e:
+            print(f"[retention] ошибка поставщика закреплений {provider}: {e}")
+
+    plan = {"missing_sets": [], "missing_user_backups": [], "orphans": [], "delete_orphans": delete_orphans,
+            "expired_sets": [], "expired_user_backups": [], "unreadable": unreadable}
+
+    # 1. Строки каталога без файлов; наборы в недоступных папках пропускаются целиком
+    live_sets = []
+    unchecked_ids = set()
+    for item in sets:
+        if any(unknown(path) for path in item["files"]):
+            unchecked_ids.add(item["id"])
+            continue
+        if all(exists(path) for path in item["files"]):
+            live_sets.append(item)
+        else:
+            plan["missing_sets"].append({"id": item["id"], "source": item["source"], "reason": "нет файлов на диске"})
+    live_user_backups = []
+    for item in user_backups:
+        if unknown(item["file"]):
+            continue
+        if exists(item["file"]):
+            live_user_backups.append(item)
+        else:
+            plan["missing_user_backups"].append({"id": item["id"], "file": item["file"], "reason": "нет файла на диске"})
+
+    # 2. Сироты: файлы без строки в каталоге (удаляются, только если delete_orphans)
+    catalog_files = {_norm(path) for item in sets for path in item["files"]}
+    catalog_files.update(_norm(item["file"]) for item in user_backups)
+    orphan_before = time.time() - orphan_hours * 3600
+    for key, (path, size, mtime) in on_disk.items():
+        if key not in catalog_files and key not in pinned_files and mtime < orphan_before:
+            plan["orphans"].append({"file": path, "size": size, "reason": "нет в каталоге"})
+
+    # 3. Политики для наборов Backups
+    def protected(item):
+        return item["id"] in pinned_ids or any(_norm(path) in pinned_files for path in item["files"])
+
+    expired = {}
+    by_source = defaultdict(list)
+    for item in live_sets:
+        by_source[item["source"].lower()].append(item)
+    for items in by_source.values():
+        items.sort(key=lambda i: (i["backup_date"], i["created_at"] or now), reverse=True)
+        for position, item in enumerate(items):
+            if position == 0 or protected(item):
+                continue  # самый свежий набор источника и закреплённые не удаляются
+            age_days = (now.date() - item["backup_date"]).days
+            if max_age_days and age_days > max_age_days:
+                expired[item["id"]] = f"старше {max_age_days:g} дн."
+            elif keep_per_source and position >= keep_per_source:
+                expired[item["id"]] = f"больше {keep_per_source} наборов источника"
+
+    if max_volume_gb:
+        newest = {items[0]["id"] for items in by_source.values() if items}
+        sizes = {item["id"]: sum(on_disk.get(_norm(p), (p, 0, 0))[1] for p in item["files"]) for item in live_sets}
+        volume_bytes = defaultdict(int)
+        volume_sets = defaultdict(list)
+        for item in live_sets:
+            for path in item["files"]:
+                size = on_disk.get(_norm(path), (path, 0, 0))[1]
+                volume_bytes[_volume(path)] += size
+                if item["id"] not in expired:
+                    volume_sets[_volume(path)].append(item)
+        for volume, items in volume_sets.items():
+            over = volume_bytes[volume] - max_volume_gb * GB
+            # Старые наборы удаляются первыми
+            for item in sorted(items, key=lambda i: (i["backup_date"], i["created_at"] or now)):
+                if over <= 0:
+                    break
+                if item["id"] in newest or protected(item) or item["id"] in expired:
+                    continue
+                expired[item["id"]] = f"том {volume} больше {max_volume_gb:g} ГБ"
+                over -= sizes[item["id"]]
+
+    # Цепочки: полный бэкап нужен, пока жив хоть один его разностный; разностный без полного бесполезен
+    live_ids = {item["id"] for item in live_sets}
+    for item in live_sets:
+        if item["base_backup_id"] and item["id"] not in expired:
+            expired.pop(item["base_backup_id"], None)
+    for item in live_sets:
+        base_id = item["base_backup_id"]
+        if base_id in unchecked_ids:
+            continue  # полный бэкап в недоступной папке — судьбу цепочки решим в следующий раз
+        if base_id and (base_id not in live_ids or base_id in expired) and not protected(item):
+            expired[item["id"]] = "удалён полный бэкап цепочки"
+
+    for item in live_sets:
+        if item["id"] in expired:
+            plan["expired_sets"].append({"id": item["id"], "source": item["source"], "files": item["files"],
+                                         "backup_date": item["backup_date"], "reason": expired[item["id"]]})
+
+    # 4. Пользовательские бэкапы: только по возрасту
+    if user_backup_days:
+        for item in live_user_backups:
+            # Бэкап, из которого ждёт или идёт восстановление, не удаляется при любом возрасте
+            if _norm(item["file"]) in pinned_files or not item["created_at"]:
+                continue
+            if now - item["created_at"] > datetime.timedelta(days=user_backup_days):
+                plan["expired_user_backups"].append({"id": item["id"], "file": item["file"],
+                                                     "reason": f"старше {user_backup_days:g} дн."})
+    return plan
+
+
+def _remove_file(path):
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+    except FileNotFoundError:
+        return 0
+    except OSError as e:
+        print(f"[retention] не удалось удалить {path}: {e}")
+        return None
+
+
+def apply_retention(plan):
+    """Выполняет план: удаляет файлы и строки каталога. Возвращает сводку."""
+    freed = 0
+    failed = 0
+    backup_ids = [item["id"] for item in plan["missing_sets"]]
+    user_backup_ids = [item["id"] for item in plan["missing_user_backups"]]
+
+    for item in plan["expired_sets"]:
+        results = [_remove_file(path) for path in item["files"]]
+        if any(result is None for result in results):
+            failed += 1
+            continue  # строку оставляем, чтобы повторить в следующий раз
+        freed += sum(results)
+        backup_ids.append(item["id"])
+    for item in plan["expired_user_backups"]:
+        result = _remove_file(item["file"])
+        if result is None:
+            failed += 1
+            continue
+        freed += result
+        user_backup_ids.append(item["id"])
+    deleted_orphans = 0
+    # Сироты портал не создавал: без явной настройки они только показываются в плане
+    orphans = plan["orphans"] if plan.get("delete_orphans") else []
+    for item in orphans:
+        result = _remove_file(item["file"])
+        if result is None:
+            failed += 1
+        else:
+            freed += result
+            deleted_orphans += 1
+
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    for backup_id in backup_ids:
+        cursor.execute("DELETE FROM Backups WHERE id = ?", backup_id)  # BackupFiles — ON DELETE CASCADE
+    for backup_id in user_backup_ids:
+        cursor.execute("DELETE FROM UserBackups WHERE id = ?", backup_id)
+    conn.commit()
+    conn.close()
+
+    summary = {
+        "deleted_sets": len(backup_ids),
+        "deleted_user_backups": len(user_backup_ids),
+        "deleted_orphans": deleted_orphans,
+        "kept_orphans": 0 if plan.get("delete_orphans") else len(plan["orphans"]),
+        "freed_bytes": freed,
+        "failed": failed,
+    }
+    print(f"[retention] удалено наборов: {summary['deleted_sets']}, личных бэкапов: {summary['deleted_user_backups']}, "
+          f"сирот: {summary['deleted_orphans']} (оставлено {summary['kept_orphans']}), "
+          f"освобождено {freed / GB:.1f} ГБ, ошибок: {failed}")
+    return summary
+
+
+def run_retention(dry_run=False):
+    """Строит план и, если не dry_run, выполняет его. Возвращает {"plan", "summary"}."""
+    plan = plan_retention()
+    summary = None if dry_run else apply_retention(plan)
+    return {"plan": plan, "summary": summary}
@@ -0,0 +1,251 @@
+# app/services/storage_cache.py
+"""
+Общий кэш выгрузок из хранилища конфигурации 1С (по storage_path и расширению).
+
+Раньше каждое восстановление базы с use_storage выполняло UpdateFromStorage, то есть
+заново скачивало одну и ту же версию хранилища для каждого пользователя.
+Теперь при смене версии хранилища конфигурация (.cf) или расширение (.cfe) выгружаются
+один раз в локальный файл, а восстановления загружают этот файл (/LoadCfg).
+Если в целевую базу уже загружена текущая версия, LoadCfg и UpdateDBCfg пропускаются.
+
+Какую версию несёт база после RESTORE, определяется по отпечатку конфигурации
+(SqlSession.config_fingerprint): после загрузки выгрузки отпечаток базы запоминается
+в StorageArtifacts.config_fingerprint, и восстановленная база с тем же отпечатком
+считается уже обновлённой до этой версии. Отпечаток не совпал или не получен —
+версия неизвестна, и обновление выполняется.
+"""
+
+import datetime
+import hashlib
+import os
+import threading
+from pathlib import Path
+
+from app.config_loader import get_svc_conn, get_global_setting
+from app.onec_commands import run_1c_designer
+
+DEFAULT_TTL_MINUTES = 60
+REPOSITORY_FILE = '1cv8ddb.1CD'
+
+_key_locks = {}
+_key_locks_guard = threading.Lock()
+
+
+def _key_lock(storage_path, extension_name):
+    key = (storage_path.lower(), (extension_name or '').lower())
+    with _key_locks_guard:
+        lock = _key_locks.get(key)
+        if lock is None:
+            lock = threading.Lock()
+            _key_locks[key] = lock
+        return lock
+
+
+def get_cache_dir():
+    base = get_global_setting('storage_cache_path') or os.path.join(
+        get_global_setting('backup_base_path') or r'D:\SQLBackups', '_storage_cache')
+    Path(base).mkdir(parents=True, exist_ok=True)
+    return base
+
+
+def get_repository_version(storage_path):
+    """
+    Возвращает отпечаток версии файлового хранилища (mtime и размер 1cv8ddb.1CD),
+    который меняется при каждом помещении в хранилище.
+    Для сетевых хранилищ (tcp://, http://) версию так не узнать — возвращает None.
+    """
+    repo_file = os.path.join(storage_path, REPOSITORY_FILE)
+    try:
+        st = os.stat(repo_file)
+    except OSError:
+        return None
+    return f"{int(st.st_mtime)}-{st.st_size}"
+
+
+def _artifact_file_name(storage_path, extension_name):
+    digest = hashlib.sha1(f"{storage_path.lower()}|{(extension_name or '').lower()}".encode('utf-8')).hexdigest()[:12]
+    suffix = '.cfe' if extension_name else '.cf'
+    name = extension_name or 'main'
+    return f"{name}_{digest}{suffix}"
+
+
+def _find_artifact(storage_path, extension_name):
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT repo_version, artifact_path, created_at, config_fingerprint
+        FROM StorageArtifacts
+        WHERE storage_path = ? AND extension_name = ?
+    """, storage_path, extension_name or '')
+    row = cursor.fetchone()
+    conn.close()
+    return row
+
+
+def _save_artifact(storage_path, extension_name, version, artifact_path):
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("""
+        MERGE StorageArtifacts AS target
+        USING (SELECT ? AS storage_path, ? AS extension_name) AS source
+        ON target.storage_path = source.storage_path AND target.extension_name = source.extension_name
+        WHEN MATCHED THEN
+            UPDATE SET repo_version = ?, artifact_path = ?, created_at = GETDATE(), config_fingerprint = NULL
+        WHEN NOT MATCHED THEN
+            INSERT (storage_path, extension_name, repo_version, artifact_path)
+            VALUES (source.storage_path, source.extension_name, ?, ?);
+    """, storage_path, extension_name or '', version, artifact_path, version, artifact_path)
+    conn.commit()
+    conn.close()
+
+
+def _is_artifact_current(row, version):
+    """Выгрузка актуальна, если версия совпадает, а для сетевых хранилищ — если она не старше TTL."""
+    if not row or not row[1] or not os.path.exists(row[1]):
+        return False
+    if version is not None:
+        return row[0] == version
+    ttl = int(get_global_setting('storage_cache_ttl_minutes') or DEFAULT_TTL_MINUTES)
+    return row[2] is not None and datetime.datetime.now() - row[2] < datetime.timedelta(minutes=ttl)
+
+
+def get_storage_artifact(storage_path, extension_name, storage_user, storage_password,
+                         donor_db, app_login=None, app_password=None, job_id=None):
+    """
+    Возвращает (путь к .cf/.cfe, версия) для текущей версии хранилища.
+    Выгрузка выполняется один раз на версию: параллельные задачи по тому же хранилищу
+    ждут её завершения и используют готовый файл. donor_db — база, через которую выгружаем.
+    """
+    with _key_lock(storage_path, extension_name):
+        version = get_repository_version(storage_path)
+        row = _find_artifact(storage_path, extension_name)
+        if _is_artifact_current(row, version):
+            print(f"[storage_cache] используем готовую выгрузку {row[1]} (версия {row[0]})")
+            return row[1], row[0]
+
+        artifact_path = os.path.join(get_cache_dir(), _artifact_file_name(storage_path, extension_name))
+        tmp_path = artifact_path + '.tmp'
+        args = [
+            "/ConfigurationRepositoryF", storage_path,
+            "/ConfigurationRepositoryN", storage_user,
+            "/ConfigurationRepositoryP", storage_password,
+            "/ConfigurationRepositoryDumpCfg", tmp_path,
+        ]
+        if extension_name:
+            args += ["-Extension", extension_name]
+        print(f"[storage_cache] выгрузка из хранилища {storage_path} ({extension_name or 'основная конфигурация'})")
+        run_1c_designer(donor_db, args, app_login, app_password, job_id=job_id, label='1cv8:ConfigurationRepositoryDumpCfg')
+        os.replace(tmp_path, artifact_path)
+
+        # Для сетевого хранилища версия неизвестна — помечаем выгрузку временем создания
+        version = version or f"ts-{datetime.datetime.now():%Y%m%d%H%M%S}"
+        _save_artifact(storage_path, extension_name, version, artifact_path)
+        return artifact_path, version
+
+
+def get_target_version(target_db, storage_path, extension_name):
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT repo_version FROM StorageTargetVersions
+        WHERE target_db = ? AND storage_path = ? AND extension_name = ?
+    """, target_db, storage_path, extension_name or '')
+    row = cursor.fetchone()
+    conn.close()
+    return row[0] if row else None
+
+
+def set_target_version(target_db, storage_path, extension_name, version):
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM StorageTargetVersions WHERE target_db = ? AND storage_path = ? AND extension_name = ?",
+                   target_db, storage_path, extension_name or '')
+    cursor.execute("""
+        INSERT INTO StorageTargetVersions (target_db, storage_path, extension_name, repo_version)
+        VALUES (?, ?, ?, ?)
+    """, target_db, storage_path, extension_name or '', version)
+    conn.commit()
+    conn.close()
+
+
+def forget_target(target_db):
+    """Сбрасывает сведения о загруженной версии (после RESTORE конфигурация базы заменена)."""
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM StorageTargetVersions WHERE target_db = ?", target_db)
+    conn.commit()
+    conn.close()
+
+
+def _safe_fingerprint(fingerprint, target_db):
+    if fingerprint is None:
+        return None
+    try:
+        return fingerprint()
+    except Exception as e:
+        print(f"[storage_cache] отпечаток конфигурации {target_db} не получен: {e}")
+        return None
+
+
+def _save_fingerprint(storage_path, extension_name, version, config_fingerprint):
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE StorageArtifacts SET config_fingerprint = ?
+        WHERE storage_path = ? AND extension_name = ? AND repo_version = ?
+    """, config_fingerprint, storage_path, extension_name or '', version)
+    conn.commit()
+    conn.close()
+
+
+def record_restored_target(target_db, db_config, fingerprint=None):
+    """
+    После RESTORE: записывает версию хранилища, которую несёт восстановленная конфигурация,
+    если её отпечаток совпал с отпечатком базы после загрузки выгрузки; иначе версия сбрасывается.
+    fingerprint — функция без аргументов, возвращающая отпечаток конфигурации базы.
+    Возвращает найденную версию или None.
+    """
+    forget_target(target_db)
+    storage_path = db_config.get('storage_path')
+    if not db_config.get('use_storage') or not storage_path:
+        return None
+    extension_name = db_config.get('extension_name', '')
+    row = _find_artifact(storage_path, extension_name)
+    if not row or not row[3]:
+        return None
+    if _safe_fingerprint(fingerprint, target_db) != row[3]:
+        return None
+    set_target_version(target_db, storage_path, extension_name, row[0])
+    return row[0]
+
+
+def update_from_storage(target_db, db_config, job_id=None, fingerprint=None):
+    """
+    Обновляет базу до текущей версии хранилища через общий кэш выгрузок.
+    fingerprint — функция, возвращающая отпечаток конфигурации базы: после загрузки
+    он запоминается для выгрузки, чтобы следующие восстановления с той же конфигурацией её узнали.
+    Возвращает dict: version, artifact_path, skipped (база уже на этой версии).
+    """
+    storage_path = db_config.get('storage_path')
+    extension_name = db_config.get('extension_name', '')
+    app_login = db_config.get('app_login')
+    app_password = db_config.get('app_password')
+
+    artifact_path, version = get_storage_artifact(
+        storage_path, extension_name,
+        db_config.get('storage_user'), db_config.get('storage_password'),
+        target_db, app_login, app_password, job_id=job_id
+    )
+    if get_target_version(target_db, storage_path, extension_name) == version:
+        return {'version': version, 'artifact_path': artifact_path, 'skipped': True}
+
+    ext_args = ["-Extension", extension_name] if extension_name else []
+    run_1c_designer(target_db, ["/LoadCfg", artifact_path] + ext_args, app_login, app_password,
+                    job_id=job_id, label='1cv8:LoadCfg')
+    run_1c_designer(target_db, ["/UpdateDBCfg"] + ext_args, app_login, app_password,
+                    job_id=job_id, label='1cv8:UpdateDBCfg')
+    set_target_version(target_db, storage_path, extension_name, version)
+    config_fingerprint = _safe_fingerprint(fingerprint, target_db)
+    if config_fingerprint:
+        _save_fingerprint(storage_path, extension_name, version, config_fingerprint)
+    return {'version': version, 'artifact_path': artifact_path, 'skipped': False}
@@ -78,52 +78,15 @@ def read_worker_config():
 
 def fetch_and_lock_next_job():
     """
-    Атомарный захват следующей pending задачи из RestoreQueue.
-    Возвращает dict {id, windows_user, target_db} или None.
-    Реализовано через pyodbc/DB-connection (использует db_utils.get_svc_conn()).
+    Атомарный захват следующей pending задачи из RestoreQueue с учётом пределов по типам задач
+    (см. app.services.job_queue). Возвращает dict {id, windows_user, target_db, job_type, user_backup_id} или None.
     """
-    if db_utils is None:
-        return None
-
-    conn = None
     try:
-        conn = db_utils.get_svc_conn()
-        conn.autocommit = False
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT TOP 1 id, windows_user, target_db
-            FROM RestoreQueue WITH (UPDLOCK, READPAST)
-            WHERE status = 'pending'
-            ORDER BY created_at
-        """)
-        row = cur.fetchone()
-        if not row:
-            conn.rollback()
-            return None
-
-        job_id, windows_user, target_db = row[0], row[1], row[2]
-        # Попытка захвата: обновить статус только если он всё еще pending
-        cur.execute("UPDATE RestoreQueue SET status = 'running', started_at = GETDATE() WHERE id = ? AND status = 'pending'", job_id)
-        if cur.rowcount == 1:
-            conn.commit()
-            return {'id': job_id, 'windows_user': windows_user, 'target_db': target_db}
-        else:
-            conn.rollback()
-            return None
+        from app.services.job_queue import claim_next_job
+        return claim_next_job()
     except Exception as e:
-        try:
-            if conn:
-                conn.rollback()
-        except:
-            pass
         print("[worker] fetch_and_lock_next_job error:", e)
         return None
-    finally:
-        try:
-            if conn:
-                conn.close()
-        except:
-            pass
 
 def reset_stuck_jobs(stuck_hours=None):
     """
@@ -176,11 +139,11 @@ def perform_restore_job(job):
     print(f"[worker] starting job {job_id} target={target_db} user={user} at {datetime.now().isoformat()}")
 
     try:
-        # Если в проекте есть старая реализация perform_restore_job в db_ops, вызовем её
-        if legacy_db_ops and hasattr(legacy_db_ops, 'perform_restore_job'):
+        # Если в проекте есть старая реализация в db_ops, вызовем её (выбор по job_type — в perform_job)
+        if legacy_db_ops and hasattr(legacy_db_ops, 'perform_job'):
             # legacy expects parameters differently in your code — adjust as needed
             try:
-                legacy_db_ops.perform_restore_job(job)
+                legacy_db_ops.perform_job(job)
             except Exception as e:
                 raise
         else:
@@ -230,6 +193,10 @@ def _worker_loop():
             while len(_running_jobs) < max_concurrent:
                 job = fetch_and_lock_next_job()
                 if not job:
+                    if not _running_jobs:
+                        # простой: подготовка к ожидаемым восстановлениям (app.services.prestage)
+                        from app.services.prestage import run_due_prestage
+                        run_due_prestage()
                     break
                 jid = job.get('id')
                 with _lock:
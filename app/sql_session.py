@@ -0,0 +1,192 @@
+# app/sql_session.py
+"""
+Сессия SQL Server на одну задачу восстановления.
+
+Открывает одно подключение к master с учётными данными задачи и использует его для всех
+SQL-шагов (SINGLE_USER, RESTORE, владелец, модель восстановления, сжатие лога, настройка БД).
+Имена БД экранируются локально, без запроса QUOTENAME к серверу.
+Время каждой инструкции сохраняется в timings.
+Ход BACKUP/RESTORE (percent_complete из sys.dm_exec_requests) передаётся в progress_callback.
+"""
+
+import re
+import threading
+import time
+
+import pyodbc
+
+from .config_loader import get_global_setting
+
+DB_NAME_RE = re.compile(r'^[A-Za-z0-9_]+$')
+PROGRESS_POLL_SECONDS = 5
+PROGRESS_LABELS = ('backup', 'restore')
+
+
+def validate_db_name(db_name):
+    """Проверяет, что имя БД состоит только из допустимых символов."""
+    if not db_name or not DB_NAME_RE.match(db_name):
+        raise ValueError(f"Недопустимое имя базы данных: {db_name}")
+    return True
+
+
+def quote_name(db_name):
+    """Локальный аналог QUOTENAME: [имя] с удвоением закрывающих скобок."""
+    validate_db_name(db_name)
+    return '[' + db_name.replace(']', ']]') + ']'
+
+
+def build_tuning_statements(quoted_name, profile):
+    """
+    Формирует список инструкций настройки БД по профилю (TuningProfiles).
+    Поля профиля со значением None не меняются.
+    """
+    statements = []
+    if profile.get('auto_update_stats') is not None:
+        statements.append(f"ALTER DATABASE {quoted_name} SET AUTO_UPDATE_STATISTICS {'ON' if profile['auto_update_stats'] else 'OFF'}")
+    if profile.get('auto_update_stats_async') is not None:
+        statements.append(f"ALTER DATABASE {quoted_name} SET AUTO_UPDATE_STATISTICS_ASYNC {'ON' if profile['auto_update_stats_async'] else 'OFF'}")
+    query_store = (profile.get('query_store') or '').upper()
+    if query_store == 'OFF':
+        statements.append(f"ALTER DATABASE {quoted_name} SET QUERY_STORE = OFF")
+    elif query_store in ('READ_WRITE', 'READ_ONLY'):
+        statements.append(f"ALTER DATABASE {quoted_name} SET QUERY_STORE = ON")
+        statements.append(f"ALTER DATABASE {quoted_name} SET QUERY_STORE (OPERATION_MODE = {query_store})")
+    if profile.get('maxdop') is not None:
+        # Параметр уровня базы: не трогает настройку сервера и другие восстановления
+        statements.append(f"USE {quoted_name}; ALTER DATABASE SCOPED CONFIGURATION SET MAXDOP = {int(profile['maxdop'])}; USE [master];")
+    return statements
+
+
+class SqlSession:
+    """Одно подключение к master на задачу; используется как контекстный менеджер."""
+
+    def __init__(self, sql_login, sql_password, server=None, job_id=None):
+        self.sql_login = sql_login
+        self.sql_password = sql_password
+        self.server = server
+        self.job_id = job_id
+        self.timings = []  # [(метка, секунды)]
+        self.progress_callback = None  # callback(percent) для BACKUP/RESTORE
+        self.session_id = None
+        self._conn = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def _conn_str(self):
+        server = self.server or get_global_setting('sql_server_address') or 'localhost'
+        return (f"DRIVER={{ODBC Driver 17 for SQL Server}};SERVER={server};DATABASE=master;"
+                f"UID={self.sql_login};PWD={self.sql_password};")
+
+    def open(self):
+        if self._conn is not None:
+            return self
+        self._conn = pyodbc.connect(self._conn_str())
+        self._conn.autocommit = True
+        self.session_id = self._conn.cursor().execute("SELECT @@SPID").fetchone()[0]
+        return self
+
+    def close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            finally:
+                self._conn = None
+
+    def execute(self, sql, *params, label=None):
+        """
+        Выполняет инструкцию и дочитывает все результирующие наборы/сообщения
+        (иначе RESTORE/BACKUP с STATS может быть прерван драйвером). Время пишется в timings.
+        """
+        self.open()
+        cursor = self._conn.cursor()
+        watcher = None
+        if self.progress_callback and label in PROGRESS_LABELS:
+            watcher = threading.Event()
+            threading.Thread(target=self._watch_progress, args=(watcher,), daemon=True).start()
+        started = time.monotonic()
+        try:
+            cursor.execute(sql, *params)
+            while cursor.nextset():
+                pass
+        finally:
+            self.timings.append((label or sql.split()[0], time.monotonic() - started))
+            if watcher:
+                watcher.set()
+        return cursor
+
+    def _watch_progress(self, stop):
+        """Опрашивает percent_complete инструкции сессии отдельным подключением (нужно VIEW SERVER STATE)."""
+        try:
+            conn = pyodbc.connect(self._conn_str())
+            try:
+                cursor = conn.cursor()
+                while not stop.wait(PROGRESS_POLL_SECONDS):
+                    cursor.execute("SELECT percent_complete FROM sys.dm_exec_requests WHERE session_id = ?", self.session_id)
+                    row = cursor.fetchone()
+                    if row and row[0]:
+                        self.progress_callback(row[0])
+            finally:
+                conn.close()
+        except Exception as e:
+            print(f"⚠️ Ход выполнения сессии {self.session_id} недоступен: {e}")
+
+    def set_single_user(self, db_name):
+        self.execute(f"ALTER DATABASE {quote_name(db_name)} SET SINGLE_USER WITH ROLLBACK IMMEDIATE", label='single_user')
+
+    def set_multi_user(self, db_name):
+        self.execute(f"ALTER DATABASE {quote_name(db_name)} SET MULTI_USER", label='multi_user')
+
+    def restore_database(self, db_name, backup_files, recovery=True):
+        """RESTORE DATABASE из одного или нескольких файлов (полосы одного набора)."""
+        if isinstance(backup_files, str):
+            backup_files = [backup_files]
+        disks = ', '.join('DISK = ?' for _ in backup_files)
+        mode = 'RECOVERY' if recovery else 'NORECOVERY'
+        self.execute(f"RESTORE DATABASE {quote_name(db_name)} FROM {disks} WITH REPLACE, {mode}, STATS = 5",
+                     *backup_files, label='restore')
+
+    def backup_database(self, db_name, backup_files, options="COPY_ONLY, COMPRESSION, INIT, STATS = 5"):
+        """BACKUP DATABASE в один или несколько файлов; по умолчанию COPY_ONLY, чтобы не трогать цепочку бэкапов."""
+        if isinstance(backup_files, str):
+            backup_files = [backup_files]
+        disks = ', '.join('DISK = ?' for _ in backup_files)
+        self.execute(f"BACKUP DATABASE {quote_name(db_name)} TO {disks} WITH {options}", *backup_files, label='backup')
+
+    def set_owner(self, db_name, owner='sa'):
+        self.execute(f"ALTER AUTHORIZATION ON DATABASE::{quote_name(db_name)} TO [{owner.replace(']', ']]')}]", label='owner')
+
+    def set_recovery_simple(self, db_name):
+        self.execute(f"ALTER DATABASE {quote_name(db_name)} SET RECOVERY SIMPLE", label='recovery_model')
+
+    def shrink_log(self, db_name):
+        self.execute(f"USE {quote_name(db_name)}; DBCC SHRINKFILE (2, TRUNCATEONLY); USE [master];", label='shrink')
+
+    def apply_tuning(self, db_name, profile):
+        """Применяет профиль настройки БД (MAXDOP на уровне базы, статистика, Query Store)."""
+        for statement in build_tuning_statements(quote_name(db_name), profile):
+            self.execute(statement, label='tuning')
+
+    def config_fingerprint(self, db_name, extension=False):
+        """
+        Отпечаток конфигурации информационной базы 1С: SHA-256 по именам и содержимому файлов
+        таблицы Config (для расширений — ConfigCAS, общей для всех расширений базы).
+        Одинаковая конфигурация даёт одинаковый отпечаток независимо от времени загрузки.
+        """
+        table = 'ConfigCAS' if extension else 'Config'
+        self.open()
+        row = self._conn.cursor().execute(f"""
+            SELECT CONVERT(varchar(64), HASHBYTES('SHA2_256',
+                       STRING_AGG(CAST(FileName AS nvarchar(max)) + N':' + CONVERT(nvarchar(64), HASHBYTES('SHA2_256', BinaryData), 2), N';')
+                       WITHIN GROUP (ORDER BY FileName)), 2)
+            FROM {quote_name(db_name)}.dbo.{table}
+        """).fetchone()
+        return row[0] if row else None
+
+    def timings_text(self):
+        return ', '.join(f"{label}: {seconds:.1f} с" for label, seconds in self.timings)
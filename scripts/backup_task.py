@@ -4,6 +4,11 @@ import pyodbc
 from pathlib import Path
 import sys
 import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
 # Добавим путь к папке app, чтобы импортировать db_utils
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 from app.email_sender import notify_admin_on_backup_failure
@@ -11,18 +16,14 @@ from app.config_loader import get_global_setting
 
 from app.db_utils import get_svc_conn, get_sql_server_conn # <-- Новый импорт
 from app.config_loader import get_global_setting # <-- Импорт для настроек из БД
+from app.config_loader import get_backup_profile
+from app.services.backup_catalog import record_backup
+from app.services.backup_flight import create_backup_under_lock
+
+DEFAULT_MAX_PARALLEL = 4
+DEFAULT_MAX_PER_SERVER = 2
+DEFAULT_MAX_PER_VOLUME = 2
 
-def daily_backup():
-    # ... (ваша логика бэкапа)
-    try:
-        # ... (ваш код)
-        pass
-    except Exception as e:
-        error_msg = str(e)
-        print(f"❌ Ошибка бэкапа: {error_msg}")
-        notify_admin_on_backup_failure(error_msg)  # <-- Новое
-        raise e
-    
 def get_svc_conn():
     return pyodbc.connect(
         "DRIVER={ODBC Driver 17 for SQL Server};"
@@ -31,25 +32,99 @@ def get_svc_conn():
         "Trusted_Connection=yes;"
     )
 
-def create_backup_from_source(source_db_name):
+def get_stripe_files(source_db_name, profile, backup_date=None, backup_type='copy'):
+    """
+    Файлы полос бэкапа: полоса i пишется в volumes[i % len(volumes)]/<source_db_name>
+    (без volumes — в backup_base_path). Для одной полосы имя файла прежнее: <база><ддммгггг>.bak;
+    у разностного бэкапа к дате добавляется _diff.
+    """
+    date_str = (backup_date or datetime.date.today()).strftime("%d%m%Y")
+    if backup_type == 'diff':
+        date_str += '_diff'
+    stripes = profile.get('stripes') or 1
+    volumes = profile.get('volumes') or []
+    files = []
+    for i in range(stripes):
+        backup_dir = os.path.join(volumes[i % len(volumes)], source_db_name) if volumes else get_backup_dir(source_db_name)
+        name = f"{source_db_name}{date_str}.bak" if stripes == 1 else f"{source_db_name}{date_str}_{i + 1}of{stripes}.bak"
+        files.append(os.path.join(backup_dir, name))
+    return files
+
+def build_backup_options(profile, backup_type='copy'):
+    """
+    Параметры WITH для BACKUP по профилю (BUFFERCOUNT/MAXTRANSFERSIZE/BLOCKSIZE — если заданы).
+    backup_type: 'copy' — COPY_ONLY, 'full' — полный (база для разностных), 'diff' — DIFFERENTIAL.
+    """
+    options = {"copy": ["COPY_ONLY"], "full": [], "diff": ["DIFFERENTIAL"]}[backup_type] + ["COMPRESSION"]
+    if profile.get('buffer_count'):
+        options.append(f"BUFFERCOUNT = {int(profile['buffer_count'])}")
+    if profile.get('max_transfer_size'):
+        options.append(f"MAXTRANSFERSIZE = {int(profile['max_transfer_size'])}")
+    if profile.get('block_size'):
+        options.append(f"BLOCKSIZE = {int(profile['block_size'])}")
+    options.append("STATS = 10")
+    return ', '.join(options)
+
+def _find_diff_base(source_db_name, max_age_days):
+    """Последний полный (не COPY_ONLY) набор источника не старше max_age_days: (id, backup_set_guid) или None."""
+    conn = get_svc_conn()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT TOP 1 b.id, bc.backup_set_guid
+        FROM Backups b
+        LEFT JOIN BackupCatalog bc ON bc.backup_id = b.id AND bc.file_path = b.backup_file_path
+        WHERE b.source_db_name = ? AND b.backup_type = 'full' AND b.backup_date >= ?
+        ORDER BY b.backup_date DESC
+    """, source_db_name, datetime.date.today() - datetime.timedelta(days=max_age_days))
+    row = cursor.fetchone()
+    conn.close()
+    return (row[0], row[1]) if row else None
+
+def choose_backup_type(prod_cursor, source_db_name, profile, allow_diff):
+    """
+    Тип бэкапа по стратегии профиля: ('copy', None), ('full', None) или ('diff', id полного набора).
+    Разностный делается, только если на источнике база для разностных — наш последний полный
+    (differential_base_guid совпадает с backup_set_guid из каталога); иначе делается полный.
+    """
+    if not allow_diff or profile.get('strategy') != 'weekly_full_daily_diff':
+        return 'copy', None
+    if datetime.date.today().weekday() == profile.get('full_weekday', 6):
+        return 'full', None
+    base = _find_diff_base(source_db_name, 7)
+    if not base:
+        return 'full', None
+    base_id, base_guid = base
+    prod_cursor.execute("SELECT differential_base_guid FROM sys.database_files WHERE file_id = 1")
+    row = prod_cursor.fetchone()
+    current_guid = str(row[0]).lower() if row and row[0] else None
+    if not base_guid or current_guid != base_guid.lower():
+        print(f"⚠️ {source_db_name}: база разностного бэкапа сменилась (чужой полный бэкап?), делаю полный")
+        return 'full', None
+    return 'diff', base_id
+
+def create_backup_from_source(source_db_name, allow_diff=False):
+    """
+    Делает бэкап источника по его профилю (BackupSources.backup_profile).
+    По умолчанию — COPY_ONLY (не влияет на цепочку бэкапов продуктива).
+    allow_diff (ежедневный бэкап): при стратегии профиля 'weekly_full_daily_diff' в день
+    full_weekday делается полный бэкап, в остальные дни — разностный от него.
+    Набор из нескольких полос записывается одной строкой Backups (первый файл)
+    и строками BackupFiles для всех полос. Возвращает список файлов набора.
+    """
     # ... (чтение из BackupSources через get_svc_conn)
     conn = get_svc_conn() # <-- Используем функцию из db_utils
     cursor = conn.cursor()
     cursor.execute("""
-        SELECT source_server, sql_login, sql_password, datafile_name
+        SELECT source_server, sql_login, sql_password, datafile_name, backup_profile
         FROM BackupSources WHERE source_db_name = ?
     """, source_db_name)
     row = cursor.fetchone()
     if not row:
         raise ValueError(f"Источник для {source_db_name} не найден")
-    source_server, sql_login, sql_password, datafile_name = row
+    source_server, sql_login, sql_password, datafile_name, backup_profile = row
     conn.close()
 
-    # Папка бэкапа
-    backup_dir = os.path.join(get_global_setting('backup_base_path') or r'D:\SQLBackups', source_db_name)
-    Path(backup_dir).mkdir(parents=True, exist_ok=True)
-    today_str = datetime.date.today().strftime("%d%m%Y")
-    backup_file = os.path.join(backup_dir, f"{source_db_name}{today_str}.bak")
+    profile = get_backup_profile(backup_profile)
 
     # Подключение к prod-серверу через основной SQL Server (или через source_server, если он отличается)
     # В данном случае, source_db_name - это БД на source_server
@@ -65,50 +140,198 @@ def create_backup_from_source(source_db_name):
     # Используем основной SQL Server из config/app_config.json
     sql_server_address = get_global_setting('sql_server_address') or 'localhost'
     prod_conn_str = f"DRIVER={{ODBC Driver 17 for SQL Server}};SERVER={sql_server_address};DATABASE={source_db_name};UID={sql_login};PWD={sql_password}"
-    prod_conn = pyodbc.connect(prod_conn_str) # <-- Используем основной сервер
+    prod_conn = pyodbc.connect(prod_conn_str, autocommit=True) # <-- Используем основной сервер
 
     cursor = prod_conn.cursor()
-    cursor.execute(f"BACKUP DATABASE [{source_db_name}] TO DISK = ? WITH COPY_ONLY, COMPRESSION, STATS = 10", backup_file)
-    prod_conn.commit()
+    backup_type, base_backup_id = choose_backup_type(cursor, source_db_name, profile, allow_diff)
+    backup_files = get_stripe_files(source_db_name, profile, backup_type=backup_type)
+    for backup_file in backup_files:
+        Path(os.path.dirname(backup_file)).mkdir(parents=True, exist_ok=True)
+
+    started = datetime.datetime.now()
+    disks = ', '.join('DISK = ?' for _ in backup_files)
+    cursor.execute(f"BACKUP DATABASE [{source_db_name}] TO {disks} WITH {build_backup_options(profile, backup_type)}", *backup_files)
+    # Дочитываем сообщения STATS, иначе драйвер может прервать BACKUP до окончания
+    while cursor.nextset():
+        pass
     prod_conn.close()
 
     # Записываем в служебную БД через get_svc_conn
     conn = get_svc_conn() # <-- Используем функцию из db_utils
     cursor = conn.cursor()
     cursor.execute(
-        "INSERT INTO Backups (source_db_name, backup_file_path, backup_date) VALUES (?, ?, ?)",
-        source_db_name, backup_file, datetime.date.today()
+        """INSERT INTO Backups (source_db_name, backup_file_path, backup_date, stripe_count, backup_type, base_backup_id)
+           OUTPUT INSERTED.id VALUES (?, ?, ?, ?, ?, ?)""",
+        source_db_name, backup_files[0], datetime.date.today(), len(backup_files), backup_type, base_backup_id
     )
+    backup_id = cursor.fetchone()[0]
+    if len(backup_files) > 1:
+        cursor.executemany(
+            "INSERT INTO BackupFiles (backup_id, file_index, file_path) VALUES (?, ?, ?)",
+            [(backup_id, i + 1, path) for i, path in enumerate(backup_files)]
+        )
     conn.commit()
     conn.close()
 
-    return backup_file
+    # Размер, контрольная сумма, длительность и GUID набора — в каталог бэкапов
+    try:
+        record_backup(backup_files, started, datetime.datetime.now())
+    except Exception as e:
+        print(f"⚠️ {source_db_name} — бэкап не внесён в каталог: {e}")
 
-def daily_backup():
-    today = datetime.date.today()
-    today_str = today.strftime("%d%m%Y")
+    return backup_files
+
+def get_backup_dir(source_db_name):
+    """Папка бэкапов источника: backup_base_path/<source_db_name>."""
+    return os.path.join(get_global_setting('backup_base_path') or r'D:\SQLBackups', source_db_name)
 
+def get_volume(path):
+    """Том, на который пишется бэкап: буква диска или сервер и шара для UNC-путей."""
+    drive = os.path.splitdrive(path)[0]
+    if drive:
+        return drive.lower()
+    parts = [p for p in path.replace('/', '\\').split('\\') if p]
+    return '\\'.join(parts[:2]).lower() if path.startswith('\\\\') else (parts[0].lower() if parts else '')
+
+def _setting_int(key, default):
+    try:
+        return int(get_global_setting(key) or default)
+    except ValueError:
+        return default
+
+def _get_backup_sources():
+    """Все источники, используемые в UserDatabases/CommonDatabases, с их сервером из BackupSources."""
     conn = get_svc_conn()
     cursor = conn.cursor()
-
-    # Получаем все уникальные source_db_name
     cursor.execute("""
-        SELECT DISTINCT source_db_name FROM (
+        SELECT all_dbs.source_db_name, bs.source_server, bs.backup_profile
+        FROM (
             SELECT source_db_name FROM UserDatabases
             UNION
             SELECT source_db_name FROM CommonDatabases
         ) AS all_dbs
+        LEFT JOIN BackupSources bs ON bs.source_db_name = all_dbs.source_db_name
     """)
-    source_dbs = [row[0] for row in cursor.fetchall()]
+    rows = [(row[0], row[1] or '', row[2]) for row in cursor.fetchall()]
     conn.close()
+    return rows
+
+def _interleave_by_server(sources):
+    """Чередует источники по серверам, чтобы потоки пула не ждали лимита одного сервера."""
+    groups = OrderedDict()
+    for source in sources:
+        groups.setdefault(source[1].lower(), []).append(source)
+    ordered = []
+    while groups:
+        for server in list(groups):
+            ordered.append(groups[server].pop(0))
+            if not groups[server]:
+                del groups[server]
+    return ordered
+
+def daily_backup():
+    """
+    Ежедневный бэкап всех источников параллельно.
+    Ограничения: backup_max_parallel всего, backup_max_per_server на один source_server
+    и backup_max_per_volume на один том назначения. В конце печатается сводка
+    (время, размер, МБ/с по каждой базе); при ошибках уведомляется администратор.
+    """
+    max_parallel = max(_setting_int('backup_max_parallel', DEFAULT_MAX_PARALLEL), 1)
+    max_per_server = max(_setting_int('backup_max_per_server', DEFAULT_MAX_PER_SERVER), 1)
+    max_per_volume = max(_setting_int('backup_max_per_volume', DEFAULT_MAX_PER_VOLUME), 1)
+
+    # Сначала освобождаем место: переполненный том ломает и бэкап, и восстановление
+    try:
+        from app.services.retention import run_retention
+        run_retention()
+    except Exception as e:
+        print(f"⚠️ Очистка старых бэкапов не выполнена: {e}")
+    # Журналы: секции следующих месяцев и очистка вышедших из срока хранения
+    try:
+        from app.services.log_storage import apply_log_retention
+        apply_log_retention()
+    except Exception as e:
+        print(f"⚠️ Очистка журналов не выполнена: {e}")
+    sources = _interleave_by_server(_get_backup_sources())
+    total = len(sources)
+    print(f"🔄 Бэкап {total} баз: всего до {max_parallel}, на сервер до {max_per_server}, на том до {max_per_volume}")
+
+    semaphores = {}
+    semaphores_guard = threading.Lock()
+    progress = {"done": 0}
 
-    for db_name in source_dbs:
-        print(f"🔄 Бэкап {db_name}...")
-        try:
-            create_backup_from_source(db_name)
-            print(f"✅ {db_name} — бэкап создан")
-        except Exception as e:
-            print(f"❌ {db_name} — ошибка: {e}")
+    def semaphore(key, limit):
+        with semaphores_guard:
+            if key not in semaphores:
+                semaphores[key] = threading.BoundedSemaphore(limit)
+            return semaphores[key]
+
+    def backup_one(db_name, server, backup_profile):
+        # Набор из нескольких полос занимает все свои тома
+        volumes = sorted({get_volume(path) for path in get_stripe_files(db_name, get_backup_profile(backup_profile))})
+        # Всегда в одном порядке (сервер, затем тома по имени), чтобы потоки не заблокировали друг друга
+        with ExitStack() as stack:
+            stack.enter_context(semaphore(('server', server.lower()), max_per_server))
+            for volume in volumes:
+                stack.enter_context(semaphore(('volume', volume), max_per_volume))
+            started = time.monotonic()
+            # Та же блокировка, что у бэкапа по требованию: сделанный за сегодня бэкап не повторяется
+            chain, created = create_backup_under_lock(db_name, allow_diff=True)
+            elapsed = time.monotonic() - started
+        backup_files = chain[-1]
+        size = sum(os.path.getsize(path) for path in backup_files if os.path.exists(path))
+        return {"db_name": db_name, "files": backup_files, "seconds": elapsed, "size": size, "created": created}
+
+    results = []
+    errors = []
+    started_all = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_parallel) as pool:
+        futures = {pool.submit(backup_one, *source): source[0] for source in sources}
+        for future in as_completed(futures):
+            db_name = futures[future]
+            progress["done"] += 1
+            try:
+                result = future.result()
+                results.append(result)
+                if result['created']:
+                    print(f"✅ [{progress['done']}/{total}] {db_name} — бэкап создан за {result['seconds']:.0f} с")
+                else:
+                    print(f"ℹ️ [{progress['done']}/{total}] {db_name} — бэкап за сегодня уже сделан по требованию")
+            except Exception as e:
+                errors.append((db_name, str(e)))
+                print(f"❌ [{progress['done']}/{total}] {db_name} — ошибка: {e}")
+    elapsed_all = time.monotonic() - started_all
+
+    print("📊 Сводка бэкапа:")
+    for result in sorted(results, key=lambda r: r["seconds"], reverse=True):
+        size_mb = result["size"] / (1024 * 1024)
+        speed = size_mb / result["seconds"] if result["seconds"] > 0 else 0
+        print(f"   {result['db_name']}: {result['seconds']:.0f} с, {size_mb:.0f} МБ, {speed:.1f} МБ/с")
+    total_mb = sum(r["size"] for r in results) / (1024 * 1024)
+    print(f"   Итого: {len(results)} успешно, {len(errors)} с ошибкой, {total_mb:.0f} МБ за {elapsed_all:.0f} с")
+
+    if errors:
+        error_msg = "\n".join(f"{db_name}: {error}" for db_name, error in errors)
+        notify_admin_on_backup_failure(error_msg)
+
+    # Каталог — после бэкапов, чтобы не удлинять окно бэкапа: сначала дожидаемся сумм
+    # файлов этой ночи (record_backup), затем догоняем удаления и файлы в обход портала
+    # и досчитываем оставшиеся суммы; процесс не завершается посреди подсчёта
+    try:
+        from app.services.backup_catalog import scan_catalog, fill_checksums, wait_for_checksums
+        wait_for_checksums()
+        scan_catalog()
+        fill_checksums()
+    except Exception as e:
+        print(f"⚠️ Каталог бэкапов не обновлён: {e}")
+
+    # Свежие бэкапы готовы: планируем подготовку баз, которые вероятно попросят восстановить
+    try:
+        from app.services.prestage import plan_prestage
+        plan_prestage()
+    except Exception as e:
+        print(f"⚠️ Подготовка к восстановлениям не запланирована: {e}")
+    return {"results": results, "errors": errors, "seconds": elapsed_all}
 
 if __name__ == '__main__':
     daily_backup()
\ No newline at end of file
@@ -10,9 +10,27 @@ CREATE TABLE BackupSources (
     source_server NVARCHAR(255) NOT NULL,
     sql_login NVARCHAR(128) NOT NULL,
     sql_password NVARCHAR(255) NOT NULL,
-    datafile_name NVARCHAR(128) NOT NULL
+    datafile_name NVARCHAR(128) NOT NULL,
+    backup_profile NVARCHAR(64) NULL, -- из BackupProfiles, NULL — 'default'
+    backup_max_age_hours INT NULL -- окно свежести бэкапа, NULL — GlobalSettings.backup_max_age_hours
 );
 
+-- Профили бэкапа: число полос, тома и параметры буферов BACKUP
+CREATE TABLE BackupProfiles (
+    profile_name NVARCHAR(64) PRIMARY KEY,
+    stripes INT NOT NULL DEFAULT 1,      -- число файлов (полос) в наборе
+    volumes NVARCHAR(1024) NULL,         -- папки для полос через ';', по кругу; NULL — backup_base_path
+    buffer_count INT NULL,               -- BUFFERCOUNT
+    max_transfer_size INT NULL,          -- MAXTRANSFERSIZE, байт (кратно 64 КБ, до 4 МБ)
+    block_size INT NULL,                 -- BLOCKSIZE, байт
+    strategy NVARCHAR(30) NOT NULL DEFAULT 'full', -- 'full' (COPY_ONLY каждый раз) или 'weekly_full_daily_diff'
+    full_weekday INT NOT NULL DEFAULT 6, -- день полного бэкапа для 'weekly_full_daily_diff' (0 — понедельник)
+    description NVARCHAR(512) NULL
+);
+
+INSERT INTO BackupProfiles (profile_name, stripes, volumes, buffer_count, max_transfer_size, block_size, description) VALUES
+('default', 1, NULL, NULL, NULL, NULL, 'Один файл в backup_base_path, параметры SQL Server по умолчанию');
+
 -- Пользователи Windows
 CREATE TABLE Users (
     id INT IDENTITY(1,1) PRIMARY KEY,
@@ -36,7 +54,8 @@ CREATE TABLE UserDatabases (
     header NVARCHAR(255) NULL,
     use_storage BIT NOT NULL DEFAULT 0,
     infobase_guid NVARCHAR(36) NULL, -- из ClusterInfo
-    notify_user BIT NOT NULL DEFAULT 0
+    notify_user BIT NOT NULL DEFAULT 0,
+    tuning_profile NVARCHAR(64) NULL -- из TuningProfiles, NULL — 'default'
 );
 
 -- Общие БД
@@ -47,7 +66,8 @@ CREATE TABLE CommonDatabases (
     backup_path_template NVARCHAR(512) NOT NULL,
     header NVARCHAR(255) NOT NULL,
     is_admin_only BIT NOT NULL DEFAULT 0
-    infobase_guid NVARCHAR(36) NULL -- из ClusterInfo
+    infobase_guid NVARCHAR(36) NULL, -- из ClusterInfo
+    tuning_profile NVARCHAR(64) NULL -- из TuningProfiles, NULL — 'default'
 );
 
 -- Актуальные бэкапы
@@ -56,20 +76,47 @@ CREATE TABLE Backups (
     source_db_name NVARCHAR(128) NOT NULL,
     backup_file_path NVARCHAR(512) NOT NULL,
     backup_date DATE NOT NULL,
-    created_at DATETIME2 NOT NULL DEFAULT GETDATE()
+    created_at DATETIME2 NOT NULL DEFAULT GETDATE(),
+    stripe_count INT NOT NULL DEFAULT 1, -- число файлов набора; при > 1 файлы в BackupFiles
+    backup_type NVARCHAR(10) NOT NULL DEFAULT 'copy', -- 'copy' (COPY_ONLY), 'full', 'diff'
+    base_backup_id INT NULL -- для 'diff': полный набор цепочки (Backups.id)
+);
+-- Поиск самого свежего бэкапа источника (backup_resolver)
+CREATE UNIQUE INDEX IX_Backups_db_date ON Backups(source_db_name, backup_date DESC) INCLUDE (backup_file_path, created_at);
+
+-- Файлы полосатых наборов (один логический бэкап из нескольких файлов)
+CREATE TABLE BackupFiles (
+    id INT IDENTITY(1,1) PRIMARY KEY,
+    backup_id INT NOT NULL FOREIGN KEY REFERENCES Backups(id) ON DELETE CASCADE,
+    file_index INT NOT NULL, -- номер полосы, с 1
+    file_path NVARCHAR(512) NOT NULL
 );
-CREATE UNIQUE INDEX IX_Backups_db_date ON Backups(source_db_name, backup_date);
+CREATE UNIQUE INDEX IX_BackupFiles_backup ON BackupFiles(backup_id, file_index);
+
+-- Журналы секционированы по месяцам: app/services/log_storage.py добавляет секции вперёд
+-- и очищает (или архивирует) старые переключением секций, без построчного DELETE.
+-- Кластерный ключ журналов — (время записи, id); некластерные индексы выровнены по той же схеме.
+-- Время записи — DATETIME2(3): миллисекунды без потерь проходят через pyodbc (datetime хранит
+-- микросекунды, а не 100 нс), и курсор страницы (время, id) совпадает с ключом строки в таблице.
+CREATE PARTITION FUNCTION PF_LogMonth (DATETIME2(3)) AS RANGE RIGHT FOR VALUES ('2026-01-01');
+CREATE PARTITION SCHEME PS_LogMonth AS PARTITION PF_LogMonth ALL TO ([PRIMARY]);
+GO
 
 -- Логи восстановлений
 CREATE TABLE RestoreJobs (
-    id INT IDENTITY(1,1) PRIMARY KEY,
+    id INT IDENTITY(1,1) NOT NULL,
+    job_id INT NULL, -- RestoreQueue.id (пишется update_job_status)
     windows_user NVARCHAR(100) NOT NULL,
     target_db NVARCHAR(128) NOT NULL,
-    started_at DATETIME2 NOT NULL DEFAULT GETDATE(),
+    started_at DATETIME2(3) NOT NULL DEFAULT GETDATE(),
     finished_at DATETIME2 NULL,
     status NVARCHAR(20) NOT NULL,
-    error_message NVARCHAR(MAX) NULL
-);
+    error_message NVARCHAR(MAX) NULL,
+    CONSTRAINT PK_RestoreJobs PRIMARY KEY CLUSTERED (started_at, id)
+) ON PS_LogMonth(started_at);
+CREATE INDEX IX_RestoreJobs_target ON RestoreJobs(target_db, started_at) INCLUDE (status, finished_at);
+CREATE INDEX IX_RestoreJobs_user ON RestoreJobs(windows_user, started_at) INCLUDE (target_db, status);
+CREATE INDEX IX_RestoreJobs_job ON RestoreJobs(job_id) INCLUDE (status);
 
 
 -- Таблица для хранения общих параметров (включая пути к 1С)
@@ -94,7 +141,59 @@ INSERT INTO GlobalSettings (setting_key, setting_value, description) VALUES
 ('smtp_login', 'sql-restore@company.local', 'Логин SMTP'),
 ('smtp_password', '...', 'Пароль SMTP'),
 ('smtp_from', 'sql-restore@company.local', 'От кого (адрес)'),
-('smtp_tls', '1', 'Использовать TLS (1/0)');
+('smtp_tls', '1', 'Использовать TLS (1/0)'),
+('onec_command_timeout', '3600', 'Таймаут запуска 1cv8/rac, секунд (процесс убивается вместе с дочерними)'),
+('onec_max_per_server', '2', 'Максимум одновременных запусков 1cv8 на сервер приложений'),
+('onec_max_licenses', '4', 'Максимум одновременных запусков 1cv8 (доступные лицензии)'),
+('rac_max_parallel', '8', 'Максимум одновременных вызовов rac на сервер'),
+('ras_address', '', 'Адрес RAS (host:port), пусто — localhost:1545'),
+('cluster_guid', '', 'Кластер 1С для баз, которых нет в ClusterInfo (пусто — основной кластер ClusterInfo или rac cluster list)'),
+('session_drain_timeout', '60', 'Сколько секунд ждать завершения сеансов 1С перед восстановлением'),
+('storage_cache_path', '', 'Папка кэша выгрузок из хранилища конфигурации (пусто — backup_base_path\_storage_cache)'),
+('storage_cache_ttl_minutes', '60', 'Срок годности выгрузки для сетевых хранилищ (tcp/http), минут'),
+('eta_refresh_minutes', '10', 'Как часто пересчитывать статистику длительности восстановлений, минут'),
+('eta_default_minutes', '30', 'Ожидаемая длительность восстановления, если истории ещё нет, минут'),
+('backup_max_parallel', '4', 'Максимум одновременных бэкапов в daily_backup'),
+('backup_max_per_server', '2', 'Максимум одновременных бэкапов с одного source_server'),
+('backup_max_per_volume', '2', 'Максимум одновременных бэкапов на один том назначения'),
+('backup_max_age_hours', '36', 'Самый старый бэкап, из которого можно восстановить без выбора даты, часов'),
+('backup_single_flight_timeout', '7200', 'Сколько ждать чужой бэкап по требованию того же источника, секунд'),
+('retention_max_age_days', '14', 'Удалять наборы бэкапов старше, дней (0 — без ограничения)'),
+('retention_keep_per_source', '3', 'Сколько последних наборов хранить на источник (0 — без ограничения)'),
+('retention_max_volume_gb', '0', 'Максимальный объём бэкапов на томе, ГБ (0 — без ограничения)'),
+('retention_orphan_hours', '24', 'Показывать .bak-файлы без записи в каталоге старше, часов'),
+('retention_delete_orphans', '0', 'Удалять .bak-файлы без записи в каталоге (1/0); при 0 они только показываются в плане'),
+('retention_user_backup_days', '30', 'Удалять личные бэкапы пользователей старше, дней (0 — хранить всегда)'),
+('catalog_checksum', '1', 'Считать SHA-256 файлов бэкапов для каталога (1/0)'),
+('max_concurrent_user_backups', '1', 'Максимум одновременных личных бэкапов пользователей'),
+('max_concurrent_user_restores', '1', 'Максимум одновременных восстановлений из личных бэкапов'),
+('staging_path', '', 'Папка локальных копий бэкапов на сервере SQL Server (пусто — восстанавливать прямо из папок бэкапов)'),
+('staging_max_gb', '200', 'Максимальный объём локальных копий бэкапов, ГБ (вытесняются давно не использованные)'),
+('staging_chunk_mb', '64', 'Размер блока копирования бэкапа в staging, МБ'),
+('prestage_history_days', '56', 'За сколько дней истории запросов строится прогноз восстановлений'),
+('prestage_min_score', '0.3', 'Минимальная вероятность запроса, при которой база готовится заранее (0..1)'),
+('prestage_max_targets', '10', 'Максимум баз, готовящихся заранее на один день'),
+('prestage_storage', '0', 'Заранее выгружать конфигурацию из хранилища для прогнозируемых баз (1/0)'),
+('log_retention_months', '12', 'Сколько месяцев хранить журналы портала (0 — хранить всегда)'),
+('log_archive_months', '0', 'Сколько месяцев держать вышедшие из срока журналы в таблицах *_Archive (0 — сразу удалять)'),
+('log_compress_threshold', '4000', 'Сжимать тексты журнала 1С длиннее, символов (0 — не сжимать)'),
+('log_data_compression', 'NONE', 'Сжатие страниц журналов: NONE, ROW или PAGE (применяется в /admin/log_storage)'),
+('metrics_token', '', 'Токен доступа к /metrics (?token= или Authorization: Bearer); пусто — без проверки');
+
+-- Профили настройки восстановленных БД (применяются на уровне базы, не сервера)
+CREATE TABLE TuningProfiles (
+    profile_name NVARCHAR(64) PRIMARY KEY,
+    maxdop INT NULL,                     -- ALTER DATABASE SCOPED CONFIGURATION SET MAXDOP; NULL — не менять
+    auto_update_stats BIT NULL,          -- AUTO_UPDATE_STATISTICS; NULL — не менять
+    auto_update_stats_async BIT NULL,    -- AUTO_UPDATE_STATISTICS_ASYNC; NULL — не менять
+    query_store NVARCHAR(20) NULL,       -- 'OFF', 'READ_WRITE', 'READ_ONLY'; NULL — не менять
+    description NVARCHAR(512) NULL
+);
+
+-- 'default' меняет только MAXDOP, как прежний set_parallelism; остальное в базе остаётся как в бэкапе
+INSERT INTO TuningProfiles (profile_name, maxdop, auto_update_stats, auto_update_stats_async, query_store, description) VALUES
+('default', 1, NULL, NULL, NULL, 'MAXDOP 1, прочие настройки базы не меняются'),
+('1c_recommended', 1, 1, 1, 'OFF', 'Рекомендации 1С: MAXDOP 1, асинхронная статистика, без Query Store');
 
 -- Очередь задач восстановления
 CREATE TABLE RestoreQueue (
@@ -106,8 +205,15 @@ CREATE TABLE RestoreQueue (
     created_at DATETIME2 NOT NULL DEFAULT GETDATE(),
     started_at DATETIME2 NULL,
     finished_at DATETIME2 NULL,
-    error_message NVARCHAR(MAX) NULL
+    error_message NVARCHAR(MAX) NULL,
+    backup_date DATE NULL, -- бэкап, выбранный пользователем; NULL — самый свежий в окне свежести
+    job_type NVARCHAR(20) NOT NULL DEFAULT 'restore', -- 'restore', 'user_backup', 'user_restore'
+    user_backup_id INT NULL, -- UserBackups.id: источник 'user_restore' или результат 'user_backup'
+    progress INT NULL, -- процент текущего BACKUP/RESTORE
+    progress_stage NVARCHAR(100) NULL -- текущий шаг задачи
 );
+-- Захват воркером: pending-задачи по типу в порядке priority, created_at
+CREATE INDEX IX_RestoreQueue_claim ON RestoreQueue(status, job_type, priority, created_at);
 
 -- Новая таблица: Информация из 1CV8Clst.lst
 CREATE TABLE ClusterInfo (
@@ -121,35 +227,174 @@ CREATE TABLE ClusterInfo (
     updated_at DATETIME2 NOT NULL DEFAULT GETDATE()
 );
 
+-- Постраничная выборка журналов по (timestamp, id) — app/services/log_query.py — идёт по кластерному ключу
 CREATE TABLE AuthLog (
-    id INT IDENTITY(1,1) PRIMARY KEY,
+    id INT IDENTITY(1,1) NOT NULL,
     windows_user NVARCHAR(100) NOT NULL,
     ip_address NVARCHAR(45) NULL, -- IPv4/v6
     action NVARCHAR(50) NOT NULL, -- 'login', 'logout', 'access_denied'
-    timestamp DATETIME2 NOT NULL DEFAULT GETDATE(),
-    details NVARCHAR(512) NULL
-);
+    timestamp DATETIME2(3) NOT NULL DEFAULT GETDATE(),
+    details NVARCHAR(512) NULL,
+    CONSTRAINT PK_AuthLog PRIMARY KEY CLUSTERED (timestamp, id)
+) ON PS_LogMonth(timestamp);
+CREATE INDEX IX_AuthLog_user ON AuthLog(windows_user, timestamp) INCLUDE (ip_address, action);
 
 CREATE TABLE UserActionsLog (
-    id INT IDENTITY(1,1) PRIMARY KEY,
+    id INT IDENTITY(1,1) NOT NULL,
     windows_user NVARCHAR(100) NOT NULL,
     ip_address NVARCHAR(45) NULL,
     action_type NVARCHAR(50) NOT NULL, -- 'restore_requested', 'settings_updated', 'profile_updated'
     target_db NVARCHAR(128) NULL,
     details NVARCHAR(1024) NULL,
-    timestamp DATETIME2 NOT NULL DEFAULT GETDATE()
-);
+    timestamp DATETIME2(3) NOT NULL DEFAULT GETDATE(),
+    CONSTRAINT PK_UserActionsLog PRIMARY KEY CLUSTERED (timestamp, id)
+) ON PS_LogMonth(timestamp);
+CREATE INDEX IX_UserActionsLog_user ON UserActionsLog(windows_user, timestamp) INCLUDE (action_type, target_db);
+CREATE INDEX IX_UserActionsLog_target ON UserActionsLog(target_db, timestamp) INCLUDE (windows_user, action_type);
 
 CREATE TABLE OneCOperationLog (
-    id INT IDENTITY(1,1) PRIMARY KEY,
+    id INT IDENTITY(1,1) NOT NULL,
     job_id INT NULL, -- из RestoreQueue
     target_db NVARCHAR(128) NOT NULL,
     operation NVARCHAR(100) NOT NULL, -- 'SetTitle', 'DisconnectFromStorage', 'ConnectToStorage', 'RestoreDB'
     status NVARCHAR(20) NOT NULL, -- 'started', 'success', 'error'
     log_text NVARCHAR(MAX) NULL, -- полный лог, как в OScript
-    timestamp DATETIME2 NOT NULL DEFAULT GETDATE(),
-    error_message NVARCHAR(MAX) NULL
+    timestamp DATETIME2(3) NOT NULL DEFAULT GETDATE(),
+    error_message NVARCHAR(MAX) NULL,
+    -- Тексты длиннее log_compress_threshold: GZIP от UTF-16LE, как COMPRESS() (app/log_text.py);
+    -- log_text/error_message при этом NULL
+    log_text_gz VARBINARY(MAX) NULL,
+    error_message_gz VARBINARY(MAX) NULL,
+    CONSTRAINT PK_OneCOperationLog PRIMARY KEY CLUSTERED (timestamp, id)
+) ON PS_LogMonth(timestamp);
+CREATE INDEX IX_OneCOperationLog_target ON OneCOperationLog(target_db, timestamp) INCLUDE (job_id, operation, status);
+CREATE INDEX IX_OneCOperationLog_job ON OneCOperationLog(job_id, timestamp) INCLUDE (operation, status);
+
+-- Построчный лог выполнения задачи (вывод 1cv8/rac), читается /logs/stream/<job_id>
+CREATE TABLE RestoreTaskLogs (
+    id INT IDENTITY(1,1) NOT NULL,
+    job_id INT NOT NULL, -- из RestoreQueue
+    message NVARCHAR(MAX) NOT NULL,
+    timestamp DATETIME2(3) NOT NULL DEFAULT GETDATE(),
+    CONSTRAINT PK_RestoreTaskLogs PRIMARY KEY CLUSTERED (timestamp, id)
+) ON PS_LogMonth(timestamp);
+CREATE INDEX IX_RestoreTaskLogs_job ON RestoreTaskLogs(job_id, id);
+
+-- Длительность шагов задач (app/services/job_phases.py), отчёт /admin/performance
+CREATE TABLE JobPhases (
+    id INT IDENTITY(1,1) NOT NULL,
+    job_id INT NOT NULL,                 -- RestoreQueue.id
+    job_type NVARCHAR(20) NOT NULL,
+    target_db NVARCHAR(128) NOT NULL,
+    source_db NVARCHAR(128) NULL,        -- база-источник бэкапа
+    phase NVARCHAR(50) NOT NULL,         -- 'staging', 'restore', 'SetTitle', 'UpdateFromStorage', 'backup'...
+    started_at DATETIME2(3) NOT NULL,
+    finished_at DATETIME2 NOT NULL,
+    duration_seconds FLOAT NOT NULL,
+    bytes BIGINT NULL,                   -- объём прочитанного/записанного бэкапа
+    outcome NVARCHAR(20) NOT NULL,       -- 'success', 'error', 'skipped'
+    details NVARCHAR(512) NULL,
+    CONSTRAINT PK_JobPhases PRIMARY KEY CLUSTERED (started_at, id)
+) ON PS_LogMonth(started_at);
+CREATE INDEX IX_JobPhases_phase ON JobPhases(phase, started_at) INCLUDE (source_db, duration_seconds, bytes, outcome);
+CREATE INDEX IX_JobPhases_job ON JobPhases(job_id) INCLUDE (phase, duration_seconds);
+
+-- Поисковый индекс по выводу 1С и ошибкам задач (app/services/log_search.py):
+-- термин -> документ; секционирован вместе с журналами и очищается с ними
+CREATE TABLE LogSearchIndex (
+    term NVARCHAR(50) NOT NULL,      -- слово без окончания, в нижнем регистре
+    timestamp DATETIME2(3) NOT NULL, -- время документа
+    doc_type NVARCHAR(10) NOT NULL,  -- '1c' — OneCOperationLog.id, 'job' — RestoreJobs.id
+    doc_id INT NOT NULL,
+    job_id INT NULL,                 -- RestoreQueue.id
+    target_db NVARCHAR(128) NULL,
+    tf SMALLINT NOT NULL,            -- сколько раз термин встречается в документе
+    CONSTRAINT PK_LogSearchIndex PRIMARY KEY CLUSTERED (term, timestamp, doc_type, doc_id)
+) ON PS_LogMonth(timestamp);
+
+-- Выгрузки из хранилища конфигурации (.cf/.cfe), общие для всех баз с тем же storage_path
+CREATE TABLE StorageArtifacts (
+    id INT IDENTITY(1,1) PRIMARY KEY,
+    storage_path NVARCHAR(512) NOT NULL,
+    extension_name NVARCHAR(128) NOT NULL DEFAULT '', -- '' — основная конфигурация
+    repo_version NVARCHAR(64) NULL,                   -- отпечаток версии хранилища
+    artifact_path NVARCHAR(512) NOT NULL,
+    config_fingerprint VARCHAR(64) NULL,              -- отпечаток конфигурации базы после загрузки этой выгрузки
+    created_at DATETIME2 NOT NULL DEFAULT GETDATE()
+);
+CREATE UNIQUE INDEX IX_StorageArtifacts_path_ext ON StorageArtifacts(storage_path, extension_name);
+
+-- Какая версия хранилища загружена в целевую базу (после восстановления — по отпечатку конфигурации)
+CREATE TABLE StorageTargetVersions (
+    target_db NVARCHAR(128) NOT NULL,
+    storage_path NVARCHAR(512) NOT NULL,
+    extension_name NVARCHAR(128) NOT NULL DEFAULT '',
+    repo_version NVARCHAR(64) NOT NULL,
+    applied_at DATETIME2 NOT NULL DEFAULT GETDATE()
+);
+CREATE INDEX IX_StorageTargetVersions_target ON StorageTargetVersions(target_db);
+
+-- Каталог файлов бэкапов (заполняется при бэкапе и сканером app/services/backup_catalog.py)
+CREATE TABLE BackupCatalog (
+    id INT IDENTITY(1,1) PRIMARY KEY,
+    file_path NVARCHAR(512) NOT NULL,
+    dir_path NVARCHAR(512) NOT NULL,
+    source_db_name NVARCHAR(128) NULL,  -- из Backups/UserBackups; NULL — файл-сирота
+    backup_id INT NULL,                 -- Backups.id
+    user_backup_id INT NULL,            -- UserBackups.id
+    size_bytes BIGINT NOT NULL,
+    file_mtime DATETIME2 NOT NULL,
+    checksum CHAR(64) NULL,             -- SHA-256 файла
+    backup_set_guid NVARCHAR(36) NULL,  -- msdb.dbo.backupset.backup_set_uuid
+    duration_seconds FLOAT NULL,
+    compression_ratio FLOAT NULL,       -- backup_size / compressed_backup_size
+    scanned_at DATETIME2 NOT NULL DEFAULT GETDATE()
+);
+CREATE UNIQUE INDEX IX_BackupCatalog_path ON BackupCatalog(file_path);
+CREATE INDEX IX_BackupCatalog_dir ON BackupCatalog(dir_path);
+CREATE INDEX IX_BackupCatalog_source ON BackupCatalog(source_db_name) INCLUDE (size_bytes);
+
+-- Состояние папок для инкрементального сканирования каталога
+CREATE TABLE CatalogDirectories (
+    dir_path NVARCHAR(512) NOT NULL PRIMARY KEY,
+    parent_path NVARCHAR(512) NULL,
+    dir_mtime DATETIME2 NOT NULL,
+    scanned_at DATETIME2 NOT NULL DEFAULT GETDATE()
+);
+
+-- Локальные копии бэкапов с сетевых папок (staging), вытесняются LRU по объёму
+CREATE TABLE StagedBackups (
+    id INT IDENTITY(1,1) PRIMARY KEY,
+    source_path NVARCHAR(512) NOT NULL,  -- исходный файл на сетевой папке
+    staged_path NVARCHAR(512) NOT NULL,  -- копия в staging_path
+    size_bytes BIGINT NOT NULL,
+    source_mtime DATETIME2 NOT NULL,     -- mtime источника: изменился — копия устарела
+    bytes_copied BIGINT NOT NULL DEFAULT 0,
+    checksum CHAR(64) NULL,              -- SHA-256 копии
+    status NVARCHAR(20) NOT NULL DEFAULT 'copying', -- 'copying', 'ready'
+    lease_until DATETIME2 NULL,          -- копию читает задача до этого времени: не вытеснять
+    created_at DATETIME2 NOT NULL DEFAULT GETDATE(),
+    last_used_at DATETIME2 NOT NULL DEFAULT GETDATE()
+);
+CREATE UNIQUE INDEX IX_StagedBackups_source ON StagedBackups(source_path);
+CREATE INDEX IX_StagedBackups_lru ON StagedBackups(last_used_at) INCLUDE (size_bytes, status);
+
+-- Прогноз восстановлений и подготовка к ним (app/services/prestage.py)
+CREATE TABLE PrestagePredictions (
+    id INT IDENTITY(1,1) PRIMARY KEY,
+    predicted_for DATE NOT NULL,            -- день ожидаемого запроса
+    target_db NVARCHAR(128) NOT NULL,
+    windows_user NVARCHAR(100) NOT NULL,    -- последний запросивший: через его доступ читается конфигурация базы
+    score FLOAT NOT NULL,                   -- оценка вероятности запроса
+    expected_hour INT NULL,                 -- типичный час запроса
+    status NVARCHAR(20) NOT NULL DEFAULT 'planned', -- 'planned', 'running', 'done', 'failed'
+    details NVARCHAR(MAX) NULL,
+    prepared_at DATETIME2 NULL,
+    prepare_seconds FLOAT NULL,
+    hit_job_id INT NULL,                    -- RestoreQueue.id первого запроса в этот день
+    created_at DATETIME2 NOT NULL DEFAULT GETDATE()
 );
+CREATE UNIQUE INDEX IX_PrestagePredictions_day_target ON PrestagePredictions(predicted_for, target_db);
 
 -- Таблица для хранения личных бэкапов пользователей
 CREATE TABLE UserBackups (
@@ -11,6 +11,7 @@ import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
 from app.db_utils import get_svc_conn # <-- Импортируем функцию подключения из нового модуля
+from app.cluster_cache import mark_updated
 
 def main():
     print("🔄 Начинаю миграцию конфигов из JSON в БД...")
@@ -206,6 +207,7 @@ def main():
     # --- 7. Фиксация изменений ---
     conn.commit()
     conn.close()
+    mark_updated()  # базы пользователей изменились: кэш топологии перечитается во всех процессах
     print("✅ Миграция конфигов завершена!")
 
 if __name__ == '__main__':
@@ -2,6 +2,7 @@ import re
 import pyodbc
 from pathlib import Path
 from app.config_loader import get_global_setting
+from app.cluster_cache import mark_updated
 def parse_1cv8clst_lst(file_path):
     """
     Парсит файл 1CV8Clst.lst и извлекает информацию о базах.
@@ -130,6 +131,7 @@ def main():
         print("✅ Информация о кластере синхронизирована с БД")
         link_user_databases_to_cluster()
         print("✅ Существующие БД сопоставлены с кластером")
+        mark_updated()  # кэш топологии в веб-приложении перечитается при следующем вызове rac
 
 if __name__ == '__main__':
     main()
\ No newline at end of file